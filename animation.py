@@ -0,0 +1,160 @@
+"""
+Render loop for the lamp's light effects.
+
+A single thread steps the current effect at a fixed frame rate.  Deadlines
+come from `time.monotonic()` and advance by exactly one period per frame, so
+time spent drawing does not accumulate as drift.  Playing a new effect
+preempts the current one and cross-fades into it; no threads are created.
+
+Effects are iterators.  Each item is either an (r, g, b) color or a frame
+array (see framebuffer.py) to show for one frame, or a number of seconds to
+hold the current frame.
+"""
+
+import threading
+import time
+import numpy as np
+import logs
+
+log = logs.get('animation')
+
+
+class Effect:
+    """A named effect being played by an Animator."""
+
+    def __init__(self, name, frames):
+        self.name = name
+        self.frames = iter(frames)
+        self.done = threading.Event()
+
+    def finish(self):
+        """Stop the effect's iterator and wake anyone waiting on it."""
+        close = getattr(self.frames, 'close', None)
+        try:
+            if close is not None:
+                close()
+        finally:
+            self.done.set()
+
+    def wait(self, timeout=None):
+        """Block until the effect completes or is preempted."""
+        return self.done.wait(timeout)
+
+
+class Animator:
+    """
+    Play effects into `buffer`, a FrameBuffer, on one render thread.
+
+    `show(frame)` is called with the buffer's frame after every step.
+    `crossfade` is the time in seconds spent blending from the last frame
+    shown into a newly played effect.
+    """
+
+    def __init__(self, buffer, show, fps=100, crossfade=0.2):
+        self.buffer = buffer
+        self.show = show
+        self.fps = fps
+        self.period = 1 / fps
+        self.crossfade_frames = round(crossfade * fps)
+        self.late_frames = 0
+        self._fade_from = np.empty_like(buffer.frame)
+        self._effect = None
+        self._pending = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def frames(self, seconds):
+        """Number of frames (at least one) lasting `seconds`."""
+        return max(1, round(seconds * self.fps))
+
+    def play(self, effect):
+        """Preempt the current effect with `effect` and return it."""
+        with self._lock:
+            replaced, self._pending = self._pending, effect
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='animator', daemon=True)
+                self._thread.start()
+        if replaced is not None:
+            replaced.finish()
+        self._wake.set()
+        return effect
+
+    @property
+    def current(self):
+        """The effect playing now, or None."""
+        return self._pending or self._effect
+
+    def _sleep_until(self, deadline):
+        """Sleep until `deadline` (None: forever) or a new effect is played."""
+        while self._pending is None:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return
+            self._wake.wait(remaining)
+            self._wake.clear()
+
+    def _fail(self):
+        """End the current effect after it or show() raised; the loop goes on."""
+        log.exception('Effect failed', effect=self._effect.name)
+        try:
+            self._effect.finish()
+        except Exception:
+            log.exception('Effect failed to stop', effect=self._effect.name)
+        self._effect = None
+
+    def _run(self):
+        frame = self.buffer.frame
+        deadline = time.monotonic()
+        fading = False
+        fade_step = 0
+        while True:
+            with self._lock:
+                pending, self._pending = self._pending, None
+            if pending is not None:
+                if self._effect is not None:
+                    self._effect.finish()
+                    np.copyto(self._fade_from, frame)
+                    fading, fade_step = True, 1
+                self._effect = pending
+                deadline = time.monotonic()
+
+            if self._effect is None:
+                self._sleep_until(None)
+                continue
+
+            try:
+                step = next(self._effect.frames)
+            except StopIteration:
+                self._effect.finish()
+                self._effect = None
+                continue
+            except Exception:
+                self._fail()
+                continue
+
+            if isinstance(step, (int, float)):
+                deadline += step
+                self._sleep_until(deadline)
+                continue
+
+            self.buffer.as_frame(step, frame)
+            if fading:
+                if fade_step > self.crossfade_frames:
+                    fading = False
+                else:
+                    level = 255 * fade_step // (self.crossfade_frames + 1)
+                    self.buffer.mix(self._fade_from, frame, level, frame)
+                    fade_step += 1
+            try:
+                self.show(frame)
+            except Exception:
+                self._fail()
+                continue
+
+            deadline += self.period
+            if deadline < time.monotonic() - self.period:
+                # too far behind to catch up; skip ahead rather than burst
+                self.late_frames += 1
+                deadline = time.monotonic()
+            self._sleep_until(deadline)
@@ -0,0 +1,1024 @@
+#!/bin/python
+"""
+Micro-benchmarks for the potter lamp.
+
+Run a single benchmark with `python benchmark.py <name>`, or `python
+benchmark.py --help` for the list.  Benchmarks never touch the lamp hardware.
+"""
+
+import argparse
+import collections
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+
+from gestures import spells_list, motions_list, SpellMatcher, GestureState
+
+
+def report(name, seconds, count, unit='op'):
+    """Print the time per operation for `count` operations."""
+    print(f'{name:<32} {seconds * 1e6 / count:10.2f} us/{unit}  ({count} {unit}s in {seconds:.3f}s)')
+
+
+def token_stream(length, seed=1):
+    """Random motion tokens, with long runs like a held wand motion."""
+    rng = random.Random(seed)
+    tokens = []
+    while len(tokens) < length:
+        tokens.extend([rng.choice(motions_list[:4])] * rng.randint(1, 8))
+    return tokens[:length]
+
+
+def legacy_is_gesture(point_gestures, i, token):
+    """The original IsGesture matching: join the whole history and scan it."""
+    point_gestures[i].append(token)
+    astr = ''.join(map(str, point_gestures[i]))
+    for motion, spell in spells_list.items():
+        if motion in astr:
+            return spell
+
+
+def bench_gestures(args):
+    """Compare the substring scan with the incremental SpellMatcher."""
+    matcher = SpellMatcher(spells_list)
+    for length in args.lengths:
+        stream = token_stream(length)
+
+        point_gestures = [['']]
+        start = time.perf_counter()
+        legacy_casts = sum(legacy_is_gesture(point_gestures, 0, token) is not None for token in stream)
+        report(f'substring scan, {length} tokens', time.perf_counter() - start, length, 'token')
+
+        gesture = GestureState()
+        start = time.perf_counter()
+        casts = sum(matcher.feed(gesture, token) is not None for token in stream)
+        report(f'SpellMatcher, {length} tokens', time.perf_counter() - start, length, 'token')
+        print(f'  casts: substring scan {legacy_casts}, SpellMatcher {casts}')
+
+
+def legacy_process_image(frame):
+    """The original ProcessImage, allocating kernels and buffers per frame."""
+    import numpy as np
+    import cv2
+    filtered = cv2.cvtColor(frame,cv2.COLOR_BGR2GRAY)
+    cv2.equalizeHist(filtered)
+    filtered = cv2.GaussianBlur(filtered,(9,9),1.5)
+    dilate_kernel = np.ones((5, 5), np.uint8)
+    filtered = cv2.dilate(filtered, dilate_kernel, iterations=1)
+    clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8,8))
+    return clahe.apply(filtered)
+
+
+def measure_frames(name, process, frames):
+    """Report time and peak transient allocation per frame for `process`."""
+    process(frames[0]) # warm up any lazily allocated buffers
+    start = time.perf_counter()
+    for frame in frames:
+        process(frame)
+    report(name, time.perf_counter() - start, len(frames), 'frame')
+
+    tracemalloc.start()
+    peak = 0
+    for frame in frames:
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        process(frame)
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - before)
+    tracemalloc.stop()
+    print(f'  peak allocation per frame: {peak / 1024:.1f} KiB')
+
+
+def bench_preprocess(args):
+    """Compare the original ProcessImage with ImagePipeline on 640x480 frames."""
+    import numpy as np
+    from preprocess import ImagePipeline
+    rng = np.random.default_rng(1)
+    frames = [rng.integers(0, 255, (480, 640, 3), np.uint8) for _ in range(args.frames)]
+    measure_frames('ProcessImage (original)', legacy_process_image, frames)
+    measure_frames('ImagePipeline', ImagePipeline().process, frames)
+
+
+def dot_frames(count, dots=3, seed=1):
+    """
+    Dark, noisy 640x480 BGR frames with bright IR-like dots.
+
+    Returns the frames and, for each frame, the (N, 2) array of dot centres.
+    """
+    import numpy as np
+    import cv2
+    rng = np.random.default_rng(seed)
+    frames, truth = [], []
+    for _ in range(count):
+        frame = rng.integers(0, 40, (480, 640, 3), np.uint8)
+        centres = rng.uniform((40, 40), (600, 440), (dots, 2))
+        for x, y in centres:
+            cv2.circle(frame, (int(x), int(y)), int(rng.integers(4, 8)), (255, 255, 255), -1)
+        frames.append(frame)
+        truth.append(centres.astype(int))
+    return frames, truth
+
+
+def load_recording(path):
+    """Frames (and ground truth 'points' if present) from an .npz recording."""
+    import numpy as np
+    recording = np.load(path, allow_pickle=True)
+    frames = list(recording['frames'])
+    truth = list(recording['points']) if 'points' in recording else None
+    return frames, truth
+
+
+def recall(found, expected, radius=8):
+    """Fraction of `expected` points with a detection within `radius` pixels."""
+    import numpy as np
+    if len(expected) == 0:
+        return 1.0
+    if found is None:
+        return 0.0
+    found = found.reshape(-1, 2)
+    distances = np.linalg.norm(found[None, :, :] - np.asarray(expected)[:, None, :], axis=2)
+    return float(np.mean(distances.min(axis=1) <= radius))
+
+
+def bench_detectors(args):
+    """Latency and recall of each wand detector on recorded or synthetic frames."""
+    from preprocess import ImagePipeline
+    from detectors import create_detector
+    if args.recording:
+        frames, truth = load_recording(args.recording)
+    else:
+        frames, truth = dot_frames(args.frames)
+    pipeline = ImagePipeline(outputs=len(frames))
+    processed = [pipeline.process(frame) for frame in frames]
+
+    for name, gate in (('hough', False), ('blob', False), ('hough', True), ('blob', True)):
+        detector = create_detector(name, gate)
+        start = time.perf_counter()
+        found = [detector.detect(gray) for gray in processed]
+        label = f'{name}{" + MOG2 gate" if gate else ""}'
+        report(label, time.perf_counter() - start, len(processed), 'frame')
+        if truth is not None:
+            scores = [recall(points, expected) for points, expected in zip(found, truth)]
+            print(f'  recall: {sum(scores) / len(scores):.2%}')
+
+
+def fake_hardware():
+    """Run on the stand-ins from hardware.py, a synthetic camera and lamp state in memory."""
+    from config import potter_lamp_config as config
+    config['hardware'] = 'stub'
+    config['camera_source'] = 'synthetic'
+    config['state_backend'] = 'memory'
+    config['debug_opencv'] = False
+
+
+class SlowBackend:
+    """Wrap a state backend, adding a network round trip to every call."""
+
+    def __init__(self, backend, latency):
+        self.backend = backend
+        self.latency = latency
+        self.calls = 0
+
+    def get(self, key):
+        self.calls += 1
+        time.sleep(self.latency)
+        return self.backend.get(key)
+
+    def set_many(self, items, channel, message):
+        self.calls += 1
+        time.sleep(self.latency)
+        self.backend.set_many(items, channel, message)
+
+    def listen(self, channel, callback, on_error=None):
+        self.backend.listen(channel, callback, on_error)
+
+
+def legacy_incendio(store, pixels, lamp_duration):
+    """The original incendio loop, with a store round trip for every check."""
+    interval = 0.1
+    duration = lamp_duration
+    store.set('potter_lights', 'on')
+    while duration > 0 and store.get('potter_lights') == 'on' and store.get('current_spell') == 'incendio':
+        current_color = store.get('potter_current_color')
+        color = (random.randint(100, 255), random.randint(0, 40), 0)
+        for val in range(10):
+            pixels.fill((
+                int(current_color[0] + ((color[0] - current_color[0]) * val / 10)),
+                int(current_color[1] + ((color[1] - current_color[1]) * val / 10)),
+                int(current_color[2] + ((color[2] - current_color[2]) * val / 10)),
+            ))
+            time.sleep(0.003)
+        store.set('potter_current_color', color)
+        pixels.fill(color)
+        time.sleep(interval)
+        duration = duration - interval
+
+
+def frame_jitter(name, frames, target, hold):
+    """Report how far LED frame intervals stray from `target` seconds."""
+    # gaps between flames are `hold` long, the rest are animation frames
+    deltas = [b - a for a, b in zip(frames, frames[1:])]
+    for label, wanted, intervals in (
+            (name, target, [delta for delta in deltas if delta < hold / 2]),
+            ('  holds', hold, [delta for delta in deltas if delta >= hold / 2])):
+        errors = sorted(abs(interval - wanted) * 1000 for interval in intervals)
+        print(f'{label:<32} {len(intervals)} intervals, mean {statistics.mean(intervals) * 1000:.2f} ms, '
+              f'stdev {statistics.pstdev(intervals) * 1000:.2f} ms, '
+              f'p99 error {errors[int(len(errors) * 0.99)]:.2f} ms')
+
+
+def bench_animation(args):
+    """Frame-time jitter of incendio, and the cost of casting a spell."""
+    fake_hardware()
+    import hardware
+    import spells
+    from state import MemoryBackend, StateStore, shared_store
+
+    backend = SlowBackend(MemoryBackend(), args.latency / 1000)
+    legacy_store = StateStore('bench', backend, max_age=0)
+    legacy_store.update({'current_spell': 'incendio', 'potter_current_color': (0, 0, 0)})
+    # the original code wrote every change straight to the strip
+    strip = hardware.StubPixels(auto_write=True)
+    legacy_incendio(legacy_store, strip, args.seconds)
+    frame_jitter('incendio (store per step)', strip.frames, 0.003, 0.1)
+    print(f'  store calls: {backend.calls}')
+
+    backend.calls = 0
+    shared_store().backend = backend
+    strip = hardware.pixels()
+    strip.frames.clear()
+    spells.incendio(args.seconds)
+    # holds start once the last frame of a fade has had its period
+    period = spells.animator.period
+    frame_jitter('incendio (render loop)', strip.frames, period, 0.1 + period)
+    print(f'  store calls: {backend.calls}, late frames: {spells.animator.late_frames}')
+
+    shared_store().backend = backend.backend
+    start = time.perf_counter()
+    for _ in range(1000):
+        spells.cast_spell('colovaria')
+    report('cast_spell', time.perf_counter() - start, 1000, 'cast')
+    print(f'  threads running: {threading.active_count()}')
+    spells.nox()
+
+def bench_effects(args):
+    """Cost of rendering and pushing per-pixel spell frames."""
+    fake_hardware()
+    import spells
+    for name in ('incendio', 'colovaria'):
+        effect = spells.spell_effects[name](args.seconds)
+        count = 0
+        start = time.perf_counter()
+        for step in effect:
+            if isinstance(step, (int, float)):
+                continue # holds cost nothing
+            spells.framebuffer.as_frame(step, spells.framebuffer.frame)
+            spells.show(spells.framebuffer.frame)
+            count += 1
+        elapsed = time.perf_counter() - start
+        report(f'{name} frames', elapsed, count, 'frame')
+        print(f'  capacity: {count / elapsed:.0f} fps')
+
+
+def percentiles(name, samples, unit='ms', scale=1000):
+    """Print the p50/p90/p99 of `samples` (seconds)."""
+    if not samples:
+        print(f'{name:<32} no samples')
+        return
+    samples = sorted(samples)
+    pick = lambda p: samples[min(len(samples) - 1, int(len(samples) * p))] * scale
+    print(f'{name:<32} p50 {pick(0.5):8.2f} {unit}  p90 {pick(0.9):8.2f} {unit}  '
+          f'p99 {pick(0.99):8.2f} {unit}  ({len(samples)} samples)')
+
+
+class StageTimer:
+    """Time calls to functions patched into modules or classes."""
+
+    def __init__(self):
+        self.samples = {}
+        self._patched = []
+
+    def wrap(self, owner, attribute, stage):
+        original = getattr(owner, attribute)
+        samples = self.samples.setdefault(stage, [])
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                samples.append(time.perf_counter() - start)
+
+        setattr(owner, attribute, timed)
+        self._patched.append((owner, attribute, original))
+
+    def restore(self):
+        for owner, attribute, original in reversed(self._patched):
+            setattr(owner, attribute, original)
+        self._patched = []
+
+
+def drive_tracker(wand, source, track=None):
+    """Run TrackWand, or `track`, until `source` is drained; returns (seconds, casts)."""
+    grabbers = []
+    start_camera = wand.StartCamera
+    def record_camera(source):
+        grabbers.append(start_camera(source))
+        return grabbers[-1]
+
+    casts = []
+    cast_spell = wand.cast_spell
+    def record_cast(spell, *rest):
+        casts.append((time.monotonic(), spell))
+        return cast_spell(spell, *rest)
+
+    wand.cast_spell = record_cast
+    wand.StartCamera = record_camera
+    try:
+        wand.LampState('on')
+        tracker = threading.Thread(target=track or wand.TrackWand, args=(source,), name='wand')
+        start = time.perf_counter()
+        tracker.start()
+        while tracker.is_alive() and not (grabbers and grabbers[0].drained):
+            time.sleep(0.05)
+        elapsed = time.perf_counter() - start
+        wand.LampState('off')
+        tracker.join()
+    finally:
+        wand.cast_spell = cast_spell
+        wand.StartCamera = start_camera
+    return elapsed, casts
+
+
+def bench_tracking(args):
+    """Drive TrackWand end to end on a synthetic scene or a replayed recording."""
+    fake_hardware()
+    from config import potter_lamp_config as config
+    if args.recognizer:
+        config['gesture_recognizer'] = args.recognizer
+    import cv2
+    import camera
+    import wand
+
+    if args.recording:
+        source = camera.ReplaySource(args.recording, realtime=not args.max_speed)
+    else:
+        source = camera.SyntheticSource(realtime=not args.max_speed, repeat=args.repeat)
+
+    timer = StageTimer()
+    timer.wrap(camera.FrameGrabber, 'read', 'capture (wait for frame)')
+    timer.wrap(wand, 'ProcessImage', 'ProcessImage')
+    timer.wrap(wand.wand_detector, 'detect', 'detect')
+    timer.wrap(cv2, 'calcOpticalFlowPyrLK', 'calcOpticalFlowPyrLK')
+    timer.wrap(wand, 'IsGesture', 'IsGesture')
+    scans = getattr(wand.frame_scans, 'value', 0)
+    elapsed, casts = drive_tracker(wand, source)
+    timer.restore()
+    scans = getattr(wand.frame_scans, 'value', 0) - scans
+
+    frames = len(timer.samples['ProcessImage'])
+    print(f'{len(source)} source frames in {elapsed:.2f}s, {frames} processed: {frames / elapsed:.1f} fps')
+    for stage, samples in timer.samples.items():
+        percentiles(stage, samples)
+
+    # from the frame on which the last stroke became a motion
+    gestures = getattr(source, 'gestures', [])
+    latencies = []
+    for started, done, spell in gestures:
+        matched = [cast for cast, name in casts if name == spell and started <= cast <= done + 1]
+        if matched:
+            latencies.append(min(matched) - done)
+    print(f'gestures recognised: {len(latencies)} of {len(gestures)}, casts: {len(casts)}, '
+          f'tracks started: {wand.tracks.next_id}, pruned: {wand.tracks.pruned} '
+          f'({sum(track.parked for track in wand.tracks.tracks.values())} parked as static), '
+          f'whole-frame scans: {scans}')
+    if not args.max_speed:
+        percentiles('gesture done -> cast_spell', latencies)
+
+
+def bench_idle(args):
+    """CPU use and wake-up latency with and without the idle motion gate."""
+    fake_hardware()
+    import camera
+    import wand
+    from idle import MotionGate
+
+    # a quiet room between gestures, long enough for the gate to fall asleep
+    idle_after = 2.0
+    pause = idle_after + 3
+    for name, gate in (('always tracking', None), ('motion gated', MotionGate(idle_after=idle_after))):
+        wand.idle_gate = gate
+        source = camera.SyntheticSource(pause=pause, repeat=args.repeat)
+        # (time.monotonic(), time.process_time(), awake) at every change of mode
+        changes = [(time.monotonic(), time.process_time(), True)]
+        if gate is not None:
+            update = gate.update
+            def record_update(frame, now):
+                awake = update(frame, now)
+                if awake != changes[-1][2]:
+                    changes.append((time.monotonic(), time.process_time(), awake))
+                return awake
+            gate.update = record_update
+        elapsed, casts = drive_tracker(wand, source)
+        changes.append((time.monotonic(), time.process_time(), None))
+
+        print(f'{name}: {len(source)} frames in {elapsed:.2f}s')
+        for mode, awake in (('tracking', True), ('idle', False)):
+            wall = cpu = 0.0
+            for (start, start_cpu, state), (end, end_cpu, _) in zip(changes, changes[1:]):
+                if state == awake:
+                    wall += end - start
+                    cpu += end_cpu - start_cpu
+            if wall:
+                print(f'  {mode:<10} {wall:6.2f}s  CPU {cpu / wall:6.1%} of one core')
+
+        # a gesture started while idle waits for the gate to wake
+        wakes = []
+        for started, _, _ in source.gestures:
+            state = [(at, awake) for at, _, awake in changes if awake is not None and at <= started][-1]
+            if state[1]:
+                wakes.append(0.0)
+            else:
+                wakes.extend([at - started for at, _, awake in changes if awake and at > started][:1])
+        recognised = sum(any(spell == cast and started <= at <= done + 1 for at, cast in casts)
+                         for started, done, spell in source.gestures)
+        print(f'  gestures recognised: {recognised} of {len(source.gestures)}')
+        percentiles('  wake-up latency', wakes)
+        wand.LampState('off')
+
+
+def bench_pipeline(args):
+    """Throughput and latency of the tracking thread and the process pipeline."""
+    fake_hardware()
+    import camera
+    import wand
+    # keep the idle gate out of the comparison
+    wand.idle_gate = None
+
+    for name in ('thread', 'processes'):
+        source = camera.SyntheticSource(realtime=not args.max_speed, repeat=args.repeat)
+        # (captured, done) for every tracked frame
+        frames = []
+        if name == 'thread':
+            # a frame is done when the loop comes back for the next one
+            read_stamped = camera.FrameGrabber.read_stamped
+            def record_read(grabber, timeout=1.0):
+                if frames and frames[-1][1] is None:
+                    frames[-1] = (frames[-1][0], time.monotonic())
+                rval, frame, stamp = read_stamped(grabber, timeout)
+                if rval:
+                    frames.append((stamp, None))
+                return rval, frame, stamp
+            camera.FrameGrabber.read_stamped = record_read
+            elapsed, casts = drive_tracker(wand, source)
+            camera.FrameGrabber.read_stamped = read_stamped
+            frames = [frame for frame in frames if frame[1] is not None]
+        else:
+            latency = wand.pipeline_latency
+            class Recorder:
+                def observe(self, seconds):
+                    done = time.monotonic()
+                    frames.append((done - seconds, done))
+            wand.pipeline_latency = Recorder()
+            elapsed, casts = drive_tracker(wand, source, wand.TrackWandPipeline)
+            wand.pipeline_latency = latency
+
+        span = frames[-1][1] - frames[0][0] if frames else 0
+        print(f'{name}: {len(source)} source frames, {len(frames)} tracked at '
+              f'{len(frames) / span if span else 0:.1f} fps ({elapsed:.2f}s with startup), '
+              f'casts: {[spell for _, spell in casts]}')
+        percentiles('  capture -> tracked', [done - captured for captured, done in frames])
+
+
+startup_script = '''
+import json, sys, time
+start = time.perf_counter()
+from config import potter_lamp_config as config
+config['hardware'] = 'stub'
+config['state_backend'] = 'memory'
+import {module}
+result = {{'import': time.perf_counter() - start}}
+if '{module}' == 'potterServer':
+    potterServer.app.test_client().get('/wand/status')
+    result['first_request'] = time.perf_counter() - start
+result['loaded'] = [name for name in ('numpy', 'cv2', 'redis', 'flask') if name in sys.modules]
+print(json.dumps(result))
+'''
+
+
+def bench_startup(args):
+    """Import time of each module, and time to the server's first request."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    for module in ('config', 'emitters', 'spells', 'potterServer', 'wand'):
+        runs = []
+        for _ in range(3):
+            # a fresh interpreter each time, so nothing is imported already
+            output = subprocess.run([sys.executable, '-c', startup_script.format(module=module)],
+                                    cwd=here, capture_output=True, text=True, check=True).stdout
+            runs.append(json.loads(output.splitlines()[-1]))
+        best = min(runs, key=lambda run: run['import'])
+        line = f'import {module:<14} {best["import"] * 1000:8.1f} ms'
+        if 'first_request' in best:
+            line += f', first request at {best["first_request"] * 1000:.1f} ms'
+        print(f'{line}  (loads {", ".join(best["loaded"]) or "none of numpy, cv2, redis, flask"})')
+
+
+def score_gestures(source, casts):
+    """Count gestures whose first cast, by frame index, was the right spell."""
+    correct = 0
+    started = None
+    for index, (_, _, event, spell) in enumerate(source.path):
+        if event == 'started':
+            started = index
+        elif event == 'completed':
+            window = [name for frame, name in casts if started <= frame <= index + 10]
+            correct += bool(window) and window[0] == spell
+    return correct
+
+
+def bench_recognizers(args):
+    """Accuracy and cost of token and trajectory recognition across speeds."""
+    import numpy as np
+    from camera import SyntheticSource
+    from gestures import TrajectoryRecognizer, load_templates
+    templates = load_templates('spell_templates.json')
+    matcher = SpellMatcher(spells_list)
+    rng = np.random.default_rng(1)
+
+    for fps in (15, 30, 60):
+        for speed in (200, 400, 800):
+            source = SyntheticSource(fps=fps, speed=speed, realtime=False, static_dots=0)
+            path = np.array([(x, y) for x, y, _, _ in source.path])
+            path += rng.normal(0, 1, path.shape)
+            gestures = sum(event == 'completed' for _, _, event, _ in source.path)
+
+            gesture = GestureState()
+            token_casts = []
+            for frame, (old, new) in enumerate(zip(path, path[1:]), 1):
+                token = gesture.motion(*new, *old)
+                spell = matcher.feed(gesture, token) if token else None
+                if spell:
+                    token_casts.append((frame, spell))
+
+            recognizer = TrajectoryRecognizer(templates)
+            trajectory_casts = []
+            for frame, (x, y) in enumerate(path):
+                for _, spell in recognizer.update([(0, x, y)], frame / fps):
+                    trajectory_casts.append((frame, spell))
+
+            print(f'{fps:3d} fps, {speed:3d} px/s: tokens {score_gestures(source, token_casts)}/{gestures}, '
+                  f'trajectory {score_gestures(source, trajectory_casts)}/{gestures}')
+
+    # scoring cost with ten tracked points, all moving
+    recognizer = TrajectoryRecognizer(templates)
+    points = rng.uniform(0, 480, (10, 2))
+    frames = args.frames
+    false_casts = 0
+    start = time.perf_counter()
+    for frame in range(frames):
+        points += rng.normal(0, 8, points.shape)
+        false_casts += len(recognizer.update([(key, x, y) for key, (x, y) in enumerate(points)], frame / 30))
+    elapsed = time.perf_counter() - start
+    report('trajectory scoring, 10 points', elapsed, frames, 'frame')
+    print(f'  {elapsed / frames * 30:.1%} of a 30 fps frame budget, {false_casts} casts from random motion')
+
+
+def bench_flow(args):
+    """Optical flow: the original call, sized parameters and ROI-restricted flow."""
+    import numpy as np
+    import cv2
+    import camera
+    from preprocess import ImagePipeline
+    from detectors import create_detector
+    from flow import OpticalFlow, criteria
+    from tracks import TrackManager
+
+    if args.recording:
+        source = camera.ReplaySource(args.recording, realtime=False)
+    else:
+        source = camera.SyntheticSource(realtime=False, repeat=args.repeat)
+    image_pipeline = ImagePipeline()
+    detector = create_detector('hough')
+    frames, grays, points = [], [], []
+    while True:
+        rval, raw = source.read()
+        if not rval:
+            break
+        frame = camera.orient(raw, np.empty_like(raw))
+        frames.append(frame)
+        grays.append(image_pipeline.process(frame).copy())
+        points.append(detector.detect(grays[-1]))
+    flow = OpticalFlow()
+    shape = grays[0].shape
+    margin = flow.margin(shape)
+    moving = sum(p0 is not None for p0 in points[:-1])
+    print(f'{len(grays)} frames of {shape[1]}x{shape[0]}, {moving} with points to follow; '
+          f'window {flow.window}, {flow.levels} levels')
+
+    def bounds(p0):
+        tracks = TrackManager()
+        tracks.associate(p0, 0)
+        return tracks.bounds(shape, margin)
+
+    def legacy(index, p0):
+        if p0 is None:
+            return None
+        return cv2.calcOpticalFlowPyrLK(grays[index - 1], grays[index], p0, None, winSize=(25, 25),
+                                        maxLevel=10, criteria=criteria)
+
+    def sized(index, p0):
+        return flow.track(grays[index], p0)
+
+    def roi(index, p0):
+        return flow.track(grays[index], p0, None if p0 is None else bounds(p0))
+
+    # each frame is followed from the previous frame's detections, in order,
+    # as TrackWand would
+    results = {}
+    for name, method in (('calcOpticalFlowPyrLK (25x25, maxLevel 10)', legacy),
+                         (f'OpticalFlow ({flow.window}x{flow.window}, {flow.levels} levels)', sized),
+                         ('OpticalFlow, padded ROI', roi)):
+        flow.reset()
+        flow.track(grays[0], None)
+        samples, found = [], []
+        for index in range(1, len(grays)):
+            p0 = points[index - 1]
+            start = time.perf_counter()
+            result = method(index, p0)
+            if p0 is not None:
+                samples.append(time.perf_counter() - start)
+                p1, st, err = result
+                found.append((p1.reshape(-1, 2), st.ravel().astype(bool)))
+        results[name] = found
+        percentiles(name, samples)
+
+    reference = next(iter(results.values()))
+    for name, found in list(results.items())[1:]:
+        agree = total = 0
+        for (p1, st), (r1, rst) in zip(found, reference):
+            both = st & rst
+            total += int(rst.sum())
+            agree += int((np.linalg.norm(p1[both] - r1[both], axis=1) < 1).sum())
+        print(f'  {name}: {agree} of {total} points within 1 px of the original call')
+
+    start = time.perf_counter()
+    for frame in frames:
+        image_pipeline.process(frame)
+    report('ProcessImage, full frame', time.perf_counter() - start, len(frames), 'frame')
+    boxes = [bounds(p0) for p0 in points if p0 is not None]
+    start = time.perf_counter()
+    for frame, box in zip(frames, boxes):
+        image_pipeline.process(frame, roi=box)
+    report('ProcessImage, padded ROI', time.perf_counter() - start, len(boxes), 'frame')
+    area = np.mean([(x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in boxes]) / (shape[0] * shape[1])
+    print(f'  ROI covers {area:.0%} of the frame on average')
+
+
+def legacy_orient(raw, dst, rotate=None, mirror=True):
+    """The original rotation then in-place flip of FrameGrabber."""
+    import numpy as np
+    import cv2
+    if rotate is not None:
+        cv2.rotate(raw, rotate, dst=dst)
+    else:
+        np.copyto(dst, raw)
+    if mirror:
+        cv2.flip(dst, 1, dst)
+    return dst
+
+
+def bench_capture(args):
+    """Grayscale capture from YUV luma planes against BGR capture and conversion."""
+    fake_hardware()
+    import numpy as np
+    import cv2
+    import camera
+
+    height = 480
+    to_gray = {'yuyv': cv2.COLOR_YUV2GRAY_YUYV, 'i420': cv2.COLOR_YUV2GRAY_I420}
+    raws = {}
+    for pixel_format in ('bgr', 'yuyv', 'i420'):
+        source = camera.SyntheticSource(realtime=False, pixel_format=pixel_format)
+        raws[pixel_format] = [source.read()[1].copy() for _ in range(args.frames)]
+        if pixel_format in to_gray:
+            # the luma view must be the Y plane itself, not a copy of it
+            shared = all(np.shares_memory(camera.luma(raw, height), raw) for raw in raws[pixel_format])
+            exact = all(np.array_equal(camera.luma(raw, height), cv2.cvtColor(raw, to_gray[pixel_format]))
+                        for raw in raws[pixel_format])
+            print(f'{pixel_format}: luma is a view of the raw frame: {shared}, equals OpenCV Y plane: {exact}')
+
+    def path(raws, orient, gray, rotate):
+        dst = None
+        start = time.perf_counter()
+        for raw in raws:
+            view = camera.luma(raw, height) if gray else raw
+            if dst is None:
+                dst = np.empty(camera.oriented_shape(view.shape, rotate), view.dtype)
+            frame = orient(view, dst, rotate, True)
+            if frame.ndim == 3:
+                cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        return time.perf_counter() - start
+
+    for rotate, name in ((None, 'no rotation'), (cv2.ROTATE_180, 'rotated 180')):
+        print(f'{name}, mirrored, to grayscale:')
+        report('  BGR (original)', path(raws['bgr'], legacy_orient, False, rotate), args.frames, 'frame')
+        report('  BGR, one transform', path(raws['bgr'], camera.orient, False, rotate), args.frames, 'frame')
+        report('  YUYV luma', path(raws['yuyv'], camera.orient, True, rotate), args.frames, 'frame')
+        report('  I420 luma', path(raws['i420'], camera.orient, True, rotate), args.frames, 'frame')
+
+    import wand
+    timer = StageTimer()
+    timer.wrap(wand, 'ProcessImage', 'ProcessImage')
+    source = camera.LumaSource(camera.SyntheticSource(pixel_format='yuyv', repeat=args.repeat), height)
+    elapsed, casts = drive_tracker(wand, source)
+    timer.restore()
+    gestures = sum(any(spell == cast and started <= at <= done + 1 for at, cast in casts)
+                   for started, done, spell in source.gestures)
+    print(f'TrackWand on YUYV luma: {len(source)} frames in {elapsed:.2f}s, '
+          f'gestures recognised: {gestures} of {len(source.gestures)}')
+    percentiles('  ProcessImage', timer.samples['ProcessImage'])
+
+
+def bench_warmstart(args):
+    """Time from turning the wand on to its first tracked frame."""
+    fake_hardware()
+    import camera
+    import spells
+    import wand
+
+    # a synthetic camera that takes as long to open as the Pi's does to
+    # start streaming and settle its exposure
+    def slow_open(spec):
+        time.sleep(args.open_delay)
+        return camera.open_source(spec)
+    wand.cameras.opener = slow_open
+
+    first = []
+    process_image = wand.ProcessImage
+    def record_first(frame, roi=None):
+        if not first:
+            first.append(time.perf_counter())
+        return process_image(frame, roi)
+    wand.ProcessImage = record_first
+
+    def legacy_watch():
+        wand.LampState('on')
+        spells.lumos(0, (16, 16, 255))
+        wand.TrackWand()
+
+    def session(watch):
+        first.clear()
+        start = time.perf_counter()
+        thread = threading.Thread(target=watch)
+        thread.start()
+        while not first and time.perf_counter() - start < 30:
+            time.sleep(0.001)
+        latency = first[0] - start
+        wand.LampState('off')
+        thread.join()
+        return latency
+
+    for name, watch, idle_release in (('blocking greeting, camera closed after each session', legacy_watch, 0),
+                                      ('WatchSpellsOn, camera kept warm', wand.WatchSpellsOn, 60)):
+        wand.cameras.idle_release = idle_release
+        latencies = [session(watch) for _ in range(args.repeat + 1)]
+        wand.cameras.close()
+        print(f'{name}:')
+        print(f'  first session {latencies[0] * 1000:7.1f} ms, then ' +
+              ', '.join(f'{latency * 1000:.1f}' for latency in latencies[1:]) + ' ms')
+    wand.ProcessImage = process_image
+
+
+def bench_replay(args):
+    """Size of a tracker recording and how fast it replays through the gestures."""
+    import tempfile
+    fake_hardware()
+    import camera
+    import wand
+    import recorder
+
+    with tempfile.TemporaryDirectory() as directory:
+        wand.recorder = recorder.Recorder(directory)
+        timer = StageTimer()
+        timer.wrap(wand.recorder, 'record', 'Recorder.record')
+        source = camera.SyntheticSource(realtime=not args.max_speed, repeat=args.repeat)
+        elapsed, casts = drive_tracker(wand, source)
+        timer.restore()
+        wand.recorder.close()
+        wand.recorder = None
+        percentiles('Recorder.record', timer.samples['Recorder.record'], 'us', 1e6)
+
+        path, = recorder.recordings(directory)
+        size = os.path.getsize(path)
+        start = time.perf_counter()
+        _, records = recorder.load(path)
+        found = recorder.replay(records)
+        replayed = time.perf_counter() - start
+        span = records['t_ms'][-1] / 1000 if len(records) else 0
+        print(f'{len(records)} records, {size} bytes for {elapsed:.1f}s of tracking: '
+              f'{size / elapsed / 1024:.2f} KiB/s, {size / elapsed * 86400 / 2**20:.0f} MiB a day of tracking')
+        print(f'replayed {span:.1f}s in {replayed * 1000:.1f}ms ({span / replayed:.0f}x real time): '
+              f'{len(found)} spells, {len(casts)} cast live')
+
+
+def bench_offload(args):
+    """Lamps sending synthetic frames to a vision worker on this machine."""
+    import socket
+    import camera
+    import offload
+
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    here = os.path.dirname(os.path.abspath(__file__))
+    worker = subprocess.Popen([sys.executable, 'offload.py', '--host', '127.0.0.1', '--port', str(port)],
+                              cwd=here, stdout=subprocess.DEVNULL)
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline or worker.poll() is not None:
+                    raise RuntimeError('the vision worker did not start')
+                time.sleep(0.1)
+
+        lamps = []
+        def run_lamp(index):
+            source = camera.SyntheticSource(repeat=args.repeat, pixel_format='yuyv')
+            grabber = camera.FrameGrabber(camera.LumaSource(source, source.size[1])).start()
+            casts = []
+            client = offload.OffloadClient('127.0.0.1', port, f'lamp-{index}',
+                                           lambda spell, key: casts.append(spell),
+                                           max_in_flight=args.in_flight).connect()
+            lamps.append((client, casts))
+            while not grabber.drained:
+                rval, frame, stamp = grabber.read_stamped()
+                if rval:
+                    client.send(frame)
+            grabber.release()
+            # let the last frames come back
+            time.sleep(0.5)
+            client.close()
+
+        threads = [threading.Thread(target=run_lamp, args=(index,)) for index in range(args.lamps)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for client, casts in lamps:
+            print(f'{client.name}: {client.sent} frames sent, {client.dropped} dropped on the lamp, '
+                  f'{client.worker_dropped} on the worker, casts: {casts}')
+            percentiles('  round trip', [round_trip for round_trip, _ in client.round_trips])
+            percentiles('  on the worker', [seconds for _, seconds in client.round_trips])
+    finally:
+        worker.terminate()
+        worker.wait()
+
+
+class SlowStream:
+    """A text stream whose writes take `delay` seconds, like a backed-up journald."""
+
+    def __init__(self, stream, delay):
+        self.stream = stream
+        self.delay = delay
+
+    def write(self, text):
+        time.sleep(self.delay)
+        return self.stream.write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+
+def bench_logging(args):
+    """Time the tracking loop spends on the old prints and on logs.py."""
+    import logging
+    import tempfile
+    import logs
+
+    log = logs.get('benchmark')
+    lamp_logger = logging.getLogger('potterlamp')
+    rate_limit = logs._limit
+    output = logs._listener.handlers[0]
+    count = args.frames * 5
+    dx, dy, gesture = 12.345, -3.21, 'right,up'
+
+    def logged(name, level, limits, sink):
+        lamp_logger.setLevel(level)
+        rate_limit.limits = limits
+        output.setStream(sink)
+        start = time.perf_counter()
+        for i in range(count):
+            if log.enabled(logs.DEBUG):
+                log.debug('Point moved', point=i, dx=dx, dy=dy, gesture=gesture)
+        report(name, time.perf_counter() - start, count, 'message')
+        # let the writer catch up before the next run
+        while not logs._listener.queue.empty():
+            time.sleep(0.01)
+
+    with tempfile.TemporaryFile('w+') as file:
+        for sink_name, sink in (('file', file), (f'{args.latency:g} ms writes', SlowStream(file, args.latency / 1000))):
+            print(f'{sink_name}:')
+            stdout = sys.stdout
+            sys.stdout = sink
+            start = time.perf_counter()
+            for i in range(count):
+                print(f'-> movement: dx={int(dx * 100) / 100}, dy={int(dy * 100) / 100}')
+                print(f'    -> {i}: {gesture}')
+            elapsed = time.perf_counter() - start
+            sys.stdout = stdout
+            report('  print, as before', elapsed, count, 'message')
+            logged('  log.debug, level INFO', logs.INFO, {}, sink)
+            logged('  log.debug, queued', logs.DEBUG, {}, sink)
+            logged('  log.debug, limited to 20/s', logs.DEBUG, {'Point moved': 20}, sink)
+        output.setStream(sys.stdout)
+
+
+def bench_profile(args):
+    """What sampling the tracking thread costs it, and what the samples show."""
+    fake_hardware()
+    import camera
+    import wand
+    import profiler
+
+    for name in ('not profiled', 'profiled'):
+        source = camera.SyntheticSource(repeat=args.repeat)
+        result = {}
+        sampler = None
+        if name == 'profiled':
+            sampler = threading.Thread(target=lambda: result.update(
+                zip(('stacks', 'samples'), profiler.sample(seconds=len(source) / 30))))
+            sampler.start()
+        cpu = time.process_time()
+        elapsed, casts = drive_tracker(wand, source)
+        cpu = time.process_time() - cpu
+        if sampler is not None:
+            sampler.join()
+        print(f'{name}: {cpu * 1000 / len(source):.2f} ms CPU a frame '
+              f'({cpu / elapsed * 100:.0f}% of a core), casts: {[spell for _, spell in casts]}')
+
+    # time in the tracking thread by innermost frame
+    innermost = collections.Counter()
+    for stack, count in result['stacks'].items():
+        if stack[0] == 'wand':
+            innermost[stack[-1]] += count
+    wand_samples = sum(innermost.values())
+    print(f'{result["samples"]} samples, {len(result["stacks"])} distinct stacks; the tracking thread in:')
+    for label, count in innermost.most_common(6):
+        print(f'  {count * 100 / wand_samples:5.1f}%  {label}')
+
+
+benchmarks = {
+    'gestures': bench_gestures,
+    'preprocess': bench_preprocess,
+    'detectors': bench_detectors,
+    'animation': bench_animation,
+    'effects': bench_effects,
+    'tracking': bench_tracking,
+    'idle': bench_idle,
+    'pipeline': bench_pipeline,
+    'startup': bench_startup,
+    'recognizers': bench_recognizers,
+    'replay': bench_replay,
+    'flow': bench_flow,
+    'capture': bench_capture,
+    'warmstart': bench_warmstart,
+    'offload': bench_offload,
+    'logging': bench_logging,
+    'profile': bench_profile,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('benchmark', choices=sorted(benchmarks))
+    parser.add_argument('--lengths', type=int, nargs='+', default=[100, 1000, 10000],
+                        help='token stream lengths for the gestures benchmark')
+    parser.add_argument('--frames', type=int, default=200,
+                        help='number of frames for image benchmarks')
+    parser.add_argument('--recording', help='.npz file of recorded frames (and points)')
+    parser.add_argument('--seconds', type=float, default=3,
+                        help='how long to run timed benchmarks')
+    parser.add_argument('--latency', type=float, default=2,
+                        help='simulated store round trip in milliseconds')
+    parser.add_argument('--max-speed', action='store_true',
+                        help='replay frames as fast as possible instead of in real time')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='times to repeat the synthetic spell sequence')
+    parser.add_argument('--open-delay', type=float, default=1.5,
+                        help='simulated camera start-up time in seconds')
+    parser.add_argument('--lamps', type=int, default=2,
+                        help='lamps sharing the vision worker in the offload benchmark')
+    parser.add_argument('--in-flight', type=int, default=2,
+                        help='frames a lamp may have at the vision worker at once')
+    parser.add_argument('--recognizer', choices=('tokens', 'trajectory'),
+                        help='gesture recognizer for the tracking benchmark')
+    args = parser.parse_args()
+    benchmarks[args.benchmark](args)
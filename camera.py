@@ -0,0 +1,563 @@
+"""
+Threaded camera capture for wand tracking.
+
+A dedicated reader thread pulls frames from the camera into a small ring of
+preallocated buffers so the vision loop never blocks on `read()` and never
+works on a stale frame.  Consumers always get the most recent frame; frames
+that arrive while the consumer is busy are overwritten and counted as dropped.
+
+Frames come from a source with the `read(image=None)` / `release()` interface
+of `cv2.VideoCapture`: the live camera, a replayed recording, or a synthetic
+scene of moving IR dots for benchmarks.
+
+Behind the IR-pass filter the NoIR camera's picture is monochrome anyway.
+With `pixel_format='gray'` the camera is asked for raw YUYV frames, and
+`LumaSource` hands out their luma plane, so no color conversion is needed.
+"""
+
+import os
+import threading
+import time
+import numpy as np
+import cv2
+from gestures import spells_list, split_motions
+import metrics
+
+captured_frames = metrics.counter('captured_frames', 'Frames read from the camera.')
+dropped_frames = metrics.counter('dropped_frames', 'Frames replaced before the tracker read them.')
+
+
+def open_source(source=0, width=640, height=480, realtime=True, pixel_format='bgr'):
+    """
+    Open a camera device number, replay a recording from a path, or draw a
+    looping 'synthetic' scene.
+
+    With `pixel_format` 'gray' frames are the luma plane of the camera's
+    YUYV output (or of the synthetic scene's); recordings are converted.
+    """
+    gray = pixel_format == 'gray'
+    if source == 'synthetic':
+        scene = SyntheticSource(size=(width, height), realtime=realtime, loop=True,
+                                pixel_format='yuyv' if gray else 'bgr')
+        return LumaSource(scene, height) if gray else scene
+    if isinstance(source, int):
+        capture = cv2.VideoCapture(source)
+        capture.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+        capture.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+        if not gray:
+            return capture
+        capture.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'YUYV'))
+        capture.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+        return LumaSource(capture, height)
+    replay = ReplaySource(source, realtime)
+    return LumaSource(replay, height) if gray else replay
+
+
+def luma(raw, height):
+    """
+    The luma (Y) plane of a raw frame `height` lines high, as a view.
+
+    YUYV frames, shaped (height, width, 2) or flat as V4L2 hands them over,
+    give a view of every other byte; planar I420 or NV12 frames, shaped
+    (height * 3 / 2, width), give their first `height` rows.  Gray frames
+    are returned as they are and BGR frames are converted.
+    """
+    if raw.ndim == 3:
+        if raw.shape[2] == 2:
+            return raw[:, :, 0]
+        return cv2.cvtColor(raw, cv2.COLOR_BGR2GRAY)
+    if raw.shape[0] == height * 3 // 2:
+        return raw[:height]
+    if raw.shape[0] != height:
+        return raw.reshape(height, -1, 2)[:, :, 0]
+    return raw
+
+
+class LumaSource:
+    """
+    Grayscale frames from the luma plane of `source`'s raw YUV frames.
+
+    `read()` returns a view into the frame `source` produced, valid until
+    the next `read()`.  Everything else is passed through to `source`.
+    """
+
+    def __init__(self, source, height=480):
+        self.source = source
+        self.height = height
+        self._raw = None
+
+    def __getattr__(self, name):
+        return getattr(self.source, name)
+
+    def __len__(self):
+        return len(self.source)
+
+    def read(self, image=None):
+        # `image` would be a previous view; the raw buffer is reused instead
+        rval, raw = self.source.read(self._raw)
+        if not rval or raw is None:
+            return rval, raw
+        self._raw = raw
+        return True, luma(raw, self.height)
+
+    def release(self):
+        self.source.release()
+
+
+class ReplaySource:
+    """
+    Replay recorded frames from a video file, a directory of images or an
+    .npz file with a 'frames' array.
+
+    With `realtime` frames are paced at `fps` (or the video's own rate),
+    otherwise they are returned as fast as they are read.
+    """
+
+    def __init__(self, path, realtime=True, fps=30, loop=False):
+        self.realtime = realtime
+        self.loop = loop
+        self.finished = False
+        self._index = 0
+        self._video = None
+        self._frames = None
+        self._files = None
+        if os.path.isdir(path):
+            self._files = sorted(os.path.join(path, name) for name in os.listdir(path))
+        elif path.endswith('.npz'):
+            self._frames = np.load(path)['frames']
+        else:
+            self._video = cv2.VideoCapture(path)
+            fps = self._video.get(cv2.CAP_PROP_FPS) or fps
+        self.period = 1 / fps
+        self._next = None
+
+    def __len__(self):
+        if self._video is not None:
+            return int(self._video.get(cv2.CAP_PROP_FRAME_COUNT))
+        return len(self._files if self._files is not None else self._frames)
+
+    def _read(self, image):
+        if self._video is not None:
+            rval, frame = self._video.read(image)
+            if not rval and self.loop:
+                self._video.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                rval, frame = self._video.read(image)
+            return rval, frame
+        if self._index >= len(self):
+            if not self.loop:
+                return False, None
+            self._index = 0
+        self._index += 1
+        if self._files is not None:
+            return True, cv2.imread(self._files[self._index - 1])
+        return True, self._frames[self._index - 1]
+
+    def read(self, image=None):
+        if self.realtime:
+            now = time.monotonic()
+            if self._next is not None and now < self._next:
+                time.sleep(self._next - now)
+            self._next = max(now, self._next or now) + self.period
+        rval, frame = self._read(image)
+        self.finished = not rval
+        return rval, frame
+
+    def release(self):
+        if self._video is not None:
+            self._video.release()
+
+
+# Direction of each motion token in (mirrored) image coordinates, matching
+# the deltas IsGesture turns into tokens.
+motion_directions = {
+    '!right': (1, 0),
+    '!left': (-1, 0),
+    '!up': (0, 1),
+    '!down': (0, -1),
+}
+
+
+class SyntheticSource:
+    """
+    Draw a bright wand tip tracing `spells` over a dark, noisy scene.
+
+    Each spell's motions are traced at `speed` pixels per second, with a
+    `pause` between spells.  `static_dots` bright points that never move
+    stand in for lamps and reflections.  `gestures` collects
+    `(started, completed, spell)` `time.monotonic()` stamps for every gesture,
+    taken as its first frame is read and as the tip first moves more than
+    `movement_threshold` pixels into its last stroke, the earliest the
+    gesture can be recognised.  With `loop` the scene
+    starts over instead of ending.  `pixel_format` 'yuyv' or 'i420' returns
+    raw frames like a camera's, for `LumaSource`.
+    """
+
+    def __init__(self, spells=('lumos', 'nox', 'incendio', 'colovaria'), size=(640, 480),
+                 fps=30, realtime=True, speed=400, stroke=150, pause=1.0,
+                 static_dots=2, repeat=1, loop=False, seed=1, pixel_format='bgr',
+                 movement_threshold=10):
+        width, height = size
+        self.size = size
+        self.pixel_format = pixel_format
+        self._conversion = {'bgr': None, 'yuyv': cv2.COLOR_BGR2YUV_YUYV,
+                            'i420': cv2.COLOR_BGR2YUV_I420}[pixel_format]
+        self._bgr = None
+        self.period = 1 / fps
+        self.realtime = realtime
+        self.loop = loop
+        self.finished = False
+        self.gestures = []
+        rng = np.random.default_rng(seed)
+        self._background = rng.integers(0, 40, (height, width, 3), np.uint8)
+        for x, y in rng.uniform((20, 20), (width - 20, height - 20), (static_dots, 2)):
+            cv2.circle(self._background, (int(x), int(y)), 6, (255, 255, 255), -1)
+
+        motions = {spell: motions for motions, spell in spells_list.items()}
+        step = speed / fps
+        strokes = int(stroke / step)
+        # the frame of a stroke on which it has gone far enough to be a motion
+        recognisable = min(int(movement_threshold // step), strokes - 1)
+        # (x, y, gesture event, spell) for every frame of the scene, in the
+        # mirrored coordinates the tracker sees
+        self.path = []
+        for spell in list(spells) * repeat:
+            x, y = width / 2, height / 2
+            for _ in range(int(pause * fps)):
+                self.path.append((x, y, None, None))
+            tokens = split_motions(motions[spell])
+            for token_index, token in enumerate(tokens):
+                dx, dy = motion_directions[token]
+                for frame_index in range(strokes):
+                    x, y = x + dx * step, y + dy * step
+                    event = None
+                    if token_index == 0 and frame_index == 0:
+                        event = 'started'
+                    elif token_index == len(tokens) - 1 and frame_index == recognisable:
+                        event = 'recognisable'
+                    elif token_index == len(tokens) - 1 and frame_index == strokes - 1:
+                        event = 'completed'
+                    self.path.append((x, y, event, spell))
+        for _ in range(int(pause * fps)):
+            self.path.append((x, y, None, None))
+        self._index = 0
+        self._next = None
+        self._started = None
+        self._recognisable = None
+
+    def __len__(self):
+        return len(self.path)
+
+    def read(self, image=None):
+        if self._index >= len(self.path):
+            if not self.loop:
+                self.finished = True
+                return False, None
+            self._index = 0
+        if self.realtime:
+            now = time.monotonic()
+            if self._next is not None and now < self._next:
+                time.sleep(self._next - now)
+            self._next = max(now, self._next or now) + self.period
+        x, y, event, spell = self.path[self._index]
+        self._index += 1
+        if self._conversion is None:
+            if image is None or image.shape != self._background.shape:
+                image = np.empty_like(self._background)
+            bgr = image
+        else:
+            if self._bgr is None:
+                self._bgr = np.empty_like(self._background)
+            bgr = self._bgr
+        np.copyto(bgr, self._background)
+        # frames are mirrored by the grabber, so draw the tip mirrored here
+        cv2.circle(bgr, (int(self.size[0] - 1 - x), int(y)), 6, (255, 255, 255), -1)
+        if self._conversion is not None:
+            image = cv2.cvtColor(bgr, self._conversion, dst=image)
+        if event == 'started':
+            self._started = time.monotonic()
+        elif event == 'recognisable':
+            self._recognisable = time.monotonic()
+        elif event == 'completed':
+            self.gestures.append((self._started, self._recognisable, spell))
+        return True, image
+
+    def release(self):
+        pass
+
+
+def oriented_shape(shape, rotate=None):
+    """The shape of a frame of `shape` once rotated by `rotate`."""
+    if rotate in (cv2.ROTATE_90_CLOCKWISE, cv2.ROTATE_90_COUNTERCLOCKWISE):
+        return (shape[1], shape[0]) + tuple(shape[2:])
+    return tuple(shape)
+
+
+def orient(raw, dst, rotate=None, mirror=True):
+    """
+    Copy `raw` into `dst`, rotated by `rotate` and then mirrored if `mirror`.
+
+    The rotation and the mirroring are a single flip or transpose of `raw`.
+    A strided view, such as the luma of a YUYV frame, is copied once by
+    NumPy rather than first compacted by OpenCV.
+    """
+    if raw.strides[-1] != raw.itemsize:
+        view = raw
+        if rotate == cv2.ROTATE_90_CLOCKWISE:
+            view = np.rot90(raw, -1)
+        elif rotate == cv2.ROTATE_180:
+            view = raw[::-1, ::-1]
+        elif rotate == cv2.ROTATE_90_COUNTERCLOCKWISE:
+            view = np.rot90(raw)
+        np.copyto(dst, view[:, ::-1] if mirror else view)
+    elif not mirror:
+        if rotate is None:
+            np.copyto(dst, raw)
+        else:
+            cv2.rotate(raw, rotate, dst=dst)
+    elif rotate is None:
+        cv2.flip(raw, 1, dst)
+    elif rotate == cv2.ROTATE_180:
+        cv2.flip(raw, 0, dst)
+    elif rotate == cv2.ROTATE_90_CLOCKWISE:
+        cv2.transpose(raw, dst)
+    else:
+        # a counterclockwise turn and a mirror make a transpose turned half way
+        cv2.transpose(raw, dst)
+        cv2.flip(dst, -1, dst)
+    return dst
+
+
+class FrameGrabber:
+    """
+    Capture frames from `source` on a background thread.
+
+    `read()` mirrors `cv2.VideoCapture.read()` but returns the latest frame
+    only.  The returned array is a ring slot owned by the grabber and stays
+    valid until the next call to `read()`.  Sources that are not real time
+    (replays at maximum speed) are read no faster than frames are consumed,
+    so no frame is dropped.  While paused the camera keeps running, but its
+    frames are only grabbed, not decoded or stored.  While `set_idle()` the
+    consumer skips frames on purpose, and they are not counted as dropped.
+    """
+
+    def __init__(self, source, rotate=None, mirror=True, slots=3):
+        self.source = source
+        self.lossless = not getattr(source, 'realtime', True)
+        self.rotate = rotate
+        self.mirror = mirror
+        # one slot being written, one published, one held by the consumer
+        self._slots = [None] * max(slots, 3)
+        self._stamps = [0.0] * len(self._slots)
+        self._raw = None
+        self._latest = -1
+        self._held = -1
+        self._seq = 0
+        self._read_seq = 0
+        self.captured = 0
+        self.dropped = 0
+        self._cond = threading.Condition()
+        self._running = False
+        self._paused = False
+        self._idle = False
+        self._thread = None
+
+    def start(self):
+        """Start the reader thread."""
+        if self._running:
+            return self
+        self._running = True
+        self._thread = threading.Thread(target=self._reader, name='camera', daemon=True)
+        self._thread.start()
+        return self
+
+    def pause(self):
+        """Stop delivering frames, keeping the camera open and running."""
+        with self._cond:
+            self._paused = True
+
+    def set_idle(self, idle):
+        """Whether the consumer is only reading now and then, e.g. to watch for motion."""
+        with self._cond:
+            self._idle = idle
+
+    def resume(self):
+        """Deliver frames again, starting with the next one captured."""
+        with self._cond:
+            self._paused = False
+            self._idle = False
+            self._read_seq = self._seq
+            self._held = -1
+            self._cond.notify_all()
+
+    def _next_slot(self):
+        for offset in range(1, len(self._slots) + 1):
+            slot = (self._latest + offset) % len(self._slots)
+            if slot != self._latest and slot != self._held:
+                return slot
+
+    def _store(self, slot, raw):
+        """Copy `raw` into ring slot `slot`, applying rotation and mirroring."""
+        shape = oriented_shape(raw.shape, self.rotate)
+        dst = self._slots[slot]
+        if dst is None or dst.shape != shape or dst.dtype != raw.dtype:
+            dst = self._slots[slot] = np.empty(shape, raw.dtype)
+        return orient(raw, dst, self.rotate, self.mirror)
+
+    def _reader(self):
+        """Read frames until stopped, publishing each as the latest frame."""
+        while self._running:
+            if self._paused:
+                if self.lossless:
+                    # a replay has no exposure to keep settled; wait for resume()
+                    with self._cond:
+                        self._cond.wait_for(lambda: not self._paused or not self._running)
+                    continue
+                # keep the camera streaming, so exposure stays settled
+                grab = getattr(self.source, 'grab', None)
+                if grab is not None:
+                    rval = grab()
+                else:
+                    rval, _ = self.source.read(self._raw)
+                if not rval:
+                    time.sleep(0.01)
+                continue
+            if self.lossless:
+                with self._cond:
+                    self._cond.wait_for(lambda: self._seq == self._read_seq or not self._running)
+            rval, raw = self.source.read(self._raw)
+            if not rval or raw is None:
+                time.sleep(0.01)
+                continue
+            self._raw = raw
+            stamp = time.monotonic()
+            with self._cond:
+                slot = self._next_slot()
+            self._store(slot, raw)
+            with self._cond:
+                if self._seq > self._read_seq and not self._idle:
+                    # the consumer never saw the previous frame
+                    self.dropped += 1
+                    dropped_frames.inc()
+                self._latest = slot
+                self._stamps[slot] = stamp
+                self._seq += 1
+                self.captured += 1
+                captured_frames.inc()
+                self._cond.notify_all()
+
+    @property
+    def drained(self):
+        """True once a finite source is finished and every frame was read."""
+        return self.finished and self._seq == self._read_seq
+
+    def read_stamped(self, timeout=1.0):
+        """
+        Wait for a frame newer than the last one read.
+
+        Returns `(rval, frame, timestamp)` where `timestamp` is the
+        `time.monotonic()` at which the frame left the camera.
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._seq > self._read_seq or not self._running, timeout):
+                return False, None, 0.0
+            if self._seq == self._read_seq:
+                return False, None, 0.0
+            self._read_seq = self._seq
+            self._held = self._latest
+            # let a lossless reader fetch the next frame
+            self._cond.notify_all()
+            return True, self._slots[self._held], self._stamps[self._held]
+
+    def read(self, timeout=1.0):
+        """Return `(rval, frame)` for the latest frame, like `VideoCapture`."""
+        rval, frame, _ = self.read_stamped(timeout)
+        return rval, frame
+
+    @property
+    def finished(self):
+        """True once a finite source has no more frames."""
+        return getattr(self.source, 'finished', False)
+
+    def release(self):
+        """Stop the reader thread and release the camera."""
+        self._running = False
+        with self._cond:
+            self._cond.notify_all()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=2)
+        self._thread = None
+        self.source.release()
+
+
+class CameraPool:
+    """
+    Cameras kept open between tracking sessions.
+
+    `acquire(spec)` returns a running FrameGrabber for a `spec` understood
+    by `opener` (a device number, 'synthetic' or a path), reusing the one
+    left by the last session.  `release()` only pauses it; it is closed
+    once unused for `idle_release` seconds, at once if 0 and never if
+    negative.
+    """
+
+    def __init__(self, opener=open_source, rotate=None, idle_release=60.0):
+        self.opener = opener
+        self.rotate = rotate
+        self.idle_release = idle_release
+        self._idle = {}
+        self._lock = threading.RLock()
+
+    def acquire(self, spec):
+        """A running grabber for `spec`, warm if one is idle."""
+        with self._lock:
+            grabber, timer = self._idle.pop(spec, (None, None))
+        if timer is not None:
+            timer.cancel()
+        if grabber is not None:
+            grabber.resume()
+            return grabber
+        grabber = FrameGrabber(self.opener(spec), self.rotate).start()
+        grabber.spec = spec
+        return grabber
+
+    def release(self, grabber):
+        """Pause `grabber` for the next session, or close it."""
+        spec = getattr(grabber, 'spec', None)
+        if spec is None or self.idle_release == 0:
+            grabber.release()
+            return
+        grabber.pause()
+        timer = None
+        if self.idle_release > 0:
+            timer = threading.Timer(self.idle_release, self._expire, (spec, grabber))
+            timer.daemon = True
+        with self._lock:
+            previous = self._idle.pop(spec, None)
+            self._idle[spec] = (grabber, timer)
+        if previous is not None:
+            previous[0].release()
+        if timer is not None:
+            timer.start()
+
+    def warm(self, spec):
+        """Open the camera for `spec` ahead of the first session."""
+        # a session starting meanwhile waits for this camera instead of opening another
+        with self._lock:
+            if spec not in self._idle:
+                self.release(self.acquire(spec))
+
+    def _expire(self, spec, grabber):
+        with self._lock:
+            if self._idle.get(spec, (None,))[0] is not grabber:
+                return
+            del self._idle[spec]
+        grabber.release()
+
+    def close(self):
+        """Release every idle camera."""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for grabber, timer in idle.values():
+            if timer is not None:
+                timer.cancel()
+            grabber.release()
@@ -0,0 +1,60 @@
+"""
+Run lamp commands one at a time on a single worker thread.
+
+Requests only queue a command and return.  A command that is already waiting
+is not queued twice, and the queue is bounded, so a burst of requests cannot
+pile up work or threads.  Commands run in the order they were first queued.
+"""
+
+import threading
+from collections import OrderedDict
+import metrics
+import logs
+
+log = logs.get('commands')
+commands_run = metrics.counter('commands', 'Commands run by the command queue.')
+commands_coalesced = metrics.counter('commands_coalesced', 'Commands merged with one already queued.')
+
+
+class CommandQueue:
+    """
+    Queue of named commands for the functions in `handlers`.
+
+    `submit()` returns 'queued', 'coalesced' when the same command is already
+    waiting, 'busy' when `maxsize` commands are waiting, or 'unknown'.
+    """
+
+    def __init__(self, handlers, maxsize=16):
+        self.handlers = handlers
+        self.maxsize = maxsize
+        self._pending = OrderedDict()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def submit(self, name):
+        """Queue command `name` unless it is waiting already."""
+        if name not in self.handlers:
+            return 'unknown'
+        with self._cond:
+            if name in self._pending:
+                commands_coalesced.inc()
+                return 'coalesced'
+            if len(self._pending) >= self.maxsize:
+                return 'busy'
+            self._pending[name] = True
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._worker, name='commands', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return 'queued'
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending)
+                name, _ = self._pending.popitem(last=False)
+            try:
+                self.handlers[name]()
+            except Exception as error:
+                log.exception('Command failed', command=name, error=error)
+            commands_run.inc()
@@ -2,24 +2,84 @@
 Configuration variables for Potter Lamp server
 '''
 
-from cv2 import ROTATE_180, ROTATE_90_CLOCKWISE, ROTATE_90_COUNTERCLOCKWISE
+# Camera rotations, the values of OpenCV's cv2.ROTATE_* constants
+ROTATE_90_CLOCKWISE = 0
+ROTATE_180 = 1
+ROTATE_90_COUNTERCLOCKWISE = 2
 
 potter_lamp_config = {
+    # 'pi', 'stub' for in-memory stand-ins, or 'auto' to use stand-ins
+    # when the Raspberry Pi libraries are missing
+    'hardware': 'auto',
+
     # Flask Server
     'host': '0.0.0.0',
     'port': 5000,
+    'command_queue_size': 16, # lamp commands waiting to run before requests are turned away
+    'events_snapshot_interval': 5, # seconds between metrics events on /events
+
+    # Timing histograms and counters served at /metrics
+    'metrics': True,
 
     # Redis
     'redis_namespace': 'potterlamp',
+    'state_backend': 'redis', # 'memory' runs without a Redis server
+    'state_max_age': 1.0, # seconds a cached value is trusted without an update
 
     # OpenCV
+    'camera_source': 0, # camera device, a recording (video, image dir, .npz) to replay, or 'synthetic'
+    'camera_format': 'bgr', # or 'gray' to track on the camera's YUYV luma plane
+    'camera_idle_release': 60, # seconds the camera stays open after tracking stops, negative for always
+    'camera_warm_on_start': False, # open the camera on server start, so the first session starts warm
     'debug_opencv': False, # requires desktop x11 server
-    'debug_test_image': False, # saves image capture with found points to file
+    'debug_test_image': False, # serves image capture with found points at /wand/watch
+    'debug_stream_fps': 10, # frame rate limit for /wand/stream
+    'debug_profile': True, # sample thread stacks at /debug/profile?seconds=N
+    'debug_profile_max_seconds': 60, # longest profile a request can ask for
     'rotate_camera': None, # optional camera rotation
+    'preprocess_stages': ('blur', 'dilate', 'clahe'), # also: 'equalize'
+    'wand_detector': 'hough', # 'hough' circles or bright IR 'blob'
+    'wand_detector_gate': False, # only detect in moving (MOG2 foreground) areas
+    'wand_detector_params': {}, # e.g. {'threshold': 220} for 'blob'
+    'wand_scan_interval': 1.0, # seconds between whole-frame searches while no wand is followed
+    'wand_confirm_interval': 2.5, # while one is, unless something moves elsewhere
+    'wand_lost_timeout': 1.0, # seconds a lost point is searched for before it is dropped
+    'wand_max_speed': 1500, # fastest wand movement followed, in pixels per second
+    'camera_fps': 30, # frame rate the optical flow is sized for
+    'wand_flow_roi': False, # between scans, only process the area around tracked points
+    'wand_max_acceleration': None, # e.g. 20000 pixels/s^2 for fewer flow pyramid levels
+    'wand_min_confidence': 0.3, # points optical flow matches worse than this are dropped
+    'wand_static_after': 3.0, # seconds a point may stay put before it is parked as a reflection, until it moves
+    'idle_mode': True, # only check for motion while nothing moves
+    'idle_fps': 5, # frames checked per second while idle
+    'idle_after': 10, # seconds without motion before idling
+    'vision_pipeline': 'thread', # or 'processes' to spread tracking over the cores, or 'offload'
+    'offload_host': '127.0.0.1', # vision worker for 'offload', see offload.py
+    'offload_port': 9000,
+    'offload_max_in_flight': 2, # frames sent but not yet tracked before new ones are dropped
+    'offload_quality': 80, # JPEG quality of the frames sent
+    'offload_crop': None, # e.g. (80, 0, 560, 480) to only send where wands are cast
+    'wand_recording': None, # directory to record tracked points in, see recorder.py
+    'wand_recording_max_mb': 8, # size of each recording file
+    'wand_recording_files': 8, # recording files kept, oldest deleted first
+
+    # Logging, see logs.py
+    'log_level': 'INFO', # or 'DEBUG' for every point movement
+    'log_limits': {'Tracking error': 1, 'Point moved': 20}, # messages a second, per message
+    'log_sampling': {}, # e.g. {'Point moved': 0.1} to keep one in ten
+    'log_format': '%(levelname)s %(name)s: %(message)s', # add %(asctime)s outside journald
 
     # Spells
     'watch_on_start': False, # start watching for spells on server start
     'wand_timeout': 600, # negative value never times out
+    'gesture_recognizer': 'tokens', # or 'trajectory' to match whole paths
+    'gesture_templates': 'spell_templates.json', # paths for 'trajectory'
+    'lights_flush_interval': 1.0, # seconds between color updates to the store
+    'animation_fps': 100, # light effect frame rate
+    'spell_crossfade': 0.2, # seconds to blend into a newly cast spell
+    'spell_wait_margin': 5, # extra seconds lumos() and friends wait for a spell before giving up
+    'led_gamma': 1.0, # e.g. 2.2 for perceptually even fades
+    'led_brightness': 1.0, # 0.0 - 1.0
 
     # IR Emitters
     'emitters_pin': 17,
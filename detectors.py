@@ -0,0 +1,131 @@
+"""
+Find candidate wand tips in a processed grayscale frame.
+
+Every detector has a `detect(gray)` method returning the points found as a
+float32 array shaped (N, 1, 2), ready to be tracked with
+`cv2.calcOpticalFlowPyrLK`, or None when nothing was found.
+"""
+
+import numpy as np
+import cv2
+
+
+def as_points(xy):
+    """Shape an (N, 2) array of x, y coordinates as tracking points."""
+    if xy is None or len(xy) == 0:
+        return None
+    return np.ascontiguousarray(xy, np.float32).reshape(-1, 1, 2)
+
+
+class HoughDetector:
+    """Circle detection with `cv2.HoughCircles`, the original detector."""
+
+    def __init__(self, dp=3, min_dist=50, param1=240, param2=8, min_radius=4, max_radius=15):
+        self.dp = dp
+        self.min_dist = min_dist
+        self.param1 = param1
+        self.param2 = param2
+        self.min_radius = min_radius
+        self.max_radius = max_radius
+
+    def detect(self, gray):
+        circles = cv2.HoughCircles(gray, cv2.HOUGH_GRADIENT, self.dp, self.min_dist,
+                                   param1=self.param1, param2=self.param2,
+                                   minRadius=self.min_radius, maxRadius=self.max_radius)
+        if circles is None:
+            return None
+        return as_points(circles[0, :, 0:2])
+
+
+class BlobDetector:
+    """
+    Bright blob detection for IR-reflective wand tips.
+
+    Thresholds the frame and keeps the centroids of connected components
+    whose area fits a wand tip, largest first.
+    """
+
+    def __init__(self, threshold=200, min_area=8, max_area=700, max_points=20):
+        self.threshold = threshold
+        self.min_area = min_area
+        self.max_area = max_area
+        self.max_points = max_points
+        self._binary = None
+        self._labels = None
+
+    def detect(self, gray):
+        if self._binary is None or self._binary.shape != gray.shape:
+            self._binary = np.empty_like(gray)
+            self._labels = np.empty(gray.shape, np.int32)
+        cv2.threshold(gray, self.threshold, 255, cv2.THRESH_BINARY, dst=self._binary)
+        count, _, stats, centroids = cv2.connectedComponentsWithStats(
+            self._binary, self._labels, connectivity=8, ltype=cv2.CV_32S)
+        # label 0 is the background
+        areas = stats[1:, cv2.CC_STAT_AREA]
+        keep = np.flatnonzero((areas >= self.min_area) & (areas <= self.max_area))
+        if len(keep) == 0:
+            return None
+        keep = keep[np.argsort(areas[keep])[::-1][:self.max_points]]
+        return as_points(centroids[1:][keep])
+
+
+class ForegroundGate:
+    """
+    Run `detector` only on the parts of the frame that are moving.
+
+    A MOG2 background model masks out static bright spots such as lamps and
+    windows before detection (from mamacker's pi_to_potter).
+    """
+
+    def __init__(self, detector, learning_rate=0.001):
+        self.detector = detector
+        self.learning_rate = learning_rate
+        self.fgbg = cv2.createBackgroundSubtractorMOG2()
+        self._mask = None
+        self._gated = None
+
+    def detect(self, gray):
+        if self._gated is None or self._gated.shape != gray.shape:
+            self._mask = np.empty_like(gray)
+            self._gated = np.empty_like(gray)
+        self.fgbg.apply(gray, self._mask, learningRate=self.learning_rate)
+        self._gated.fill(0)
+        cv2.copyTo(gray, self._mask, self._gated)
+        return self.detector.detect(self._gated)
+
+
+def detect_regions(detector, gray, regions):
+    """
+    Run `detector` on each (x0, y0, x1, y1) region of `gray`.
+
+    Returns the points found in frame coordinates, or None.  A
+    ForegroundGate is bypassed here: its background model only learns from
+    whole frames.
+    """
+    if isinstance(detector, ForegroundGate):
+        detector = detector.detector
+    found = []
+    for x0, y0, x1, y1 in regions:
+        points = detector.detect(gray[y0:y1, x0:x1])
+        if points is not None:
+            found.append(points + np.array((x0, y0), np.float32))
+    if not found:
+        return None
+    return np.concatenate(found)
+
+
+detectors = {
+    'hough': HoughDetector,
+    'blob': BlobDetector,
+}
+
+
+def create_detector(name='hough', foreground_gate=False, **params):
+    """Build the detector called `name`, optionally behind a ForegroundGate."""
+    try:
+        detector = detectors[name](**params)
+    except KeyError:
+        raise ValueError(f'Unknown wand detector "{name}", expected one of {sorted(detectors)}')
+    if foreground_gate:
+        detector = ForegroundGate(detector)
+    return detector
@@ -2,16 +2,45 @@
 Control the IR emitters.
 '''
 
-import RPi.GPIO as GPIO
+import threading
 from config import potter_lamp_config as config
+from state import shared_store
+import hardware
+import events
+import logs
+
+log = logs.get('emitters')
 
 # IR LED emitters control
 emitters_pin = config['emitters_pin']
-GPIO.setmode(GPIO.BCM)
-GPIO.setwarnings(False)
-GPIO.setup(emitters_pin, GPIO.OUT)
+_setup = threading.Lock()
+_ready = False
+
+def emitters_gpio():
+    """GPIO, with the emitters pin set up as an output on first use."""
+    global _ready
+    gpio = hardware.gpio()
+    with _setup:
+        if not _ready:
+            gpio.setup(emitters_pin, gpio.OUT)
+            _ready = True
+    return gpio
 
 def set_emitters(state=False):
-    gpio_state = GPIO.HIGH if state else GPIO.LOW
-    GPIO.output(emitters_pin, gpio_state)
+    gpio = emitters_gpio()
+    gpio_state = gpio.HIGH if state else gpio.LOW
+    gpio.output(emitters_pin, gpio_state)
     return state
+
+def LampState(set=None):
+    """Retrieve or set lamp state."""
+    if set in ['on', 'off']:
+        shared_store().set('potter_lamp', set)
+        lamp_state = set == 'on'
+        set_emitters(lamp_state)
+        events.publish('lamp', state=set)
+        log.info('Lamp state set', on=lamp_state)
+    else:
+        lamp_state = shared_store().get('potter_lamp') == 'on'
+
+    return lamp_state
@@ -0,0 +1,64 @@
+"""
+Push lamp and wand state changes to clients as Server-Sent Events.
+
+Anything can `publish('spell', spell='lumos')`; every open `/events` stream
+gets the event as it happens instead of polling for it.  Each subscriber has
+a bounded backlog, so a stalled client loses its oldest events rather than
+holding up the lamp.
+"""
+
+import json
+import threading
+import time
+from collections import deque
+import metrics
+
+backlog = 64
+
+
+class EventBus:
+    """Fan events out to any number of subscribers."""
+
+    def __init__(self):
+        self._subscribers = []
+        self._cond = threading.Condition()
+
+    def publish(self, kind, **data):
+        """Send event `kind` with JSON-serializable `data` to every subscriber."""
+        event = (kind, data)
+        with self._cond:
+            if not self._subscribers:
+                return
+            for events in self._subscribers:
+                events.append(event)
+            self._cond.notify_all()
+
+    def stream(self, initial=(), snapshot_interval=5.0):
+        """
+        Generate text/event-stream chunks for one client.
+
+        `initial` events are sent first.  Every `snapshot_interval` seconds a
+        'metrics' event with the current counters doubles as a keep-alive.
+        """
+        events = deque(initial, maxlen=backlog)
+        with self._cond:
+            self._subscribers.append(events)
+        try:
+            due = time.monotonic() + snapshot_interval
+            while True:
+                with self._cond:
+                    self._cond.wait_for(lambda: events, max(0, due - time.monotonic()))
+                    pending = list(events)
+                    events.clear()
+                if time.monotonic() >= due:
+                    pending.append(('metrics', metrics.snapshot()))
+                    due = time.monotonic() + snapshot_interval
+                for kind, data in pending:
+                    yield f'event: {kind}\ndata: {json.dumps(data)}\n\n'
+        finally:
+            with self._cond:
+                self._subscribers.remove(events)
+
+
+bus = EventBus()
+publish = bus.publish
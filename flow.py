@@ -0,0 +1,107 @@
+"""
+Lucas-Kanade optical flow for the wand tracker.
+
+Window size and pyramid depth come from the frame size and how fast a wand
+can move, instead of a fixed depth the frame is too small for.  When the
+search starts from a predicted position, only the prediction error has to
+be covered, and `max_acceleration` can size the pyramid for that instead.
+Flow can be restricted to a box around the tracked points, so pyramids and
+gradients are only computed there.
+
+OpenCV's Python bindings cannot pass a pyramid from
+`cv2.buildOpticalFlowPyramid` to `cv2.calcOpticalFlowPyrLK`, so both frames'
+pyramids are still built on every call.  Walking the cached levels from
+Python, one `maxLevel=0` call per level, saved too little to be worth it.
+"""
+
+import math
+import numpy as np
+import cv2
+
+criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03)
+
+
+def flow_params(shape, max_speed=1500, fps=30, max_acceleration=None):
+    """
+    Window size and pyramid levels for frames of `shape`.
+
+    The window scales with the frame, about 15 pixels at 480 lines.  Each
+    level doubles the distance a window can follow, so there are just enough
+    levels for a point moving `max_speed` pixels a second at `fps`, or for
+    the distance a point accelerating at `max_acceleration` strays from a
+    constant-velocity prediction, but never so many that the top level is
+    smaller than two windows.
+    """
+    side = min(shape[:2])
+    window = min(max(int(side / 32) | 1, 9), 31)
+    step = max_speed / fps
+    if max_acceleration is not None:
+        step = min(step, max_acceleration / fps ** 2)
+    levels = max(math.ceil(math.log2(max(step / (window // 2), 1))), 0)
+    top = max(int(math.log2(side / (2 * window))), 0)
+    return window, min(levels, top)
+
+
+class OpticalFlow:
+    """
+    Optical flow between consecutive frames.
+
+    `track()` is called with every frame; the window and levels are set from
+    the first frame's size unless given.  Set `max_acceleration` only when
+    every call passes a `guess`.
+    """
+
+    def __init__(self, max_speed=1500, fps=30, window=None, levels=None, max_acceleration=None):
+        self.max_speed = max_speed
+        self.fps = fps
+        self.max_acceleration = max_acceleration
+        self.window = window
+        self.levels = levels
+        self._fixed = (window, levels)
+        self._shape = None
+        self._gray = None
+
+    def reset(self):
+        """Forget the previous frame."""
+        self._gray = None
+
+    def _configure(self, shape):
+        if self._shape != shape[:2]:
+            self._shape = shape[:2]
+            window, levels = flow_params(shape, self.max_speed, self.fps, self.max_acceleration)
+            fixed_window, fixed_levels = self._fixed
+            self.window = fixed_window or window
+            self.levels = levels if fixed_levels is None else fixed_levels
+            self.reset()
+
+    def margin(self, shape):
+        """Pixels around a point that flow can reach into within one frame."""
+        self._configure(shape)
+        return int(self.max_speed / self.fps) + self.window
+
+    def track(self, gray, points, box=None, guess=None):
+        """
+        Follow `points` (N, 1, 2) from the previous frame into `gray`.
+
+        With `box` (x0, y0, x1, y1) only that part of both frames is used.
+        `guess` holds where the points are expected in `gray`, to start the
+        search from.  Returns `(p1, st, err)` like `cv2.calcOpticalFlowPyrLK`,
+        or None on the first frame or without points.  `gray` must stay
+        unchanged until the next call.
+        """
+        self._configure(gray.shape)
+        previous, self._gray = self._gray, gray
+        if points is None or previous is None:
+            return None
+        params = dict(winSize=(self.window, self.window), maxLevel=self.levels, criteria=criteria)
+        if guess is not None:
+            params['flags'] = cv2.OPTFLOW_USE_INITIAL_FLOW
+        if box is None:
+            return cv2.calcOpticalFlowPyrLK(previous, gray, points, guess, **params)
+        x0, y0, x1, y1 = box
+        offset = np.float32((x0, y0))
+        p1, st, err = cv2.calcOpticalFlowPyrLK(
+            previous[y0:y1, x0:x1], gray[y0:y1, x0:x1], points - offset,
+            None if guess is None else guess - offset, **params)
+        p1 += offset
+        return p1, st, err
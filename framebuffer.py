@@ -0,0 +1,66 @@
+"""
+NumPy frame buffer for the NeoPixel strip.
+
+A frame is a (pixels, 3) uint8 array of RGB values.  Fades and cross-fades
+use a precomputed scaling table instead of per-pixel float math, and the
+output table folds brightness and gamma into a single lookup before the
+frame is written to the strip in one bulk update.
+"""
+
+import numpy as np
+
+# scale_lut[level, value] == value * level / 255, for fades and blends
+scale_lut = (np.arange(256)[:, None] * np.arange(256)[None, :] // 255).astype(np.uint8)
+
+
+def output_lut(gamma=1.0, brightness=1.0):
+    """Lookup table applying `gamma` and then `brightness` to a channel."""
+    values = np.arange(256) / 255
+    return np.round(255 * brightness * values ** gamma).clip(0, 255).astype(np.uint8)
+
+
+def gradient(colors, count):
+    """A (count, 3) frame blending evenly through `colors` along the strip."""
+    colors = np.asarray(colors, np.float64).reshape(-1, 3)
+    stops = np.linspace(0, count - 1, len(colors))
+    positions = np.arange(count)
+    frame = np.empty((count, 3), np.uint8)
+    for channel in range(3):
+        frame[:, channel] = np.interp(positions, stops, colors[:, channel])
+    return frame
+
+
+class FrameBuffer:
+    """The frame being shown on a strip of `count` pixels."""
+
+    def __init__(self, count=60, gamma=1.0, brightness=1.0):
+        self.count = count
+        self.frame = np.zeros((count, 3), np.uint8)
+        self.lut = output_lut(gamma, brightness)
+        self._start = np.empty_like(self.frame)
+        self._end = np.empty_like(self.frame)
+        self._output = np.empty_like(self.frame)
+
+    def as_frame(self, color, out):
+        """Write a color, or a whole frame, into `out`."""
+        if isinstance(color, np.ndarray):
+            np.copyto(out, color)
+        else:
+            out[:] = color
+        return out
+
+    def mix(self, start, end, level, out):
+        """Blend `end` over `start` by `level` (0-255) into `out`."""
+        np.take(scale_lut[255 - level], start, out=self._start)
+        np.take(scale_lut[level], end, out=self._end)
+        return np.add(self._start, self._end, out=out)
+
+    def color(self):
+        """The average color of the frame."""
+        return tuple(int(channel) for channel in self.frame.mean(axis=0))
+
+    def push(self, pixels):
+        """Write the frame to `pixels` (auto_write off) in one update."""
+        np.take(self.lut, self.frame, out=self._output)
+        pixels[:] = self._output.tolist()
+        pixels.show()
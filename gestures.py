@@ -0,0 +1,264 @@
+"""
+Match wand motions against the known spells.
+
+Spells are sequences of motion tokens such as "!right!up".  `SpellMatcher`
+compiles them into an Aho-Corasick automaton so each new token costs a single
+table lookup, no matter how long a point has been moving.
+
+`TrajectoryRecognizer` instead compares the recent path of each point with
+spell templates, in the style of the $1 recognizer, so recognition does not
+depend on how fast the wand moves or the camera's frame rate.
+"""
+
+import json
+from collections import deque
+import numpy as np
+
+# Spells
+spells_list = {
+    "!right!up": "lumos",
+    "!right!down": "nox",
+    "!left!up": "incendio",
+    "!left!down": "colovaria"
+}
+
+motions_list = ("!right", "!left", "!up", "!down",
+                "!ADR", "!ADL", "!AUR", "!AUL")
+
+# number of recent tokens kept per point for debug output
+history_length = 16
+
+
+def split_motions(motions):
+    """Split a casting string like "!right!up" into its motion tokens."""
+    return tuple(f'!{token}' for token in motions.split('!') if token)
+
+
+def motion_token(moveX, moveY, movement_threshold=10):
+    """The motion token for a frame-to-frame move, or None if too small."""
+    motion = None
+    # if moveX > movement_threshold and abs(moveY) < static_threshold:
+    if moveX > movement_threshold and abs(moveY) < abs(moveX / 2):
+        motion = "!right"
+    # elif moveX < (0 - movement_threshold) and abs(moveY) < static_threshold:
+    elif moveX < (0 - movement_threshold) and abs(moveY) < abs(moveX / 2):
+        motion = "!left"
+    # elif moveY > movement_threshold and abs(moveX) < static_threshold:
+    elif moveY > movement_threshold and abs(moveX) < abs(moveY / 2):
+        motion = "!up"
+    # elif moveY < (0 - movement_threshold) and abs(moveX) < static_threshold:
+    elif moveY < (0 - movement_threshold) and abs(moveX) < abs(moveY / 2):
+        motion = "!down"
+    # Check diagonals
+    # elif 0.8 < abs(moveX/moveY) < 1.2 and abs(moveX) > movement_threshold:
+    #     if moveX < 0 and moveY < 0:
+    #         motion = "!ADL" # Down-Left
+    #     if moveX > 0 and moveY < 0:
+    #         motion = "!ADR" # Down-Right
+    #     if moveX < 0 and moveY > 0:
+    #         motion = "!AUL" # Up-Left
+    #     if moveX > 0 and moveY > 0:
+    #         motion = "!AUR" # Up-Right
+    return motion
+
+
+class GestureState:
+    """Matching state for one tracked point."""
+
+    __slots__ = ('state', 'last', 'history', 'anchor')
+
+    def __init__(self):
+        self.state = 0
+        self.last = None
+        self.history = deque(maxlen=history_length)
+        # where the point was when it last made a motion
+        self.anchor = None
+
+    def motion(self, newX, newY, oldX, oldY, movement_threshold=10):
+        """
+        The motion token for the point's move from (oldX, oldY) to (newX,
+        newY), or None.  Moves add up until the point is `movement_threshold`
+        away from where the last motion ended, so a slow stroke seen at a
+        high frame rate still makes motions.
+        """
+        if self.anchor is None:
+            self.anchor = (oldX, oldY)
+        moveX = newX - self.anchor[0]
+        moveY = newY - self.anchor[1]
+        if abs(moveX) <= movement_threshold and abs(moveY) <= movement_threshold:
+            return None
+        self.anchor = (newX, newY)
+        return motion_token(moveX, moveY, movement_threshold)
+
+    def __str__(self):
+        return ''.join(self.history)
+
+
+class SpellMatcher:
+    """
+    Incremental matcher for `spells`, a dict of casting strings to spells.
+
+    Repeated tokens are collapsed, so a motion held over many frames counts
+    once.  A point's state is reset after it casts a spell.
+    """
+
+    def __init__(self, spells=spells_list):
+        # goto table of the trie; state 0 is the root
+        goto = [{}]
+        output = [None]
+        for motions, spell in spells.items():
+            state = 0
+            for token in split_motions(motions):
+                if token not in goto[state]:
+                    goto.append({})
+                    output.append(None)
+                    goto[state][token] = len(goto) - 1
+                state = goto[state][token]
+            # the first spell listed wins, matching the old substring scan
+            if output[state] is None:
+                output[state] = spell
+
+        # breadth-first pass adding failure transitions to make a full DFA
+        alphabet = {token for edges in goto for token in edges}
+        self.transitions = [dict() for _ in goto]
+        fail = [0] * len(goto)
+        queue = deque()
+        for token in alphabet:
+            target = goto[0].get(token, 0)
+            self.transitions[0][token] = target
+            if target:
+                queue.append(target)
+        while queue:
+            state = queue.popleft()
+            if output[state] is None:
+                output[state] = output[fail[state]]
+            for token in alphabet:
+                target = goto[state].get(token)
+                if target is None:
+                    self.transitions[state][token] = self.transitions[fail[state]][token]
+                else:
+                    fail[target] = self.transitions[fail[state]][token]
+                    self.transitions[state][token] = target
+                    queue.append(target)
+        self.output = output
+
+    def feed(self, gesture, token):
+        """
+        Advance `gesture` by one motion token.
+
+        Returns the spell completed by this token, or None.
+        """
+        if token == gesture.last:
+            return None
+        gesture.last = token
+        gesture.history.append(token)
+        # tokens that appear in no spell send us back to the root
+        gesture.state = self.transitions[gesture.state].get(token, 0)
+        spell = self.output[gesture.state]
+        if spell is not None:
+            gesture.state = 0
+        return spell
+
+
+def load_templates(path):
+    """Load spell templates: a JSON object of spell names to [x, y] paths."""
+    with open(path) as templates:
+        return json.load(templates)
+
+
+def resample(path, samples):
+    """Resample an (N, 2) path to `samples` points evenly spaced along it."""
+    steps = np.hypot(*np.diff(path, axis=0).T)
+    distance = np.concatenate(([0.0], np.cumsum(steps)))
+    targets = np.linspace(0.0, distance[-1], samples)
+    return np.stack((np.interp(targets, distance, path[:, 0]),
+                     np.interp(targets, distance, path[:, 1])), axis=1)
+
+
+def normalize(path):
+    """Center a path on its centroid and scale its larger side to 1."""
+    path = path - path.mean(axis=0)
+    size = np.ptp(path, axis=0).max()
+    return path / size if size > 0 else path
+
+
+class TrajectoryRecognizer:
+    """
+    Recognize spells from the trajectories of tracked points.
+
+    Each point keeps the positions it visited over the last `horizon`
+    seconds.  Every update the trailing `windows` (fractions of the path
+    length) of each trajectory are resampled, normalized and scored against
+    all templates at once; the mean point distance of the best template must
+    be under `threshold`, and the path at least `min_size` pixels across.
+    """
+
+    def __init__(self, templates, samples=32, horizon=2.0, threshold=0.12,
+                 min_size=60, windows=(1.0, 0.75, 0.5), max_points=128):
+        self.names = list(templates)
+        self.samples = samples
+        self.templates = np.stack([normalize(resample(np.asarray(path, np.float64), samples))
+                                   for path in templates.values()])
+        self.horizon = horizon
+        self.threshold = threshold
+        self.min_size = min_size
+        self.windows = windows
+        self.max_points = max_points
+        self.tracks = {}
+
+    def reset(self, key=None):
+        """Forget the trajectory of `key`, or of every point."""
+        if key is None:
+            self.tracks.clear()
+        else:
+            self.tracks.pop(key, None)
+
+    def _candidates(self, track):
+        """Normalized trailing windows of one trajectory worth scoring."""
+        path = np.asarray(track, np.float64)[:, 1:]
+        steps = np.hypot(*np.diff(path, axis=0).T)
+        distance = np.concatenate(([0.0], np.cumsum(steps)))
+        for window in self.windows:
+            segment = path[np.searchsorted(distance, distance[-1] * (1 - window)):]
+            if len(segment) >= 3 and np.ptp(segment, axis=0).max() >= self.min_size:
+                yield normalize(resample(segment, self.samples))
+
+    def update(self, points, now):
+        """
+        Add `(key, x, y)` positions seen at time `now`.
+
+        Returns `(key, spell)` for every point that completed a spell; those
+        points start a fresh trajectory.
+        """
+        for key, x, y in points:
+            track = self.tracks.get(key)
+            if track is None:
+                track = self.tracks[key] = deque(maxlen=self.max_points)
+            track.append((now, x, y))
+        for key, track in list(self.tracks.items()):
+            while track and track[0][0] < now - self.horizon:
+                track.popleft()
+            if not track:
+                del self.tracks[key]
+
+        candidates = []
+        owners = []
+        for key, track in self.tracks.items():
+            for candidate in self._candidates(track):
+                candidates.append(candidate)
+                owners.append(key)
+        if not candidates:
+            return []
+
+        # (candidates, templates): mean distance between matching points
+        scores = np.linalg.norm(np.stack(candidates)[:, None] - self.templates[None], axis=3).mean(axis=2)
+        best = scores.argmin(axis=1)
+        matched = {}
+        for index in np.flatnonzero(scores[np.arange(len(best)), best] < self.threshold):
+            key = owners[index]
+            score = scores[index, best[index]]
+            if key not in matched or score < matched[key][1]:
+                matched[key] = (self.names[best[index]], score)
+        for key in matched:
+            self.reset(key)
+        return [(key, spell) for key, (spell, _) in matched.items()]
@@ -0,0 +1,126 @@
+"""
+The lamp's hardware, set up the first time it is used.
+
+Importing the lamp modules touches no pin, LED or camera.  `pixels()` and
+`gpio()` pick a device on first use.  It is the real one, or an in-memory
+stand-in when config['hardware'] is 'stub', or when it is 'auto' and the
+Raspberry Pi libraries are missing.  The camera and the state store are
+always the configured ones; with `camera_source` 'synthetic' and
+`state_backend` 'memory' as well, the server, the benchmarks and `reset.py`
+run on any machine.
+"""
+
+import threading
+import time
+from config import potter_lamp_config as config
+import logs
+
+led_count = 60
+
+_lock = threading.Lock()
+_pixels = None
+_gpio = None
+_stubbed = None
+
+
+class StubPixels:
+    """A NeoPixel strip that remembers its pixels and when it was shown."""
+
+    def __init__(self, n=led_count, auto_write=False):
+        self.n = n
+        self.auto_write = auto_write
+        self.pixels = [(0, 0, 0)] * n
+        self.frames = []
+
+    def fill(self, color):
+        self.pixels = [tuple(color)] * self.n
+        if self.auto_write:
+            self.show()
+
+    def __setitem__(self, index, colors):
+        self.pixels[index] = colors
+        if self.auto_write:
+            self.show()
+
+    def show(self):
+        self.frames.append(time.perf_counter())
+
+
+class StubGPIO:
+    """The parts of RPi.GPIO the lamp uses, keeping pin levels in `pins`."""
+
+    BCM = 11
+    OUT = 0
+    HIGH = 1
+    LOW = 0
+
+    def __init__(self):
+        self.pins = {}
+
+    def setmode(self, mode):
+        pass
+
+    def setwarnings(self, warnings):
+        pass
+
+    def setup(self, pin, mode):
+        self.pins.setdefault(pin, self.LOW)
+
+    def output(self, pin, state):
+        self.pins[pin] = state
+
+
+def stubbed():
+    """True when the lamp runs on stand-ins instead of its hardware."""
+    global _stubbed
+    if _stubbed is None:
+        mode = config.get('hardware', 'auto')
+        if mode == 'auto':
+            try:
+                import board, neopixel, RPi.GPIO
+                _stubbed = False
+            except (ImportError, NotImplementedError, RuntimeError):
+                logs.get('hardware').warning('Lamp hardware not found, using stand-ins')
+                _stubbed = True
+        else:
+            _stubbed = mode == 'stub'
+    return _stubbed
+
+
+def pixels():
+    """The LED strip, with auto_write off: call show() after each frame."""
+    global _pixels
+    with _lock:
+        if _pixels is None:
+            if stubbed():
+                _pixels = StubPixels()
+            else:
+                import board
+                import neopixel
+                _pixels = neopixel.NeoPixel(board.D18, led_count, auto_write=False)
+        return _pixels
+
+
+def gpio():
+    """The GPIO module, in BCM pin numbering."""
+    global _gpio
+    with _lock:
+        if _gpio is None:
+            if stubbed():
+                _gpio = StubGPIO()
+            else:
+                import RPi.GPIO as GPIO
+                _gpio = GPIO
+            _gpio.setmode(_gpio.BCM)
+            _gpio.setwarnings(False)
+        return _gpio
+
+
+def camera_source():
+    """config['camera_source'], whether or not the lamp hardware is stubbed."""
+    return config.get('camera_source', 0)
+
+
+def state_backend():
+    """config['state_backend'], whether or not the lamp hardware is stubbed."""
+    return config.get('state_backend', 'redis')
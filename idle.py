@@ -0,0 +1,108 @@
+"""
+Decide when the room is quiet enough to stop tracking.
+
+`MotionGate` looks at a small, downscaled copy of each frame and compares it
+with the previous one.  While nothing moves the tracker only feeds it a few
+frames a second; a moving bright spot, or motion that lasts a few frames,
+wakes the full pipeline again.
+"""
+
+import numpy as np
+import cv2
+
+
+class MotionGate:
+    """
+    Frame-difference gate deciding whether full tracking should run.
+
+    Frames are sampled every `1 / scale` pixels (nearest neighbour, so a
+    small IR tip keeps its brightness) and differenced with the previous
+    sample.  A frame moves when more than `min_pixels` samples changed by
+    `threshold`.  The gate wakes as soon as a changed sample is at least
+    `bright`, or after `wake_frames` moving frames in a row, and sleeps again
+    once nothing has moved for `idle_after` seconds.
+    """
+
+    def __init__(self, scale=0.25, threshold=25, min_pixels=4, bright=200,
+                 wake_frames=3, idle_after=10.0):
+        self.scale = scale
+        self.threshold = threshold
+        self.min_pixels = min_pixels
+        self.bright = bright
+        self.wake_frames = wake_frames
+        self.idle_after = idle_after
+        self.awake = False
+        self.streak = 0
+        self.last_motion = None
+        self._small = None
+        self._gray = None
+        self._previous = None
+        self._diff = None
+        self._changed = None
+
+    def reset(self, awake=False):
+        """Start over, forgetting the previous frame."""
+        self.awake = awake
+        self.streak = 0
+        self.last_motion = None
+        self._previous = None
+        self._changed = None
+
+    def _sample(self, frame):
+        """The downscaled grayscale frame, in a reused buffer."""
+        height, width = frame.shape[:2]
+        size = (max(int(width * self.scale), 1), max(int(height * self.scale), 1))
+        if self._gray is None or self._gray.shape != (size[1], size[0]):
+            self._small = np.empty((size[1], size[0]) + frame.shape[2:], frame.dtype)
+            self._gray = np.empty((size[1], size[0]), np.uint8)
+            self._previous = None
+        cv2.resize(frame, size, dst=self._small, interpolation=cv2.INTER_NEAREST)
+        if self._small.ndim == 3:
+            cv2.cvtColor(self._small, cv2.COLOR_BGR2GRAY, dst=self._gray)
+        else:
+            np.copyto(self._gray, self._small)
+        return self._gray
+
+    def update(self, frame, now):
+        """Feed the frame seen at `now`; returns whether tracking should run."""
+        gray = self._sample(frame)
+        if self.last_motion is None:
+            # the quiet period starts with the first frame
+            self.last_motion = now
+        moving = bright = False
+        if self._previous is None:
+            self._previous = gray.copy()
+            self._diff = np.empty_like(gray)
+        else:
+            cv2.absdiff(gray, self._previous, dst=self._diff)
+            changed = self._changed = self._diff > self.threshold
+            moving = np.count_nonzero(changed) > self.min_pixels
+            bright = moving and gray[changed].max() >= self.bright
+            np.copyto(self._previous, gray)
+
+        if moving:
+            self.streak += 1
+            self.last_motion = now
+        else:
+            self.streak = 0
+        if not self.awake:
+            self.awake = bright or self.streak >= self.wake_frames
+        elif now - self.last_motion > self.idle_after:
+            self.awake = False
+        return self.awake
+
+    def moved_outside(self, box):
+        """
+        True if more than `min_pixels` samples of the last frame changed
+        outside `box` (x0, y0, x1, y1, in frame pixels).
+        """
+        if self._changed is None:
+            return False
+        total = np.count_nonzero(self._changed)
+        if total <= self.min_pixels:
+            return False
+        if box is None:
+            return True
+        x0, y0, x1, y1 = (int(value * self.scale) for value in box)
+        inside = np.count_nonzero(self._changed[y0:y1 + 1, x0:x1 + 1])
+        return total - inside > self.min_pixels
@@ -0,0 +1,165 @@
+"""
+Logging that stays off the tracking loop.
+
+`log = logs.get('wand')` gives a logger taking structured fields as keyword
+arguments, written out as key=value pairs:
+
+    log.info('Spell cast', spell=spell, point=key)
+
+Records go on a queue and are formatted and written by a background thread,
+so the loop never waits on stdout or journald.  A call below
+config['log_level'] returns before a record is made.  Noisy messages can be
+rate limited with config['log_limits'] ({message: per second}) or sampled
+with config['log_sampling'] ({message: fraction kept}); the next one let
+through says how many were left out.
+"""
+
+import atexit
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import threading
+import time
+from config import potter_lamp_config as config
+
+DEBUG = logging.DEBUG
+INFO = logging.INFO
+
+_lock = threading.Lock()
+_listener = None
+_limit = None
+
+
+class FieldFormatter(logging.Formatter):
+    """Format a record with its fields appended as key=value pairs."""
+
+    def formatMessage(self, record):
+        line = super().formatMessage(record)
+        fields = getattr(record, 'fields', None)
+        if fields:
+            line += ' ' + ' '.join(f'{key}={_field(value)}' for key, value in fields.items())
+        return line
+
+
+def _field(value):
+    if isinstance(value, float):
+        return f'{value:.2f}'
+    text = str(value)
+    if not text or ' ' in text or '"' in text:
+        return '"' + text.replace('"', '\\"') + '"'
+    return text
+
+
+class RateLimit:
+    """
+    Let through at most `limits[message]` of a message a second, with bursts
+    of up to a second's worth, and a random `sampling[message]` fraction of
+    it.
+    """
+
+    def __init__(self, limits=None, sampling=None):
+        self.limits = limits or {}
+        self.sampling = sampling or {}
+        # message -> [tokens, last refill, left out since the last one kept]
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def allow(self, message):
+        """None to leave `message` out, else how many were left out before it."""
+        rate = self.limits.get(message)
+        fraction = self.sampling.get(message)
+        if rate is None and fraction is None:
+            return 0
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(message)
+            if bucket is None:
+                bucket = self._buckets[message] = [rate or 0, now, 0]
+            keep = fraction is None or random.random() < fraction
+            if rate is not None:
+                tokens = min(rate, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+                keep = keep and tokens >= 1
+                bucket[0] = tokens - 1 if keep else tokens
+            if not keep:
+                bucket[2] += 1
+                return None
+            left_out, bucket[2] = bucket[2], 0
+            return left_out
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """Queue records as they are; the listener thread formats them."""
+
+    def prepare(self, record):
+        return record
+
+
+class Log:
+    """A logger whose calls take structured fields as keyword arguments."""
+
+    def __init__(self, logger, limit):
+        self.logger = logger
+        self.limit = limit
+
+    def enabled(self, level):
+        """True if messages at `level` are written; check before costly fields."""
+        return self.logger.isEnabledFor(level)
+
+    def _log(self, level, message, fields, exc_info=None):
+        left_out = self.limit.allow(message)
+        if left_out is None:
+            return
+        if left_out:
+            fields['suppressed'] = left_out
+        # made directly, without looking up the caller: the format never shows it
+        self.logger.handle(self.logger.makeRecord(
+            self.logger.name, level, '', 0, message, (), exc_info, extra={'fields': fields}))
+
+    def debug(self, message, **fields):
+        if self.logger.isEnabledFor(DEBUG):
+            self._log(DEBUG, message, fields)
+
+    def info(self, message, **fields):
+        if self.logger.isEnabledFor(INFO):
+            self._log(INFO, message, fields)
+
+    def warning(self, message, **fields):
+        if self.logger.isEnabledFor(logging.WARNING):
+            self._log(logging.WARNING, message, fields)
+
+    def error(self, message, **fields):
+        if self.logger.isEnabledFor(logging.ERROR):
+            self._log(logging.ERROR, message, fields)
+
+    def exception(self, message, **fields):
+        """Log an error with the traceback of the exception being handled."""
+        if self.logger.isEnabledFor(logging.ERROR):
+            self._log(logging.ERROR, message, fields, sys.exc_info())
+
+
+def _start():
+    """Send the lamp's loggers through a queue to a writer thread."""
+    global _listener, _limit
+    root = logging.getLogger('potterlamp')
+    root.setLevel(str(config.get('log_level', 'INFO')).upper())
+    root.propagate = False
+    records = queue.SimpleQueue()
+    root.addHandler(QueueHandler(records))
+    _limit = RateLimit(config.get('log_limits'), config.get('log_sampling'))
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(FieldFormatter(config.get('log_format', '%(levelname)s %(name)s: %(message)s')))
+    _listener = logging.handlers.QueueListener(records, output)
+    _listener.start()
+    # write out whatever is still queued on exit
+    atexit.register(_listener.stop)
+
+
+def get(name):
+    """The logger for module `name`."""
+    with _lock:
+        if _listener is None:
+            _start()
+    return Log(logging.getLogger(f'potterlamp.{name}'), _limit)
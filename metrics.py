@@ -0,0 +1,125 @@
+"""
+Lightweight timing histograms and counters, exported for Prometheus.
+
+Time a stage with `with stage('capture'):` and count events with
+`counter('frames').inc()`.  Metrics are cheap enough for the tracking loop;
+when config['metrics'] is off every metric is a shared no-op object.
+"""
+
+from bisect import bisect_left
+from time import perf_counter
+from config import potter_lamp_config as config
+
+enabled = config.get('metrics', True)
+prefix = 'potterlamp'
+
+# upper bounds of the latency buckets, in seconds
+buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+class Histogram:
+    """
+    Latency histogram for one stage.
+
+    Use as a context manager to time a block.  Each stage should be timed
+    from one thread at a time.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._start = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(buckets, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def __enter__(self):
+        self._start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.observe(perf_counter() - self._start)
+
+
+class Counter:
+    """A monotonically increasing count."""
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class NullMetric:
+    """Stands in for every metric while metrics are disabled."""
+
+    def observe(self, seconds):
+        pass
+
+    def inc(self, amount=1):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+null_metric = NullMetric()
+stages = {}
+counters = {}
+
+
+def stage(name):
+    """The latency histogram for stage `name`."""
+    if not enabled:
+        return null_metric
+    if name not in stages:
+        stages[name] = Histogram(name)
+    return stages[name]
+
+
+def counter(name, help=''):
+    """The counter `name`, exported as `<prefix>_<name>_total`."""
+    if not enabled:
+        return null_metric
+    if name not in counters:
+        counters[name] = Counter(name, help)
+    return counters[name]
+
+
+def snapshot():
+    """Counter values and the mean of each stage, in seconds, as a dict."""
+    return {
+        'counters': {name: count.value for name, count in counters.items()},
+        'stages': {name: histogram.sum / histogram.count
+                   for name, histogram in stages.items() if histogram.count},
+    }
+
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    lines = [
+        f'# HELP {prefix}_stage_seconds Time spent in each processing stage.',
+        f'# TYPE {prefix}_stage_seconds histogram',
+    ]
+    for name, histogram in sorted(stages.items()):
+        cumulative = 0
+        for bound, count in zip(buckets + ('+Inf',), histogram.counts):
+            cumulative += count
+            lines.append(f'{prefix}_stage_seconds_bucket{{stage="{name}",le="{bound}"}} {cumulative}')
+        lines.append(f'{prefix}_stage_seconds_sum{{stage="{name}"}} {histogram.sum}')
+        lines.append(f'{prefix}_stage_seconds_count{{stage="{name}"}} {histogram.count}')
+    for name, count in sorted(counters.items()):
+        lines.append(f'# HELP {prefix}_{name}_total {count.help}')
+        lines.append(f'# TYPE {prefix}_{name}_total counter')
+        lines.append(f'{prefix}_{name}_total {count.value}')
+    return '\n'.join(lines) + '\n'
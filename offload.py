@@ -0,0 +1,372 @@
+"""
+Wand tracking on another machine.
+
+The lamp sends grayscale camera frames, JPEG compressed and optionally
+cropped, over TCP to a vision worker, which runs the same preprocessing,
+detection, optical flow and gesture recognition as TrackWand and sends back
+the spells it sees.  A worker keeps separate tracks for every lamp connected
+to it.  Run one with:
+
+    python3 offload.py --port 9000
+
+and set config['vision_pipeline'] to 'offload' and config['offload_host'] on
+the lamp.
+
+Every message is a one byte kind and a four byte length, then the payload:
+
+    H  lamp -> worker  the lamp's name
+    F  lamp -> worker  frame number, send time, JPEG
+    A  worker -> lamp  frame number, send time, seconds spent, dropped flag
+    S  worker -> lamp  send time, track ID, spell name
+
+Neither end queues frames.  The lamp drops a frame when `max_in_flight`
+frames are not yet acknowledged, and the worker only keeps the latest frame
+a lamp sent, acknowledging any it replaces as dropped.  Acknowledgements
+carry the send time back, for the round trip.
+"""
+
+import argparse
+import math
+import socket
+import socketserver
+import struct
+import threading
+import time
+from collections import defaultdict, deque
+import numpy as np
+import cv2
+import metrics
+import logs
+
+header = struct.Struct('!cI')
+frame_header = struct.Struct('!Id')
+ack_format = struct.Struct('!IdfB')
+spell_header = struct.Struct('!dI')
+# far more than one JPEG frame; anything longer is a corrupt stream
+max_message = 8 << 20
+
+log = logs.get('offload')
+round_trip_time = metrics.stage('offload_round_trip')
+frames_sent = metrics.counter('offload_frames_sent', 'Frames sent to the vision worker.')
+frames_dropped = metrics.counter('offload_frames_dropped',
+                                 'Frames dropped because the vision worker was behind.')
+
+
+def receive_exactly(sock, size):
+    """`size` bytes from `sock`, or None once it is closed."""
+    data = bytearray(size)
+    view = memoryview(data)
+    while view:
+        count = sock.recv_into(view)
+        if not count:
+            return None
+        view = view[count:]
+    return data
+
+
+def receive_message(sock):
+    """
+    The next (kind, payload) from `sock`, or None once it is closed or sent
+    a message longer than `max_message`.
+    """
+    head = receive_exactly(sock, header.size)
+    if head is None:
+        return None
+    kind, size = header.unpack(head)
+    if size > max_message:
+        log.warning('Message too long, hanging up', kind=kind.decode('ascii', 'replace'), size=size)
+        return None
+    payload = receive_exactly(sock, size)
+    if payload is None:
+        return None
+    return kind, payload
+
+
+def send_message(sock, kind, *parts):
+    """Send the concatenation of `parts` as one message of `kind`."""
+    size = sum(memoryview(part).nbytes for part in parts)
+    sock.sendall(header.pack(kind, size) + parts[0])
+    for part in parts[1:]:
+        sock.sendall(part)
+
+
+class OffloadClient:
+    """
+    The lamp's connection to a vision worker.
+
+    `send()` frames as they are captured; `on_spell(spell, track)` is called
+    from a receiving thread for every spell the worker recognizes.  `crop`
+    (x0, y0, x1, y1) sends only that part of each frame.
+    """
+
+    def __init__(self, host, port, name=None, on_spell=None, max_in_flight=2,
+                 quality=80, crop=None):
+        self.address = (host, port)
+        self.name = name or socket.gethostname()
+        self.on_spell = on_spell
+        self.max_in_flight = max_in_flight
+        self.crop = crop
+        self.encode_params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+        self.sent = 0
+        self.dropped = 0
+        # frames the worker replaced with newer ones before tracking them
+        self.worker_dropped = 0
+        self.in_flight = 0
+        # (round trip, seconds on the worker) of recent frames
+        self.round_trips = deque(maxlen=1000)
+        self._sequence = 0
+        self._lock = threading.Lock()
+        self._sock = None
+        self._receiver = None
+
+    def connect(self, timeout=5.0):
+        """Connect to the worker; raises OSError if it cannot be reached."""
+        self._sock = socket.create_connection(self.address, timeout=timeout)
+        self._sock.settimeout(None)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        send_message(self._sock, b'H', self.name.encode())
+        self._receiver = threading.Thread(target=self._receive, name='offload-receive', daemon=True)
+        self._receiver.start()
+        return self
+
+    @property
+    def connected(self):
+        return self._receiver is not None and self._receiver.is_alive()
+
+    def send(self, frame, stamp=None):
+        """
+        Send a BGR or grayscale frame unless too many are in flight.
+
+        Returns False if the frame was dropped.  Raises OSError if the
+        connection was lost.
+        """
+        with self._lock:
+            if self.in_flight >= self.max_in_flight:
+                self.dropped += 1
+                frames_dropped.inc()
+                return False
+            self.in_flight += 1
+            sequence = self._sequence
+            self._sequence += 1
+        if self.crop is not None:
+            x0, y0, x1, y1 = self.crop
+            frame = frame[y0:y1, x0:x1]
+        gray = frame if frame.ndim == 2 else cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        ok, encoded = cv2.imencode('.jpg', gray, self.encode_params)
+        stamp = time.monotonic() if stamp is None else stamp
+        send_message(self._sock, b'F', frame_header.pack(sequence, stamp), encoded.data)
+        self.sent += 1
+        frames_sent.inc()
+        return True
+
+    def _receive(self):
+        try:
+            while True:
+                message = receive_message(self._sock)
+                if message is None:
+                    break
+                kind, payload = message
+                if kind == b'A':
+                    _, stamp, seconds, dropped = ack_format.unpack(payload)
+                    round_trip = time.monotonic() - stamp
+                    with self._lock:
+                        self.in_flight -= 1
+                    if dropped:
+                        self.worker_dropped += 1
+                    else:
+                        round_trip_time.observe(round_trip)
+                        self.round_trips.append((round_trip, seconds))
+                elif kind == b'S':
+                    _, key = spell_header.unpack_from(payload)
+                    spell = bytes(payload[spell_header.size:]).decode()
+                    if self.on_spell is not None:
+                        self.on_spell(spell, key)
+        except OSError:
+            pass
+
+    def close(self):
+        if self._sock is not None:
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._sock.close()
+        if self._receiver is not None:
+            self._receiver.join(1.0)
+
+
+class LampTracker:
+    """
+    Wand tracking for the frames of one lamp, as configured by `settings`
+    (see wand.PipelineSettings).  `process()` returns the spells cast.
+    """
+
+    def __init__(self, settings):
+        from preprocess import ImagePipeline
+        from detectors import create_detector
+        from tracks import TrackManager
+        from flow import OpticalFlow
+        from gestures import SpellMatcher, GestureState
+        from gestures import TrajectoryRecognizer, load_templates
+        self.settings = settings
+        self.image_pipeline = ImagePipeline(settings['stages'], dilation=settings['dilation'])
+        self.detector = create_detector(settings['detector'], settings['detector_gate'],
+                                        **settings['detector_params'])
+        self.tracks = TrackManager(**settings['tracks'])
+        self.optical_flow = OpticalFlow(**settings['flow'])
+        self.matcher = SpellMatcher()
+        self.gestures = defaultdict(GestureState)
+        self.trajectories = None
+        if settings['templates']:
+            self.trajectories = TrajectoryRecognizer(load_templates(settings['templates']))
+        self.last_scan = -math.inf
+
+    def process(self, frame, now):
+        """Track the points in `frame`, seen at `now`; returns [(spell, track)]."""
+        from detectors import detect_regions
+        settings = self.settings
+        tracks = self.tracks
+        gray = self.image_pipeline.process(frame)
+        cast = []
+
+        moved = []
+        ids, p0 = tracks.points()
+        guess = tracks.predictions(ids, now) if p0 is not None else None
+        flow = self.optical_flow.track(gray, p0, guess=guess)
+        if flow is not None:
+            p1, st, err = flow
+            moved = tracks.advance(ids, p1, st, now, err)
+        limit = settings['max_gesture_tracks']
+        if self.trajectories is None:
+            for key, newX, newY, oldX, oldY in moved[:limit]:
+                gesture = self.gestures[key]
+                token = gesture.motion(newX, newY, oldX, oldY, settings['movement_threshold'])
+                spell = self.matcher.feed(gesture, token) if token else None
+                if spell is not None:
+                    cast.append((spell, key))
+        elif moved:
+            cast.extend((spell, key) for key, spell in self.trajectories.update(
+                ((key, x, y) for key, x, y, _, _ in moved[:limit]), now))
+
+        # whole-frame searches as in the process pipeline
+        following = tracks.live(now - settings['scan_interval'])
+        interval = settings['confirm_interval'] if following else settings['scan_interval']
+        if now - self.last_scan >= interval:
+            tracks.associate(self.detector.detect(gray), now, confirm=True)
+            self.last_scan = now
+        else:
+            regions = tracks.lost_regions(gray.shape)
+            if regions:
+                tracks.associate(detect_regions(self.detector, gray, regions), now)
+        for key in tracks.retire(now):
+            self.gestures.pop(key, None)
+            if self.trajectories is not None:
+                self.trajectories.reset(key)
+        return cast
+
+
+class LampHandler(socketserver.BaseRequestHandler):
+    """
+    One lamp's connection: this thread reads frames and keeps the latest,
+    a second one decodes and tracks them.
+    """
+
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.send_lock = threading.Lock()
+        self.ready = threading.Condition()
+        self.pending = None
+        self.closed = False
+        self.processed = 0
+        self.dropped = 0
+
+    def reply(self, kind, *parts):
+        with self.send_lock:
+            send_message(self.request, kind, *parts)
+
+    def handle(self):
+        message = receive_message(self.request)
+        if message is None or message[0] != b'H':
+            return
+        name = self.name = bytes(message[1]).decode()
+        log.info('Lamp connected', lamp=name, address=self.client_address[0])
+        worker = threading.Thread(target=self.track, name=f'offload-{name}', daemon=True)
+        worker.start()
+        try:
+            while True:
+                message = receive_message(self.request)
+                if message is None:
+                    break
+                kind, payload = message
+                if kind != b'F':
+                    continue
+                with self.ready:
+                    replaced, self.pending = self.pending, payload
+                    self.ready.notify()
+                if replaced is not None:
+                    self.dropped += 1
+                    sequence, stamp = frame_header.unpack_from(replaced)
+                    self.reply(b'A', ack_format.pack(sequence, stamp, 0.0, 1))
+        except OSError:
+            pass
+        finally:
+            with self.ready:
+                self.closed = True
+                self.ready.notify()
+            worker.join()
+            log.info('Lamp disconnected', lamp=name, tracked=self.processed, dropped=self.dropped)
+
+    def track(self):
+        tracker = LampTracker(self.server.settings)
+        while True:
+            with self.ready:
+                self.ready.wait_for(lambda: self.pending is not None or self.closed)
+                if self.closed:
+                    return
+                payload, self.pending = self.pending, None
+            start = time.perf_counter()
+            sequence, stamp = frame_header.unpack_from(payload)
+            frame = cv2.imdecode(np.frombuffer(payload, np.uint8, offset=frame_header.size),
+                                 cv2.IMREAD_GRAYSCALE)
+            try:
+                cast = tracker.process(frame, stamp) if frame is not None else []
+                for spell, key in cast:
+                    self.reply(b'S', spell_header.pack(stamp, key), spell.encode())
+                self.processed += 1
+                self.reply(b'A', ack_format.pack(sequence, stamp, time.perf_counter() - start, 0))
+            except OSError:
+                return
+            except Exception:
+                # hang up, so the lamp knows it lost the worker instead of waiting for acks
+                log.exception('Tracking failed', lamp=self.name)
+                try:
+                    self.request.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                return
+
+
+class VisionWorker(socketserver.ThreadingTCPServer):
+    """Track wands for every lamp that connects to `address`."""
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, settings):
+        self.settings = settings
+        super().__init__(address, LampHandler)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Track wands for lamps on the network.')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=9000)
+    args = parser.parse_args()
+    # the tracking settings come from this machine's config.py
+    from wand import PipelineSettings
+    with VisionWorker((args.host, args.port), PipelineSettings()) as worker:
+        print(f'Vision worker listening on {args.host}:{args.port}')
+        try:
+            worker.serve_forever()
+        except KeyboardInterrupt:
+            pass
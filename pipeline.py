@@ -0,0 +1,319 @@
+"""
+Wand tracking split across processes, one per core.
+
+capture -> preprocess and detect -> optical flow and gestures
+
+Frames never go through a pipe.  Each stage writes them into a slot of a
+`FrameRing` in shared memory and only passes the slot number, the capture
+time and any detected points to the next stage, which hands the slot back
+on a free queue when it is done with it.  A live camera drops a frame when no
+slot is free; a recording waits for one.  Spells are sent back to the parent
+process, which owns the lights.
+
+The debug view is not available in this mode: the tracking stage only sees
+the processed grayscale frames.
+"""
+
+import math
+import queue
+import time
+import multiprocessing
+from multiprocessing import shared_memory
+from collections import defaultdict
+import numpy as np
+import logs
+
+# spawn, not fork: the parent runs Flask, animation and camera threads
+context = multiprocessing.get_context('spawn')
+
+
+class FrameRing:
+    """
+    `slots` frames of `shape` in one block of shared memory.
+
+    The process that creates a ring unlinks it on `close()`; a ring sent to
+    another process through a queue attaches to the same memory there.
+    """
+
+    def __init__(self, shape, dtype=np.uint8, slots=4, name=None):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.slots = slots
+        self.owner = name is None
+        size = int(np.prod(self.shape)) * self.dtype.itemsize * slots
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=size)
+        self.frames = np.ndarray((slots,) + self.shape, self.dtype, buffer=self.shm.buf)
+
+    def __reduce__(self):
+        return FrameRing, (self.shape, self.dtype.str, self.slots, self.shm.name)
+
+    def close(self):
+        self.frames = None
+        try:
+            self.shm.close()
+        except BufferError:
+            # views of a frame are still around; the mapping goes with the process
+            pass
+        if self.owner:
+            self.shm.unlink()
+
+
+def take_slot(free, stop, wait):
+    """A free slot number, or None if `wait` is off and none is free."""
+    while not stop.is_set():
+        try:
+            return free.get(timeout=0.5) if wait else free.get_nowait()
+        except queue.Empty:
+            if not wait:
+                return None
+    return None
+
+
+def receive(messages, stop):
+    """The next message, or None once stopped."""
+    while True:
+        try:
+            return messages.get(timeout=0.5)
+        except queue.Empty:
+            if stop.is_set():
+                return None
+
+
+def capture_stage(source, settings, free, frames, stop):
+    """Read, rotate and mirror frames into a shared ring."""
+    from camera import open_source, oriented_shape, orient
+    if isinstance(source, (int, str)):
+        source = open_source(source, pixel_format=settings['camera_format'])
+    # recordings replayed at full speed wait for the next stage instead of dropping frames
+    wait = not getattr(source, 'realtime', True)
+    ring = None
+    raw = None
+    dropped = 0
+    try:
+        while not stop.is_set():
+            rval, raw = source.read(raw)
+            if not rval or raw is None:
+                if getattr(source, 'finished', False):
+                    break
+                time.sleep(0.01)
+                continue
+            stamp = time.monotonic()
+            if ring is None:
+                ring = FrameRing(oriented_shape(raw.shape, settings['rotate']), raw.dtype, settings['slots'])
+                for slot in range(ring.slots):
+                    free.put(slot)
+                frames.put(('ring', ring))
+            slot = take_slot(free, stop, wait)
+            if slot is None:
+                dropped += 1
+                continue
+            orient(raw, ring.frames[slot], settings['rotate'], mirror=True)
+            frames.put((slot, stamp))
+    finally:
+        frames.put(None)
+        source.release()
+        if dropped:
+            logs.get('pipeline').info('Capture dropped frames', frames=dropped)
+        if ring is not None:
+            ring.close()
+
+
+def detect_stage(settings, frames, frames_free, grays, grays_free, following, stop):
+    """
+    Preprocess frames into a grayscale ring and look for wands, every
+    `scan_interval` while the tracking stage is not `following` a point and
+    every `confirm_interval` while it is.
+    """
+    from preprocess import ImagePipeline
+    from detectors import create_detector
+    from idle import MotionGate
+    image_pipeline = ImagePipeline(settings['stages'], dilation=settings['dilation'])
+    detector = create_detector(settings['detector'], settings['detector_gate'], **settings['detector_params'])
+    gate = None
+    if settings['idle']:
+        gate = MotionGate(idle_after=settings['idle_after'])
+        gate.reset(awake=True)
+    ring = None
+    gray_ring = None
+    last_scan = -math.inf
+    try:
+        while True:
+            message = receive(frames, stop)
+            if message is None:
+                break
+            if message[0] == 'ring':
+                ring = message[1]
+                # the tracking stage holds the previous frame as well as the current one
+                gray_ring = FrameRing(ring.shape[:2], np.uint8, ring.slots + 1)
+                for slot in range(gray_ring.slots):
+                    grays_free.put(slot)
+                grays.put(('ring', gray_ring))
+                continue
+            slot, stamp = message
+            frame = ring.frames[slot]
+            if gate is not None:
+                awake = gate.awake
+                if not gate.update(frame, stamp):
+                    frames_free.put(slot)
+                    if awake:
+                        grays.put(('idle',))
+                    time.sleep(max(0, stamp + 1 / settings['idle_fps'] - time.monotonic()))
+                    continue
+                if not awake:
+                    last_scan = -math.inf
+            gray_slot = take_slot(grays_free, stop, wait=True)
+            if gray_slot is None:
+                break
+            gray = image_pipeline.process(frame, out=gray_ring.frames[gray_slot])
+            frames_free.put(slot)
+            # whole-frame searches; the tracking stage searches where it lost points
+            points = None
+            interval = settings['confirm_interval'] if following.value else settings['scan_interval']
+            if stamp - last_scan >= interval:
+                points = detector.detect(gray)
+                if points is None:
+                    points = np.empty((0, 1, 2), np.float32)
+                last_scan = stamp
+            grays.put((gray_slot, stamp, points))
+    finally:
+        grays.put(None)
+        if ring is not None:
+            ring.close()
+        if gray_ring is not None:
+            gray_ring.close()
+
+
+def track_stage(settings, grays, grays_free, results, following, stop):
+    """Follow points with optical flow and report the spells they cast."""
+    from detectors import create_detector, detect_regions
+    from tracks import TrackManager
+    from flow import OpticalFlow
+    from gestures import SpellMatcher, GestureState
+    from gestures import TrajectoryRecognizer, load_templates
+    detector = create_detector(settings['detector'], **settings['detector_params'])
+    tracks = TrackManager(**settings['tracks'])
+    optical_flow = OpticalFlow(**settings['flow'])
+    matcher = SpellMatcher()
+    gestures = defaultdict(GestureState)
+    trajectories = None
+    if settings['templates']:
+        trajectories = TrajectoryRecognizer(load_templates(settings['templates']))
+    limit = settings['max_gesture_tracks']
+    ring = None
+    old_slot = None
+    try:
+        while True:
+            message = receive(grays, stop)
+            if message is None:
+                break
+            if message[0] == 'ring':
+                ring = message[1]
+                continue
+            if message[0] == 'idle':
+                tracks.reset()
+                following.value = False
+                optical_flow.reset()
+                gestures.clear()
+                if trajectories is not None:
+                    trajectories.reset()
+                if old_slot is not None:
+                    grays_free.put(old_slot)
+                    old_slot = None
+                continue
+            slot, stamp, points = message
+            gray = ring.frames[slot]
+
+            moved = []
+            ids, p0 = tracks.points()
+            guess = tracks.predictions(ids, stamp) if p0 is not None else None
+            flow = optical_flow.track(gray, p0, guess=guess)
+            if flow is not None:
+                p1, st, err = flow
+                moved = tracks.advance(ids, p1, st, stamp, err)
+            if trajectories is None:
+                for key, newX, newY, oldX, oldY in moved[:limit]:
+                    token = gestures[key].motion(newX, newY, oldX, oldY, settings['movement_threshold'])
+                    spell = matcher.feed(gestures[key], token) if token else None
+                    if spell is not None:
+                        results.put(('spell', spell, key))
+            elif moved:
+                for key, spell in trajectories.update(((key, x, y) for key, x, y, _, _ in moved[:limit]), stamp):
+                    results.put(('spell', spell, key))
+
+            if points is not None:
+                tracks.associate(points, stamp, confirm=True)
+            else:
+                regions = tracks.lost_regions(gray.shape)
+                if regions:
+                    tracks.associate(detect_regions(detector, gray, regions), stamp)
+            for key in tracks.retire(stamp):
+                gestures.pop(key, None)
+                if trajectories is not None:
+                    trajectories.reset(key)
+            following.value = bool(tracks.live(stamp - settings['scan_interval']))
+
+            if old_slot is not None:
+                grays_free.put(old_slot)
+            old_slot = slot
+            results.put(('frame', stamp, time.monotonic()))
+    finally:
+        results.put(None)
+        if ring is not None:
+            ring.close()
+
+
+class VisionPipeline:
+    """
+    The three tracking processes for `source`, configured by `settings`.
+
+    `get()` returns `('spell', spell, track)` and `('frame', captured, done)`
+    messages, and None once the source is finished.
+    """
+
+    def __init__(self, source, settings):
+        self.stop_event = context.Event()
+        self.results = context.Queue()
+        # held here as well: a started process lets go of its arguments, and a
+        # collected queue would take its semaphores with it before a slow
+        # child has attached to them
+        self.queues = frames, frames_free, grays, grays_free = [context.Queue() for _ in range(4)]
+        # whether the tracking stage is following a point, for the detection stage
+        following = context.Value('b', False, lock=False)
+        self.processes = [
+            context.Process(target=capture_stage, name='vision-capture', daemon=True,
+                            args=(source, settings, frames_free, frames, self.stop_event)),
+            context.Process(target=detect_stage, name='vision-detect', daemon=True,
+                            args=(settings, frames, frames_free, grays, grays_free, following, self.stop_event)),
+            context.Process(target=track_stage, name='vision-track', daemon=True,
+                            args=(settings, grays, grays_free, self.results, following, self.stop_event)),
+        ]
+        self.finished = False
+
+    def start(self):
+        # spawned children import the parent's __main__ first, e.g. the server,
+        # which leaves the lamp hardware alone until it is used
+        for process in self.processes:
+            process.start()
+        return self
+
+    def get(self, timeout=0.5):
+        """The next message from the tracking stage; raises queue.Empty."""
+        message = self.results.get(timeout=timeout)
+        if message is None:
+            self.finished = True
+        return message
+
+    def stop(self, timeout=5):
+        """Stop every stage and wait for them to exit."""
+        self.stop_event.set()
+        deadline = time.monotonic() + timeout
+        # drain the results so the tracking stage can flush its queue and exit
+        while not self.finished and time.monotonic() < deadline:
+            try:
+                self.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        for process in self.processes:
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.terminate()
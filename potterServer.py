@@ -5,21 +5,73 @@ more powerful server used to identify said spells.  It also handles turning
 on and off the IR emitters which can get hot if they're left on all the time.
 """
 
-from flask import Flask, make_response
+from flask import Flask, Response, make_response, request, jsonify
 import threading
-import redis
-import pickle
 
-from spells import cast_spell
+from spells import cast_spell, get_lights_state, reset_lights
 from config import potter_lamp_config as config
-from wand import WatchSpellsOn, WatchSpellsOff, WatchSpellsStatus
-from emitters import set_emitters
+from emitters import set_emitters, LampState
+from commands import CommandQueue
+import events
+import metrics
+import logs
+import profiler
+
+log = logs.get('server')
 
 app = Flask(__name__)
 
-# Use redis to track state of lamp
-redis_ns = config["redis_namespace"]
-store = redis.Redis() # defaults for localhost will work just fine
+def wand():
+    """The wand module, imported with OpenCV the first time it is needed."""
+    import wand
+    return wand
+
+# Wand tracking runs on one long-lived thread, started by the 'wand/on' command
+tracker = None
+
+def track_wand():
+    """Watch for spells, announcing when tracking starts and stops."""
+    events.publish('tracking', state='started')
+    try:
+        wand().WatchSpellsOn()
+    finally:
+        events.publish('tracking', state='stopped')
+
+def start_tracking():
+    """Start watching for spells, unless we already are."""
+    global tracker
+    if tracker is not None and tracker.is_alive():
+        if LampState():
+            log.info('Already watching for spells')
+            return
+        # turned off, but still closing the camera and saying goodbye
+        log.info('Waiting for the last session to end')
+        tracker.join()
+    # on before the thread starts, so it cannot be taken for one that is ending
+    LampState('on')
+    tracker = threading.Thread(target=track_wand, name='wand', daemon=True)
+    tracker.start()
+
+def tracking():
+    """True while the wand tracking thread is running."""
+    return tracker is not None and tracker.is_alive()
+
+def warm_camera():
+    """Open the camera ahead of the first session."""
+    import hardware
+    wand().cameras.warm(hardware.camera_source())
+
+# Every request that changes the lamp goes through one worker thread
+commands = CommandQueue({
+    'spells/lumos': lambda: cast_spell('lumos'),
+    'spells/nox': lambda: cast_spell('nox'),
+    'spells/incendio': lambda: cast_spell('incendio'),
+    'spells/colovaria': lambda: cast_spell('colovaria'),
+    'emitters/on': lambda: set_emitters(True),
+    'emitters/off': lambda: set_emitters(False),
+    'wand/on': start_tracking,
+    'wand/off': lambda: wand().WatchSpellsOff(),
+}, config.get('command_queue_size', 16))
 
 @app.route('/')
 def index():
@@ -28,57 +80,76 @@ def index():
 
 @app.route('/spells/lumos')
 def cast_lumos():
-    spell = threading.Thread(target=cast_spell, args=('lumos',))
-    spell.start()
+    commands.submit('spells/lumos')
     return "lumos on"
 
 @app.route('/spells/incendio')
 def cast_incendio():
-    spell = threading.Thread(target=cast_spell, args=('incendio',))
-    spell.start()
+    commands.submit('spells/incendio')
     return "incendio on"
 
 @app.route('/spells/colovaria')
 def cast_colovaria():
-    spell = threading.Thread(target=cast_spell, args=('colovaria',))
-    spell.start()
+    commands.submit('spells/colovaria')
     return "colovaria on"
 
 @app.route('/spells/nox')
 def cast_nox():
-    spell = threading.Thread(target=cast_spell, args=('nox',))
-    spell.start()
+    commands.submit('spells/nox')
     return "nox on"
 
 @app.route('/emitters/on')
 def emitters_on():
     # Turn on IR LED emitters.
-    set_emitters(True)
+    commands.submit('emitters/on')
     return "ir emitters on"
 
 @app.route('/emitters/off')
 def emitters_off():
     # Turn off IR LED emitters.
-    set_emitters(False)
+    commands.submit('emitters/off')
     return "ir emitters off"
 
 @app.route('/wand/on')
 def wand_on():
     """Start watching for spells."""
-    wand = threading.Thread(target=WatchSpellsOn)
-    wand.start()
+    commands.submit('wand/on')
     return "wand on"
 
 @app.route('/wand/off')
 def wand_off():
     """Stop watching for spells."""
-    WatchSpellsOff()
+    commands.submit('wand/off')
     return "wand off"
 
 @app.route('/wand/status')
 def wand_status():
     """Check status of watching for spells."""
-    return "wand on" if WatchSpellsStatus() else "wand off"
+    return "wand on" if LampState() else "wand off"
+
+@app.route('/commands', methods=['POST'])
+def run_commands():
+    """
+    Queue a batch of commands, e.g. ["wand/on", "spells/lumos"], posted as
+    a JSON list or as {"commands": [...]}.  Returns the status of each.
+    """
+    batch = request.get_json(force=True, silent=True)
+    if isinstance(batch, dict):
+        batch = batch.get('commands')
+    if not isinstance(batch, list):
+        return jsonify(error='expected a list of commands'), 400
+    return jsonify([{'command': name, 'status': commands.submit(str(name))} for name in batch])
+
+@app.route('/events')
+def event_stream():
+    """Server-Sent Events for lamp, spell and tracking changes."""
+    current = [('state', {'lamp': 'on' if LampState() else 'off',
+                          'lights': get_lights_state(),
+                          'tracking': tracking()})]
+    response = Response(events.bus.stream(current, config.get('events_snapshot_interval', 5)),
+                        mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 @app.route('/wand/image')
 def wand_image():
@@ -86,18 +157,60 @@ def wand_image():
     if not config['debug_test_image']:
         return 'Image debug is currently disabled.'
 
-    img_key = f'{redis_ns}:image'
-    if store.exists(img_key):
-        img_encoded = pickle.loads(store.get(img_key))
-        response = make_response(img_encoded.tobytes())
+    img_encoded = wand().debug_stream.snapshot()
+    if img_encoded is not None:
+        response = make_response(img_encoded)
         response.headers['Content-Type'] = 'image/jpg'
         return response
     else:
         return "No image."
 
+@app.route('/metrics')
+def metrics_endpoint():
+    """Stage timings and counters in Prometheus text format."""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# one profile at a time: each holds its request for the whole window
+profiling = threading.Lock()
+
+@app.route('/debug/profile')
+def debug_profile():
+    """
+    Sample the tracking, light effect and camera threads for ?seconds=N
+    (default 10) and return their stacks in collapsed stack format, for a
+    flame graph.  ?threads=a,b samples other threads, by name.
+    """
+    if not config.get('debug_profile', True):
+        return 'Profiling is currently disabled.'
+
+    seconds = request.args.get('seconds', 10.0, type=float)
+    seconds = max(0.0, min(seconds, config.get('debug_profile_max_seconds', 60)))
+    threads = request.args.get('threads')
+    threads = threads.split(',') if threads else profiler.default_threads
+    if not profiling.acquire(blocking=False):
+        return 'A profile is already running.', 409
+    try:
+        stacks, samples = profiler.sample(threads, seconds)
+    finally:
+        profiling.release()
+    log.info('Profiled', seconds=seconds, samples=samples, stacks=len(stacks))
+    response = Response(profiler.collapsed(stacks), mimetype='text/plain')
+    response.headers['X-Profile-Samples'] = str(samples)
+    return response
+
+@app.route('/wand/stream')
+def wand_stream():
+    """Stream the images seen by the camera as MJPEG."""
+    if not config['debug_test_image']:
+        return 'Image debug is currently disabled.'
+
+    from stream import boundary
+    return Response(wand().debug_stream.stream(),
+                    mimetype=f'multipart/x-mixed-replace; boundary={boundary}')
+
 @app.route('/wand/watch')
 def wand_watch():
-    """Watch debug image with refresh."""
+    """Watch the debug image stream."""
     if not config['debug_test_image']:
         return 'Image debug is currently disabled.'
 
@@ -107,22 +220,20 @@ def wand_watch():
             <title>This is what your lamp sees!</title>
         </head>
         <body style="text-align: center;">
-            <img src='/wand/image' />
-            <script>
-                let img = document.querySelector('img')
-                setInterval(() => {
-                    img.src = '/wand/image?refresh=' + (new Date()).valueOf()
-                }, 1000)
-            </script>
+            <img src='/wand/stream' />
         </body>
     </html>
     '''
 
 
-if config['watch_on_start']:
-    print("Watch for spells autostarted.")
-    wand_on()
-
 if __name__ == '__main__':
+    # start dark, with the emitters off
+    reset_lights()
+    LampState('off')
+    if config.get('camera_warm_on_start', False):
+        threading.Thread(target=warm_camera, name='camera-warm', daemon=True).start()
+    if config['watch_on_start']:
+        log.info('Watch for spells autostarted')
+        commands.submit('wand/on')
     app.run(host=config['host'], port=config['port'], debug=False, threaded=True)
 
@@ -0,0 +1,91 @@
+"""
+Image preprocessing for isolating wand points.
+
+`ImagePipeline` builds its kernels and CLAHE object once and writes every
+stage into preallocated buffers, so processing a frame allocates nothing
+once the first frame has set up the buffers.
+"""
+
+import numpy as np
+import cv2
+
+# Stages applied after grayscale conversion, in order
+default_stages = ('blur', 'dilate', 'clahe')
+
+
+class ImagePipeline:
+    """
+    Grayscale a frame and run it through `stages`.
+
+    Available stages are 'equalize', 'blur', 'dilate' and 'clahe'.  The
+    result of `process()` is one of `outputs` rotating buffers, so the
+    previous frame's result stays valid while the next one is processed.
+    """
+
+    def __init__(self, stages=default_stages, blur_size=(9, 9), blur_sigma=1.5,
+                 dilation=(5, 5), clip_limit=3.0, tile_grid=(8, 8), outputs=2):
+        self.blur_size = blur_size
+        self.blur_sigma = blur_sigma
+        self.dilate_kernel = np.ones(dilation, np.uint8)
+        self.clahe = cv2.createCLAHE(clipLimit=clip_limit, tileGridSize=tile_grid)
+        self.stages = [getattr(self, f'_{stage}') for stage in stages]
+        self._gray = None
+        self._scratch = None
+        self._outputs = [None] * max(outputs, 2)
+        self._next_output = 0
+
+    def _equalize(self, src, dst):
+        cv2.equalizeHist(src, dst)
+
+    def _blur(self, src, dst):
+        cv2.GaussianBlur(src, self.blur_size, self.blur_sigma, dst=dst)
+
+    def _dilate(self, src, dst):
+        cv2.dilate(src, self.dilate_kernel, dst=dst, iterations=1)
+
+    def _clahe(self, src, dst):
+        self.clahe.apply(src, dst)
+
+    def _allocate(self, shape):
+        """(Re)allocate all buffers for single-channel frames of `shape`."""
+        self._gray = np.empty(shape, np.uint8)
+        self._scratch = (np.empty(shape, np.uint8), np.empty(shape, np.uint8))
+        self._outputs = [np.empty(shape, np.uint8) for _ in self._outputs]
+
+    def process(self, frame, out=None, roi=None):
+        """
+        Return the processed grayscale image for a BGR or gray `frame`.
+
+        With `out` the result is written there instead of a rotating buffer.
+        With `roi` (x0, y0, x1, y1) only that part of the result is updated;
+        the rest holds whatever the buffer held before.
+        """
+        shape = frame.shape[:2]
+        if self._gray is None or self._gray.shape != shape:
+            self._allocate(shape)
+
+        if out is not None:
+            output = out
+        else:
+            output = self._outputs[self._next_output]
+            self._next_output = (self._next_output + 1) % len(self._outputs)
+        region = np.s_[:, :]
+        if roi is not None:
+            x0, y0, x1, y1 = roi
+            region = np.s_[y0:y1, x0:x1]
+
+        if frame.ndim == 3:
+            src = cv2.cvtColor(frame[region], cv2.COLOR_BGR2GRAY, dst=self._gray[region])
+        else:
+            src = frame[region]
+
+        if not self.stages:
+            np.copyto(output[region], src)
+            return output
+
+        last = len(self.stages) - 1
+        for index, stage in enumerate(self.stages):
+            dst = output[region] if index == last else self._scratch[index % 2][region]
+            stage(src, dst)
+            src = dst
+        return output
@@ -0,0 +1,65 @@
+"""
+Sample where the lamp's threads spend their time while it runs.
+
+`sample()` looks at the stacks of the named threads every `interval` seconds
+with `sys._current_frames()`, from the calling thread.  Nothing is installed
+in the threads being sampled, so they run at full speed again as soon as it
+returns.  Threads waiting for a frame or a lock are counted where they wait,
+so the profile shows wall-clock time, not only CPU time.
+
+`collapsed()` writes the result in the collapsed stack format read by
+flamegraph.pl and speedscope: one `thread;outer;...;inner count` line per
+distinct stack.
+"""
+
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+# the tracking loop, the light effects and the camera reader
+default_threads = ('wand', 'animator', 'camera')
+
+
+def frame_label(frame):
+    code = frame.f_code
+    name = getattr(code, 'co_qualname', code.co_name)
+    return f'{name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+def sample(threads=default_threads, seconds=10.0, interval=0.005):
+    """
+    Count the stacks of the threads named in `threads` for `seconds`.
+
+    Returns a Counter of stacks, each a tuple of the thread name and the
+    frames outermost first, and the number of samples taken.
+    """
+    names = set(threads)
+    stacks = Counter()
+    samples = 0
+    me = threading.get_ident()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        # threads come and go, e.g. tracking starts with the wand
+        sampled = {thread.ident: thread.name for thread in threading.enumerate()
+                   if thread.name in names and thread.ident != me}
+        frames = sys._current_frames()
+        for ident, name in sampled.items():
+            frame = frames.get(ident)
+            stack = []
+            while frame is not None:
+                stack.append(frame_label(frame))
+                frame = frame.f_back
+            if stack:
+                stack.append(name)
+                stacks[tuple(reversed(stack))] += 1
+        del frames
+        samples += 1
+        time.sleep(interval)
+    return stacks, samples
+
+
+def collapsed(stacks):
+    """`stacks` from sample() as collapsed stack lines, most frequent first."""
+    return ''.join(f'{";".join(stack)} {count}\n' for stack, count in stacks.most_common())
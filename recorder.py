@@ -0,0 +1,187 @@
+"""
+Record what the wand tracker saw, compactly enough to leave on all day.
+
+Every tracked point is appended as a fixed-width 12 byte record: time since
+the file started, track ID, position in quarter pixels, status, and the
+motion token it produced.  Records are collected in a preallocated buffer and
+written in blocks; files rotate at `max_bytes` and only the newest
+`max_files` are kept.
+
+Replay memory-maps a file and feeds its tracks to the gesture layer as fast
+as it can, to tune thresholds and templates against real sessions:
+
+    python3 recorder.py recordings/*.trk
+"""
+
+import os
+import sys
+import time
+from collections import defaultdict
+import numpy as np
+from gestures import motions_list, spells_list, SpellMatcher, GestureState
+
+magic = b'PLTR'
+version = 1
+record_dtype = np.dtype([
+    ('t_ms', '<u4'),   # milliseconds since the file was started
+    ('track', '<u2'),  # wraps around after 65535
+    ('x', '<i2'),      # quarter pixels
+    ('y', '<i2'),
+    ('status', 'u1'),
+    ('token', 'u1'),   # index into `tokens`
+])
+# magic, version, record size, start time (seconds since the epoch)
+header_dtype = np.dtype([('magic', 'S4'), ('version', '<u2'), ('size', '<u2'), ('start', '<f8')])
+
+# record statuses
+TRACKED, NEW, RETIRED, SPELL = range(4)
+# token 0 is no motion; SPELL records carry a spell instead
+tokens = (None,) + motions_list
+token_index = {token: index for index, token in enumerate(tokens)}
+spell_names = (None,) + tuple(dict.fromkeys(spells_list.values()))
+spell_index = {spell: index for index, spell in enumerate(spell_names)}
+
+
+class Recorder:
+    """
+    Append records to rotating files in `directory`.
+
+    `record()` only writes into a preallocated buffer of `buffer_records`;
+    the buffer goes to disk when full or `flush_interval` seconds after the
+    last write.
+    """
+
+    def __init__(self, directory, max_bytes=8 << 20, max_files=8,
+                 buffer_records=1024, flush_interval=5.0):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.flush_interval = flush_interval
+        self._buffer = np.zeros(buffer_records, record_dtype)
+        # column views, so recording a point does not build any arrays
+        self._t = self._buffer['t_ms']
+        self._track = self._buffer['track']
+        self._x = self._buffer['x']
+        self._y = self._buffer['y']
+        self._status = self._buffer['status']
+        self._token = self._buffer['token']
+        self._count = 0
+        self._file = None
+        self._start = 0.0
+        self._origin = 0.0
+        self._written = 0
+        self._flushed = 0.0
+
+    def _open(self, now):
+        """Start a new file, dropping the oldest ones beyond `max_files`."""
+        if self._file is not None:
+            self._file.close()
+        os.makedirs(self.directory, exist_ok=True)
+        self._start = time.time()
+        # record times are monotonic; `now` is when the file started
+        self._origin = now
+        name = time.strftime('wand-%Y%m%d-%H%M%S', time.localtime(self._start))
+        milliseconds = int(self._start * 1000) % 1000
+        path = os.path.join(self.directory, f'{name}-{milliseconds:03d}.trk')
+        self._file = open(path, 'xb')
+        header = np.array([(magic, version, record_dtype.itemsize, self._start)], header_dtype)
+        self._file.write(header.tobytes())
+        self._written = header_dtype.itemsize
+        for old in recordings(self.directory)[:-self.max_files]:
+            os.remove(old)
+
+    def record(self, now, track, x, y, status=TRACKED, token=0):
+        """Add one point seen at monotonic time `now`."""
+        if self._file is None:
+            self._open(now)
+        n = self._count
+        self._t[n] = (now - self._origin) * 1000
+        # IDs count up for as long as the lamp runs; positions far off the
+        # frame (a diverging prediction) are clipped to what fits
+        self._track[n] = track & 0xFFFF
+        self._x[n] = min(max(x * 4, -32768), 32767)
+        self._y[n] = min(max(y * 4, -32768), 32767)
+        self._status[n] = status
+        self._token[n] = token
+        self._count = n + 1
+        if self._count == len(self._buffer) or now - self._flushed > self.flush_interval:
+            self.flush(now)
+
+    def flush(self, now=None):
+        """Write buffered records, rotating the file when it is full."""
+        now = time.monotonic() if now is None else now
+        self._flushed = now
+        if not self._count:
+            return
+        self._file.write(self._buffer[:self._count].data)
+        self._file.flush()
+        self._written += self._count * record_dtype.itemsize
+        self._count = 0
+        if self._written >= self.max_bytes:
+            self._open(now)
+
+    def close(self):
+        if self._file is not None:
+            self.flush()
+            self._file.close()
+            self._file = None
+
+
+def recordings(directory):
+    """Recording files in `directory`, oldest first."""
+    if not os.path.isdir(directory):
+        return []
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                  if name.endswith('.trk'))
+
+
+def load(path):
+    """Memory-map a recording; returns (start time, records)."""
+    header = np.fromfile(path, header_dtype, count=1)[0]
+    if header['magic'] != magic or header['size'] != record_dtype.itemsize:
+        raise ValueError(f'{path} is not a version {version} wand recording')
+    count = (os.path.getsize(path) - header_dtype.itemsize) // record_dtype.itemsize
+    if count == 0:
+        return float(header['start']), np.zeros(0, record_dtype)
+    records = np.memmap(path, record_dtype, 'r', offset=header_dtype.itemsize, shape=(count,))
+    return float(header['start']), records
+
+
+def replay(records, matcher=None, movement_threshold=10, recognizer=None):
+    """
+    Feed recorded tracks to the gesture layer as fast as possible.
+
+    Tokens are recomputed from the positions with `movement_threshold`, or
+    whole trajectories go to a TrajectoryRecognizer.  Returns `(t_ms, track,
+    spell)` for every spell recognized.
+    """
+    matcher = matcher or SpellMatcher()
+    gestures = defaultdict(GestureState)
+    last = {}
+    found = []
+    tracked = records[records['status'] == TRACKED]
+    # plain Python values are much faster to loop over than numpy scalars
+    for t_ms, track, x, y in zip(tracked['t_ms'].tolist(), tracked['track'].tolist(),
+                                 (tracked['x'] / 4).tolist(), (tracked['y'] / 4).tolist()):
+        if recognizer is not None:
+            for key, spell in recognizer.update(((track, x, y),), t_ms / 1000):
+                found.append((t_ms, key, spell))
+            continue
+        if track in last:
+            oldX, oldY = last[track]
+            token = gestures[track].motion(x, y, oldX, oldY, movement_threshold)
+            spell = matcher.feed(gestures[track], token) if token else None
+            if spell is not None:
+                found.append((t_ms, track, spell))
+        last[track] = (x, y)
+    return found
+
+
+if __name__ == '__main__':
+    for path in sys.argv[1:]:
+        start, records = load(path)
+        cast = records[records['status'] == SPELL]
+        print(f'{path}: {len(records)} records from {time.ctime(start)}, '
+              f'{len(cast)} spells cast at the time')
+        for t_ms, track, spell in replay(records):
+            print(f'  {t_ms / 1000:9.3f}s  point {track}: {spell}')
@@ -4,170 +4,216 @@ server used to identify said spells.  It also handles turning on and off the IR
 emitters which can get hot if they're left on all the time.
 """
 
-import board
-import neopixel
 import time
-import random
-import redis
 import threading
-import pickle
+import numpy as np
+from animation import Animator, Effect
+from framebuffer import FrameBuffer, gradient
 from config import potter_lamp_config as config
+from state import shared_store
+import hardware
+import events
+import metrics
+import logs
 
-# LED light strip setup
-pixels = neopixel.NeoPixel(board.D18, 60)
-pixels.fill((0,0,0))
+log = logs.get('spells')
 
-# Use redis to track state of lights
-redis_ns = config["redis_namespace"]
-store = redis.Redis() # defaults for localhost will work just fine
+# Frames for the LED strip are pushed in bulk from `framebuffer`; the strip
+# itself is set up on the first push, see hardware.py
+framebuffer = FrameBuffer(hardware.led_count, config.get('led_gamma', 1.0), config.get('led_brightness', 1.0))
 
+# Track state of lights in the shared state store
 def store_set(key, value):
-    store.set(f'{redis_ns}:{key}', pickle.dumps(value))
+    shared_store().set(key, value)
 
 def store_get(key):
-    return pickle.loads(store.get(f'{redis_ns}:{key}'))
-
-store_set('potter_lights', 'off')
-store_set('current_spell', '')
+    return shared_store().get(key)
+
+class LightsState:
+    """
+    State of the lights, kept in memory for the animations.
+
+    Changes are flushed to the shared store in a single round trip, straight
+    away when the spell or lights change and at most every `flush_interval`
+    seconds for color updates.
+    """
+
+    def __init__(self, flush_interval=1.0):
+        self.flush_interval = flush_interval
+        self.lights = 'off'
+        self.spell = ''
+        self.color = (0, 0, 0)
+        self._dirty = {}
+        self._flushed = 0.0
+        self._lock = threading.Lock()
+
+    def set(self, key, value, force=False):
+        """Set `key` ('lights', 'spell' or 'color') and schedule a flush."""
+        store_key = {'lights': 'potter_lights',
+                     'spell': 'current_spell',
+                     'color': 'potter_current_color'}[key]
+        with self._lock:
+            setattr(self, key, value)
+            self._dirty[store_key] = value
+        self.flush(force)
+
+    def flush(self, force=False):
+        """Write pending changes to the store if forced or due."""
+        now = time.monotonic()
+        with self._lock:
+            if not self._dirty or (not force and now - self._flushed < self.flush_interval):
+                return
+            dirty, self._dirty = self._dirty, {}
+            self._flushed = now
+        shared_store().update(dirty)
+
+lights = LightsState(config.get('lights_flush_interval', 1.0))
 
 def set_current_color(color):
     """Set the current color of the lamp. (Used by Nox.)"""
-    store_set('potter_current_color', color)
+    lights.set('color', tuple(color))
 
 def get_current_color():
     """Get current color of the lamp."""
-    return store_get('potter_current_color')
+    return lights.color
 
 def get_lights_state():
     """Returns True is lights are on; False if off or turning off."""
-    return store_get('potter_lights') == 'on'
+    return lights.lights == 'on'
 
 def set_lights_state(light_status):
     """Sets the state of 'potter_lights' to 'on' or 'off'."""
     status_text = 'on' if light_status else 'off'
-    store_set('potter_lights', status_text)
-    print(f'lights status: {status_text}')
+    lights.set('lights', status_text, True)
+    log.debug('Lights set', status=status_text)
     return status_text
 
 def check_current_spell(spell):
     """Checks if 'spell' is the currently cast spell."""
-    return store_get('current_spell') == spell
-
+    return lights.spell == spell
 
-# set initial color
-set_current_color((0,0,0))
 
 # SPELLS
 
-def lumos(lamp_duration=180, start_color=(255, 255, 255), direct_cast = False):
+push_time = metrics.stage('led_push')
+spells_cast = metrics.counter('spells_cast', 'Spells cast, by the wand or the API.')
+
+def show(frame):
+    """Push one frame to the light strip."""
+    with push_time:
+        framebuffer.push(hardware.pixels())
+    set_current_color(framebuffer.color())
+
+# All spells are played by a single render loop, see animation.py
+animator = Animator(framebuffer, show, config.get('animation_fps', 100), config.get('spell_crossfade', 0.2))
+rng = np.random.default_rng()
+
+def fade(end, seconds):
+    """Yield the frames of a fade from what is showing to `end`."""
+    start = framebuffer.frame.copy()
+    end = framebuffer.as_frame(end, np.empty_like(start))
+    step_frame = np.empty_like(start)
+    steps = animator.frames(seconds)
+    for step in range(1, steps + 1):
+        yield framebuffer.mix(start, end, 255 * step // steps, step_frame)
+
+def lumos_effect(lamp_duration=180, start_color=(255, 255, 255)):
     """Lumos - light up the lantern."""
-    print('start lumos')
-    duration = 3
     set_lights_state(True)
-    for val in range(0, 255, 4):
-        # if someone casts "Nox", stop turning on lights
-        if not get_lights_state() or not check_current_spell('lumos') and not direct_cast:
-            break
-        color = (int(val * start_color[0] / 256),
-                 int(val * start_color[1] / 256),
-                 int(val * start_color[2] / 256))
-        set_current_color(color)
-        pixels.fill(color)
-        time.sleep(duration / 256)
-
+    yield from fade(start_color, 0.75)
+    lights.flush(True)
     # Keep the lights on (default 3 minutes)
-    time.sleep(lamp_duration)
-
-    # If the lights are still on, run nox.
-    if get_lights_state() and (check_current_spell('lumos') or direct_cast):
-        nox()
-    print("lumos complete")
-    return
+    yield lamp_duration
+    yield from nox_effect()
 
-def nox():
+def nox_effect():
     """Nox - turn off the light."""
     set_lights_state(False)
-    color = get_current_color()
-    for val in range(0, 255, 4):
-        pr = int((255 - val) / 256 * color[0])
-        pg = int((255 - val) / 256 * color[1])
-        pb = int((255 - val) / 256 * color[2])
-        pixels.fill((pr, pg, pb))
-        time.sleep(0.001)
-    # complete fade to black
-    pixels.fill((0, 0, 0))
-    set_current_color((0, 0, 0))
-    print("nox complete")
+    yield from fade((0, 0, 0), 0.1)
     # All spells end in Nox
-    store_set('current_spell', '')
-    return
+    lights.set('spell', '', True)
 
-def incendio(lamp_duration=180):
+def incendio_effect(lamp_duration=180):
     """Incendio - FIRE!!!"""
     duration = lamp_duration # burn for 3 minutes by default
     interval = 0.1 # change the flame every 1/10s
+    flame = np.zeros((framebuffer.count, 3), np.uint8)
     set_lights_state(True)
-    while duration > 0 and get_lights_state() and check_current_spell('incendio'):
-        current_color = get_current_color()
-        color = (random.randint(100, 255), random.randint(0, 40), 0)
-        for val in range(10):
-            pixels.fill((
-                int(current_color[0] + ((color[0] - current_color[0]) * val / 10)),
-                int(current_color[1] + ((color[1] - current_color[1]) * val / 10)),
-                int(current_color[2] + ((color[2] - current_color[2]) * val / 10)),
-            ))
-            time.sleep(0.003)
-        set_current_color(color)
-        pixels.fill(color)
-        time.sleep(interval)
+    while duration > 0:
+        # every pixel flickers on its own
+        flame[:, 0] = rng.integers(100, 256, framebuffer.count)
+        flame[:, 1] = rng.integers(0, 41, framebuffer.count)
+        yield from fade(flame, 0.03)
+        yield interval
         duration = duration - interval
-    if check_current_spell('incendio'):
-        nox()
-    print("incendio complete")
-    return
+    yield from nox_effect()
 
-def colovaria(lamp_duration=180):
+def colovaria_effect(lamp_duration=180):
     """Colovaria - lots of colors"""
     duration = lamp_duration # kaleidascope for 3 minutes by default
-    interval = 0.2 # change the color every 2/10s
+    interval = 0.2 # change the colors every 2/10s
     set_lights_state(True)
-    while duration > 0 and get_lights_state() and check_current_spell('colovaria'):
-        current_color = get_current_color()
-        color = (
-            random.randint(20, 255),
-            random.randint(20, 255),
-            random.randint(20, 255)
-        )
-        #TODO: Make multiple colors
-        for val in range(10):
-            pixels.fill((
-                int(current_color[0] + ((color[0] - current_color[0]) * val / 10)),
-                int(current_color[1] + ((color[1] - current_color[1]) * val / 10)),
-                int(current_color[2] + ((color[2] - current_color[2]) * val / 10)),
-            ))
-            time.sleep(0.003)
-        set_current_color(color)
-        pixels.fill(color)
-        time.sleep(interval)
+    while duration > 0:
+        # a few random colors blended along the strip
+        colors = rng.integers(20, 256, (3, 3))
+        yield from fade(gradient(colors, framebuffer.count), 0.03)
+        yield interval
         duration = duration - interval
-    if check_current_spell('colovaria'):
-        nox()
-    print("colovaria complete")
-    return
-
-def cast_spell(spell):
-    cast = None
-    if spell == 'lumos':
-        cast = threading.Thread(target=lumos)
-    elif spell == 'nox':
-        cast = threading.Thread(target=nox)
-    elif spell == 'incendio':
-        cast = threading.Thread(target=incendio)
-    elif spell == 'colovaria':
-        cast = threading.Thread(target=colovaria)
-
-    if cast is not None:
-        store_set('current_spell', spell)
-        cast.start()
-    
-    return cast
\ No newline at end of file
+    yield from nox_effect()
+
+spell_effects = {
+    'lumos': lumos_effect,
+    'nox': nox_effect,
+    'incendio': incendio_effect,
+    'colovaria': colovaria_effect,
+}
+
+def reset_lights():
+    """Blank the strip and record the lights as off, e.g. on startup."""
+    framebuffer.frame.fill(0)
+    show(framebuffer.frame)
+    lights.set('spell', '')
+    lights.set('color', (0, 0, 0))
+    lights.set('lights', 'off', True)
+
+def cast_spell(spell, *args):
+    """
+    Start `spell`, preempting whatever is playing.
+
+    Returns the playing `Effect` (wait on it to block until the spell is
+    done), or None for an unknown spell.
+    """
+    if spell not in spell_effects:
+        return None
+    lights.set('spell', spell, True)
+    spells_cast.inc()
+    events.publish('spell', spell=spell)
+    return animator.play(Effect(spell, spell_effects[spell](*args)))
+
+def wait_for(effect, seconds):
+    """
+    Wait for `effect`, meant to last about `seconds`, to finish; gives up
+    and returns False if it overruns by far, e.g. with the render loop stuck.
+    """
+    # the fades between flickers stretch incendio and colovaria by up to a third
+    if effect.wait(1.5 * seconds + config.get('spell_wait_margin', 5)):
+        log.debug('Spell complete', spell=effect.name)
+        return True
+    log.warning('Spell did not finish in time', spell=effect.name)
+    return False
+
+def lumos(lamp_duration=180, start_color=(255, 255, 255)):
+    """Cast lumos and wait for it to finish."""
+    return wait_for(cast_spell('lumos', lamp_duration, start_color), lamp_duration)
+
+def nox():
+    """Cast nox and wait for it to finish."""
+    return wait_for(cast_spell('nox'), 0)
+
+def incendio(lamp_duration=180):
+    """Cast incendio and wait for it to finish."""
+    return wait_for(cast_spell('incendio', lamp_duration), lamp_duration)
+
+def colovaria(lamp_duration=180):
+    """Cast colovaria and wait for it to finish."""
+    return wait_for(cast_spell('colovaria', lamp_duration), lamp_duration)
@@ -0,0 +1,184 @@
+"""
+Shared lamp state with an in-process cache.
+
+Reads are served from memory.  Writes go to the backend (Redis by default) in
+a single pipeline together with an invalidation message on a pub/sub channel,
+so other processes drop their cached copies.  Cached values are also refetched
+after `max_age` seconds, which bounds how stale a read can be even if an
+invalidation is lost.
+"""
+
+import json
+import os
+import threading
+import time
+import uuid
+from config import potter_lamp_config as config
+import hardware
+import metrics
+
+redis_calls = metrics.counter('redis_calls', 'Round trips to the Redis server.')
+
+
+def encode(value):
+    """Encode `value` compactly: raw bytes as-is, anything else as JSON."""
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return b'b' + bytes(value)
+    return b'j' + json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+
+def _tuples(value):
+    """JSON has no tuples; colors and other sequences come back as tuples."""
+    if isinstance(value, list):
+        return tuple(_tuples(item) for item in value)
+    return value
+
+
+def decode(data):
+    """Inverse of `encode`."""
+    if data is None:
+        return None
+    if data[:1] == b'b':
+        return data[1:]
+    return _tuples(json.loads(data[1:]))
+
+
+class MemoryBackend:
+    """
+    Backend kept in process memory, for running and testing without Redis.
+
+    Several StateStores sharing one MemoryBackend behave like separate
+    processes sharing a Redis server.
+    """
+
+    def __init__(self):
+        self._data = {}
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        return self._data.get(key)
+
+    def set_many(self, items, channel, message):
+        with self._lock:
+            self._data.update(items)
+            subscribers = list(self._subscribers.get(channel, ()))
+        for callback in subscribers:
+            callback(message)
+
+    def listen(self, channel, callback, on_error=None):
+        with self._lock:
+            self._subscribers.setdefault(channel, []).append(callback)
+
+
+class RedisBackend:
+    """Backend using a Redis server and its pub/sub channels."""
+
+    def __init__(self, client=None):
+        import redis
+        self.client = client or redis.Redis() # defaults for localhost will work just fine
+
+    def get(self, key):
+        redis_calls.inc()
+        return self.client.get(key)
+
+    def set_many(self, items, channel, message):
+        redis_calls.inc()
+        pipe = self.client.pipeline(transaction=False)
+        for key, value in items.items():
+            pipe.set(key, value)
+        pipe.publish(channel, message)
+        pipe.execute()
+
+    def listen(self, channel, callback, on_error=None):
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{channel: lambda message: callback(message['data'])})
+
+        def handle_error(error, pubsub, thread):
+            if on_error is not None:
+                on_error(error)
+            time.sleep(1)
+
+        pubsub.run_in_thread(sleep_time=0.1, daemon=True, exception_handler=handle_error)
+
+
+class StateStore:
+    """Namespaced, cached key/value state shared between processes."""
+
+    def __init__(self, namespace, backend, max_age=1.0):
+        self.namespace = namespace
+        self.backend = backend
+        self.max_age = max_age
+        self.channel = f'{namespace}:invalidate'
+        self._origin = f'{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self._cache = {}
+        self._lock = threading.Lock()
+        self._listening = False
+
+    def _listen(self):
+        """Subscribe to invalidations on first use."""
+        with self._lock:
+            if self._listening:
+                return
+            self._listening = True
+        # if the subscription breaks, stop trusting the cache
+        self.backend.listen(self.channel, self._invalidate, lambda error: self.clear())
+
+    def _invalidate(self, message):
+        message = json.loads(message)
+        if message['origin'] == self._origin:
+            return
+        with self._lock:
+            for key in message['keys']:
+                self._cache.pop(key, None)
+
+    def clear(self):
+        """Drop every cached value."""
+        with self._lock:
+            self._cache.clear()
+
+    def get(self, key, default=None):
+        """Return the value of `key`, from the cache when it is fresh enough."""
+        self._listen()
+        now = time.monotonic()
+        cached = self._cache.get(key)
+        if cached is not None and now - cached[1] < self.max_age:
+            return default if cached[0] is None else cached[0]
+        value = decode(self.backend.get(f'{self.namespace}:{key}'))
+        with self._lock:
+            self._cache[key] = (value, now)
+        return default if value is None else value
+
+    def set(self, key, value):
+        """Set a single key."""
+        self.update({key: value})
+
+    def update(self, items):
+        """Set several keys in one round trip and invalidate other caches."""
+        self._listen()
+        now = time.monotonic()
+        with self._lock:
+            for key, value in items.items():
+                self._cache[key] = (value, now)
+        message = json.dumps({'origin': self._origin, 'keys': list(items)})
+        self.backend.set_many(
+            {f'{self.namespace}:{key}': encode(value) for key, value in items.items()},
+            self.channel, message)
+
+
+_shared_store = None
+_shared_lock = threading.Lock()
+
+
+def shared_store():
+    """The StateStore shared by this process, built from `config`."""
+    global _shared_store
+    with _shared_lock:
+        if _shared_store is None:
+            if hardware.state_backend() == 'memory':
+                backend = MemoryBackend()
+            else:
+                backend = RedisBackend()
+            _shared_store = StateStore(config['redis_namespace'], backend,
+                                       config.get('state_max_age', 1.0))
+    return _shared_store
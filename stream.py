@@ -0,0 +1,125 @@
+"""
+Share the debug view with any number of MJPEG viewers.
+
+The tracker publishes every frame, but frames are only copied and encoded
+while someone is watching, at most `fps` times a second, and each JPEG is
+encoded once for all viewers.
+"""
+
+import threading
+import time
+import numpy as np
+import cv2
+import metrics
+
+boundary = 'frame'
+encode_time = metrics.stage('debug_encode')
+
+
+class FrameBroadcaster:
+    """Latest-frame buffer feeding JPEGs to subscribed viewers."""
+
+    def __init__(self, fps=10, quality=80):
+        self.interval = 1 / fps
+        self.quality = quality
+        self.subscribers = 0
+        self.jpeg = None
+        self._frame = None
+        self._spare = None
+        self._fresh = False
+        self._seq = 0
+        self._due = 0.0
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def publish(self, frame):
+        """Offer a frame; cheap when nobody is watching or it is not due."""
+        if not self.subscribers:
+            return
+        now = time.monotonic()
+        if now < self._due:
+            return
+        self._due = now + self.interval
+        with self._cond:
+            if self._frame is None or self._frame.shape != frame.shape:
+                self._frame = np.empty_like(frame)
+            np.copyto(self._frame, frame)
+            self._fresh = True
+            self._cond.notify_all()
+
+    def _encoder(self):
+        """Encode published frames while there are subscribers."""
+        params = [cv2.IMWRITE_JPEG_QUALITY, self.quality]
+        with self._cond:
+            while self.subscribers:
+                if not self._fresh:
+                    self._cond.wait(1)
+                    continue
+                self._fresh = False
+                # publish() fills the spare buffer while this one is encoded
+                frame = self._frame
+                self._frame, self._spare = self._spare, frame
+                self._cond.release()
+                try:
+                    with encode_time:
+                        _, encoded = cv2.imencode('.jpg', frame, params)
+                finally:
+                    self._cond.acquire()
+                self.jpeg = encoded.tobytes()
+                self._seq += 1
+                self._cond.notify_all()
+            self._thread = None
+
+    def _subscribe(self):
+        with self._cond:
+            self.subscribers += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._encoder, name='debug-stream', daemon=True)
+                self._thread.start()
+            return self._seq
+
+    def _unsubscribe(self):
+        with self._cond:
+            self.subscribers -= 1
+            self._cond.notify_all()
+
+    def _next(self, seq, timeout):
+        """Wait for a JPEG newer than `seq`; returns (seq, jpeg or None)."""
+        with self._cond:
+            self._cond.wait_for(lambda: self._seq > seq, timeout)
+            if self._seq > seq:
+                return self._seq, self.jpeg
+            return seq, None
+
+    def snapshot(self, timeout=1.0):
+        """Return a fresh JPEG, or the last one if none arrives in time."""
+        seq = self._subscribe()
+        try:
+            _, jpeg = self._next(seq, timeout)
+            return jpeg or self.jpeg
+        finally:
+            self._unsubscribe()
+
+    def stream(self):
+        """
+        Generate multipart/x-mixed-replace chunks for one viewer.
+
+        The last JPEG is sent again every second while no new one comes, so
+        a viewer that has disconnected is let go even when nothing is
+        published.
+        """
+        seq = self._subscribe()
+        try:
+            while True:
+                seq, jpeg = self._next(seq, 1.0)
+                if jpeg is None:
+                    # write something anyway: only a failed write shows the viewer has gone
+                    jpeg = self.jpeg
+                    if jpeg is None:
+                        # before the first part this is preamble, which viewers ignore
+                        yield b'\r\n'
+                        continue
+                yield (f'--{boundary}\r\nContent-Type: image/jpeg\r\n'
+                       f'Content-Length: {len(jpeg)}\r\n\r\n').encode() + jpeg + b'\r\n'
+        finally:
+            self._unsubscribe()
@@ -0,0 +1,274 @@
+"""
+Give every tracked wand point a stable identity.
+
+Optical flow follows the points frame to frame; `TrackManager` remembers
+which point is which.  A point that optical flow loses is kept for a short
+while as a lost track, and detection is re-run only around where it was
+last seen.  A detection close to a lost track picks it up again under the
+same ID, so gesture state survives brief drop-outs.
+
+Each track runs a constant-velocity Kalman filter, so optical flow can
+start its search where the point is heading, and keeps a confidence score
+from how well optical flow matched it.  Tracks that optical flow matches
+badly are pruned.  Bright spots that stay put (lamps, reflections,
+windows) are parked: optical flow still follows them, so they are not
+detected again as new points, but they are not reported for gestures until
+they move.  A wand held still before a cast is one of them for a while.
+"""
+
+import math
+import numpy as np
+
+
+class Track:
+    """
+    One tracked point.
+
+    `x`, `y`, `vx` and `vy` are the filtered position and velocity at time
+    `seen`; `covariance` is (position, position-velocity, velocity), the
+    same for both axes.
+    """
+
+    __slots__ = ('id', 'x', 'y', 'seen', 'lost', 'vx', 'vy', 'covariance',
+                 'confidence', 'anchor', 'still_since', 'parked')
+
+    def __init__(self, id, x, y, seen, velocity_variance=1e6):
+        self.id = id
+        self.x = x
+        self.y = y
+        self.seen = seen
+        self.lost = False
+        self.vx = 0.0
+        self.vy = 0.0
+        self.covariance = (1.0, 0.0, velocity_variance)
+        self.confidence = 1.0
+        self.anchor = (x, y)
+        self.still_since = seen
+        self.parked = False
+
+    def predict(self, now):
+        """Expected position at `now`."""
+        dt = now - self.seen
+        return self.x + self.vx * dt, self.y + self.vy * dt
+
+    def correct(self, x, y, now, process_noise, measurement_noise):
+        """Fold a measured position at `now` into the filter."""
+        dt = now - self.seen
+        p11, p12, p22 = self.covariance
+        # predict, with white acceleration noise of `process_noise`
+        p11 += dt * (2 * p12 + dt * p22) + process_noise * dt ** 4 / 4
+        p12 += dt * p22 + process_noise * dt ** 3 / 2
+        p22 += process_noise * dt ** 2
+        px, py = self.predict(now)
+        # update
+        s = p11 + measurement_noise
+        k1, k2 = p11 / s, p12 / s
+        ex, ey = x - px, y - py
+        self.x, self.y = px + k1 * ex, py + k1 * ey
+        self.vx += k2 * ex
+        self.vy += k2 * ey
+        self.covariance = ((1 - k1) * p11, (1 - k1) * p12, p22 - k2 * p12)
+        self.seen = now
+
+
+class TrackManager:
+    """
+    Tracked points, oldest first.
+
+    Detections within `match_radius` pixels of a track are associated with
+    it, nearest pairs first.  Lost tracks are searched for `search_radius`
+    pixels around their last position and retired after `lost_timeout`
+    seconds.  At most `max_tracks` are kept.
+
+    `process_noise` ((pixels/s^2)^2) and `measurement_noise` (pixels^2) tune
+    the Kalman filters.  Optical flow errors are scaled by `error_scale` into
+    a match quality that `confidence` is smoothed towards by `smoothing`;
+    tracks below `min_confidence` are pruned.  A track that stays within
+    `static_radius` pixels for `static_after` seconds is parked until it
+    leaves that spot.
+    """
+
+    def __init__(self, match_radius=25, search_radius=40, lost_timeout=1.0, max_tracks=20,
+                 process_noise=1e6, measurement_noise=1.0, error_scale=20.0, smoothing=0.3,
+                 min_confidence=0.3, static_radius=4, static_after=3.0):
+        self.match_radius = match_radius
+        self.search_radius = search_radius
+        self.lost_timeout = lost_timeout
+        self.max_tracks = max_tracks
+        self.process_noise = process_noise
+        self.measurement_noise = measurement_noise
+        self.error_scale = error_scale
+        self.smoothing = smoothing
+        self.min_confidence = min_confidence
+        self.static_radius = static_radius
+        self.static_after = static_after
+        self.tracks = {}
+        self.pruned = 0
+        self.next_id = 0
+        self._pruned = []
+
+    def reset(self):
+        """Forget every track."""
+        self.tracks.clear()
+        self._pruned.clear()
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def active(self):
+        """Tracks currently followed by optical flow, oldest first."""
+        return [track for track in self.tracks.values() if not track.lost]
+
+    def live(self, moved_since=-math.inf):
+        """
+        Active tracks that are not parked: the points that might be wands.
+        With `moved_since`, only those that have moved since then.
+        """
+        return [track for track in self.tracks.values()
+                if not track.lost and not track.parked and track.still_since >= moved_since]
+
+    def points(self):
+        """IDs and (N, 1, 2) float32 positions of the active tracks."""
+        active = self.active()
+        if not active:
+            return [], None
+        points = np.array([(track.x, track.y) for track in active], np.float32)
+        return [track.id for track in active], points.reshape(-1, 1, 2)
+
+    def predictions(self, ids, now):
+        """(N, 1, 2) float32 positions the tracks `ids` are expected at `now`."""
+        predicted = np.array([self.tracks[key].predict(now) for key in ids], np.float32)
+        return predicted.reshape(-1, 1, 2)
+
+    def advance(self, ids, new, status, now, errors=None):
+        """
+        Move the tracks `ids` to their optical flow positions `new`.
+
+        Tracks whose `status` is 0 are marked lost.  `errors` from optical
+        flow update each track's confidence; tracks that fall below
+        `min_confidence` are pruned, and tracks that have stayed put too long
+        are parked.  Returns `(id, newX, newY, oldX, oldY)` for every track
+        that was followed and is not parked, most confident first.
+        """
+        moved = []
+        if errors is None:
+            errors = np.zeros(len(ids), np.float32)
+        for key, (newX, newY), found, error in zip(ids, new.reshape(-1, 2), status.ravel(), errors.ravel()):
+            track = self.tracks[key]
+            quality = max(0.0, 1 - float(error) / self.error_scale) if found else 0.0
+            track.confidence += self.smoothing * (quality - track.confidence)
+            if not found:
+                track.lost = True
+                continue
+            oldX, oldY = track.x, track.y
+            track.correct(float(newX), float(newY), now, self.process_noise, self.measurement_noise)
+            if math.hypot(track.x - track.anchor[0], track.y - track.anchor[1]) > self.static_radius:
+                track.anchor = (track.x, track.y)
+                track.still_since = now
+                track.parked = False
+            elif now - track.still_since > self.static_after:
+                track.parked = True
+            if track.confidence < self.min_confidence:
+                self._prune(key)
+                continue
+            if track.parked:
+                continue
+            moved.append((key, track.x, track.y, oldX, oldY))
+        moved.sort(key=lambda entry: -self.tracks[entry[0]].confidence)
+        return moved
+
+    def _prune(self, key):
+        del self.tracks[key]
+        self._pruned.append(key)
+        self.pruned += 1
+
+    def lost_regions(self, shape):
+        """(x0, y0, x1, y1) search windows around lost tracks, clipped to `shape`."""
+        height, width = shape[:2]
+        r = self.search_radius
+        regions = []
+        for track in self.tracks.values():
+            if track.lost:
+                x, y = int(track.x), int(track.y)
+                region = (max(x - r, 0), max(y - r, 0), min(x + r, width), min(y + r, height))
+                if region[0] < region[2] and region[1] < region[3]:
+                    regions.append(region)
+        return regions
+
+    def bounds(self, shape, padding, parked=True):
+        """
+        (x0, y0, x1, y1) around every track, lost ones included, padded by
+        `padding` and clipped to `shape`; None without tracks.  Parked tracks
+        are left out unless `parked`.
+        """
+        tracks = [track for track in self.tracks.values() if parked or not track.parked]
+        if not tracks:
+            return None
+        height, width = shape[:2]
+        xs = [track.x for track in tracks]
+        ys = [track.y for track in tracks]
+        pad = max(padding, self.search_radius)
+        return (max(int(min(xs)) - pad, 0), max(int(min(ys)) - pad, 0),
+                min(int(max(xs)) + pad + 1, width), min(int(max(ys)) + pad + 1, height))
+
+    def associate(self, points, now, confirm=False):
+        """
+        Match detected `points` (N, 1, 2) to tracks, nearest first.
+
+        Lost tracks matched to a detection are active again; detections
+        already followed by an active track are ignored and the rest start
+        new tracks.  With `confirm` the points cover the whole frame, and
+        active tracks with no detection are marked lost: optical flow happily
+        follows a patch of empty background once the wand has gone.  Returns
+        the IDs of the new tracks.
+        """
+        if points is None or len(points) == 0:
+            points = np.empty((0, 2), np.float32)
+        points = points.reshape(-1, 2)
+        tracks = list(self.tracks.values())
+        unmatched = set(range(len(points)))
+        used = set()
+        if tracks and len(points):
+            positions = np.array([(track.x, track.y) for track in tracks], np.float32)
+            distances = np.linalg.norm(points[:, None] - positions[None], axis=2)
+            for flat in np.argsort(distances, axis=None):
+                point, index = divmod(int(flat), len(tracks))
+                if distances[point, index] > self.match_radius:
+                    break
+                if point not in unmatched or index in used:
+                    continue
+                unmatched.discard(point)
+                used.add(index)
+                track = tracks[index]
+                if track.lost:
+                    x, y = (float(value) for value in points[point])
+                    track.correct(x, y, now, self.process_noise, self.measurement_noise)
+                    track.confidence = 1.0
+                    track.lost = False
+        if confirm:
+            for index, track in enumerate(tracks):
+                if index not in used:
+                    track.lost = True
+
+        started = []
+        for point in sorted(unmatched):
+            if len(self.tracks) >= self.max_tracks:
+                break
+            x, y = (float(value) for value in points[point])
+            self.tracks[self.next_id] = Track(self.next_id, x, y, now)
+            started.append(self.next_id)
+            self.next_id += 1
+        return started
+
+    def retire(self, now):
+        """
+        Drop tracks lost for longer than `lost_timeout`; returns their IDs,
+        and those of tracks pruned since the last call.
+        """
+        stale = [key for key, track in self.tracks.items()
+                 if track.lost and now - track.seen > self.lost_timeout]
+        for key in stale:
+            del self.tracks[key]
+        stale.extend(self._pruned)
+        self._pruned.clear()
+        return stale
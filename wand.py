@@ -37,319 +37,521 @@ SOFTWARE.
 
 import numpy as np
 import cv2
+import os
 import sys
 import math
 import time
+import queue
 import warnings
-import redis
 import re
-import traceback
-import pickle
-from PIL import Image
+from collections import defaultdict
 from config import potter_lamp_config as config
 from spells import cast_spell, lumos
-from emitters import set_emitters
+from emitters import set_emitters, LampState
+from camera import FrameGrabber, CameraPool, open_source
+from stream import FrameBroadcaster
+import hardware
+import metrics
+import logs
+from detectors import create_detector, detect_regions
+from tracks import TrackManager
+from flow import OpticalFlow
+from idle import MotionGate
+from pipeline import VisionPipeline
+from offload import OffloadClient
+from preprocess import ImagePipeline, default_stages
+from gestures import spells_list, motions_list, SpellMatcher, GestureState, motion_token
+from gestures import TrajectoryRecognizer, load_templates
+from recorder import Recorder, NEW, SPELL, RETIRED, token_index, spell_index
 
 # Set global variables
+log = logs.get('wand')
 debug_opencv = config["debug_opencv"]
 
-# Use redis to track state of lamp
-redis_ns = config["redis_namespace"]
-store = redis.Redis() # defaults for localhost will work just fine
-
-def LampState(set=None):
-    """Retrieve or set lamp state."""
-    if set in ['on', 'off']:
-        store.set(f'{redis_ns}:potter_lamp', set)
-        lamp_state = set == 'on'
-        set_emitters(lamp_state)
-        print(f'Set Lamp State: {lamp_state}')
-    else:
-        lamp_state = store.get(f'{redis_ns}:potter_lamp').decode('utf-8') == 'on'
-
-    return lamp_state
-
-# Set default lamp state
-LampState('off')
-
 # OpenCV Parameters for image processing
-lk_params = dict( winSize  = (25,25),
-                  maxLevel = 10,
-                  criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03))
 dilation_params = (5, 5)
+image_pipeline = ImagePipeline(
+    config.get('preprocess_stages', default_stages), dilation=dilation_params)
 movement_threshold = 10
 static_threshold = 5
-scene_duration = 2.5
+max_gesture_tracks = 10
+scan_interval = config.get('wand_scan_interval', 1.0)
+confirm_interval = config.get('wand_confirm_interval', 2.5)
 rotate_camera = config['rotate_camera']
-# Background removal filter
-fgbg = cv2.createBackgroundSubtractorMOG2()
+# 'gray' tracks on the camera's luma plane, without color conversion
+camera_format = config.get('camera_format', 'bgr')
+# the camera stays open and warm between sessions, see camera.CameraPool
+cameras = CameraPool(lambda spec: open_source(spec, pixel_format=camera_format),
+                     rotate_camera, config.get('camera_idle_release', 60))
+# Timing for each stage of tracking, exported at /metrics
+capture_time = metrics.stage('capture')
+process_time = metrics.stage('process_image')
+detect_time = metrics.stage('detect')
+flow_time = metrics.stage('optical_flow')
+gesture_time = metrics.stage('gesture')
+gate_time = metrics.stage('motion_gate')
+idle_frames = metrics.counter('idle_frames', 'Frames only checked for motion while idle.')
+tracked_frames = metrics.counter('tracked_frames', 'Frames processed by the wand tracker.')
+frame_scans = metrics.counter('frame_scans', 'Whole-frame searches for new wands.')
+
+# Debug view for the Flask endpoints, see stream.py
+debug_stream = FrameBroadcaster(config.get('debug_stream_fps', 10))
+
+# Wand tip detection, see detectors.py
+wand_detector = create_detector(
+    config.get('wand_detector', 'hough'),
+    config.get('wand_detector_gate', False),
+    **config.get('wand_detector_params', {}))
+
+# Lucas-Kanade optical flow sized for the frames and wand speed, see flow.py
+optical_flow = OpticalFlow(config.get('wand_max_speed', 1500), config.get('camera_fps', 30),
+                           max_acceleration=config.get('wand_max_acceleration'))
+# between scans, only process and follow the area around tracked points
+flow_roi = config.get('wand_flow_roi', False)
+
+# Wand points keep their identity while tracked, see tracks.py
+tracks = TrackManager(lost_timeout=config.get('wand_lost_timeout', 1.0),
+                      min_confidence=config.get('wand_min_confidence', 0.3),
+                      static_after=config.get('wand_static_after', 3.0))
+
+# Only check for motion, a few times a second, while nothing moves; see idle.py
+idle_gate = None
+if config.get('idle_mode', True):
+    idle_gate = MotionGate(idle_after=config.get('idle_after', 10))
+idle_period = 1 / config.get('idle_fps', 5)
 
 # Spells
-spells_list = {
-    "!right!up": "lumos",
-    "!right!down": "nox",
-    "!left!up": "incendio",
-    "!left!down": "colovaria"
-}
-
-motions_list = ("!right", "!left", "!up", "!down",
-                "!ADR", "!ADL", "!AUR", "!AUL")
-
-def StartCamera():
-    """Initialize camera input."""
+spell_matcher = SpellMatcher(spells_list)
+# Optional template matching of whole trajectories instead of IsGesture
+trajectories = None
+if config.get('gesture_recognizer', 'tokens') == 'trajectory':
+    templates_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  config.get('gesture_templates', 'spell_templates.json'))
+    trajectories = TrajectoryRecognizer(load_templates(templates_path))
+
+# Optional record of every tracked point, for tuning gestures; see recorder.py
+recorder = None
+if config.get('wand_recording'):
+    recorder = Recorder(config['wand_recording'],
+                        max_bytes=config.get('wand_recording_max_mb', 8) << 20,
+                        max_files=config.get('wand_recording_files', 8))
+
+# Capture, detection and optical flow in their own processes, see pipeline.py
+pipeline_latency = metrics.stage('pipeline_latency')
+
+def StartCamera(source=None):
+    """
+    Initialize camera input.
+
+    `source` may be a camera device number, a recording to replay or any
+    object with a `VideoCapture`-like `read()`; it defaults to
+    config['camera_source'] (a synthetic scene without the lamp hardware).
+    Cameras opened from a number or a path come from `cameras`, still warm
+    if the last session ended recently.
+    """
     # Open a window for debug
     if debug_opencv:
         cv2.namedWindow("Raspberry Potter")
     # Initialize camera
     try:
-        cam = cv2.VideoCapture(0)
-        cam.set(3, 640)
-        cam.set(4, 480)
-        print('Camera started')
+        # frames are read, rotated and mirrored on a dedicated thread
+        if source is None or isinstance(source, (int, str)):
+            cam = cameras.acquire(hardware.camera_source() if source is None else source)
+        else:
+            cam = FrameGrabber(source, rotate_camera).start()
+        log.info('Camera started')
         return cam
     except Exception as camera:
-        print('Camera already open')
+        log.warning('Camera already open')
 
 
 def IsGesture(newX,newY,oldX,oldY,i,ig):
     """
     Determines if the point has moved.
+
+    `i` is the point's track ID, so its gesture state follows the point.
     """
 
     point_gestures = ig
     spell_cast = False
     #look for basic movements - TODO: trained gestures
-    moveX = newX - oldX
-    moveY = newY - oldY
-    # if moveX > movement_threshold and abs(moveY) < static_threshold:
-    if moveX > movement_threshold and abs(moveY) < abs(moveX / 2):
-        point_gestures[i].append("!right")
-    # elif moveX < (0 - movement_threshold) and abs(moveY) < static_threshold:
-    elif moveX < (0 - movement_threshold) and abs(moveY) < abs(moveX / 2):
-        point_gestures[i].append("!left")
-    # elif moveY > movement_threshold and abs(moveX) < static_threshold:
-    elif moveY > movement_threshold and abs(moveX) < abs(moveY / 2):
-        point_gestures[i].append("!up")
-    # elif moveY < (0 - movement_threshold) and abs(moveX) < static_threshold:
-    elif moveY < (0 - movement_threshold) and abs(moveX) < abs(moveY / 2):
-        point_gestures[i].append("!down")
-    # Check diagonals
-    # elif 0.8 < abs(moveX/moveY) < 1.2 and abs(moveX) > movement_threshold:
-    #     if moveX < 0 and moveY < 0:
-    #         point_gestures[i].append("!ADL") # Down-Left
-    #     if moveX > 0 and moveY < 0:
-    #         point_gestures[i].append("!ADR") # Down-Right
-    #     if moveX < 0 and moveY > 0:
-    #         point_gestures[i].append("!AUL") # Up-Left
-    #     if moveX > 0 and moveY > 0:
-    #         point_gestures[i].append("!AUR") # Up-Right
+    motion = point_gestures[i].motion(newX, newY, oldX, oldY, movement_threshold)
 
     # PART 5B 
-    #check for gesture patterns in array
-    astr = ''.join(map(str, point_gestures[i]))
+    #check for gesture patterns, one motion at a time
+    spell = spell_matcher.feed(point_gestures[i], motion) if motion else None
 
-    if abs(moveX) > movement_threshold or abs(moveY) > movement_threshold:
-        print(f'-> movement: dx={int(moveX * 100) / 100}, dy={int(moveY * 100) / 100}')
-        print(f'    -> {i}: {astr}')
+    if motion and log.enabled(logs.DEBUG):
+        log.debug('Point moved', point=i, motion=motion, gesture=str(point_gestures[i]))
 
-    # Look for spells in the casting string
-    for motion, spell in spells_list.items():
-        if motion in astr:
-            cast_spell(spell)
-            print(f'Spell "{spell}" cast for point {i} string: {astr}')
-            spell_cast = True
-            break # only cast one spell
+    if spell is not None:
+        cast_spell(spell)
+        log.info('Spell cast', spell=spell, point=i, gesture=str(point_gestures[i]))
+        spell_cast = spell
 
     return point_gestures, spell_cast
 
 
-def ProcessImage(frame):
-    """
-    Take the input frame and add filters for isolating points.
+def ProcessImage(frame, roi=None):
     """
+    Take the input frame and add filters for isolating points, only within
+    `roi` (x0, y0, x1, y1) if given.
 
-    filtered = cv2.cvtColor(frame,cv2.COLOR_BGR2GRAY)
-    cv2.equalizeHist(filtered)
-    filtered = cv2.GaussianBlur(filtered,(9,9),1.5)
-    dilate_kernel = np.ones(dilation_params, np.uint8)
-    filtered = cv2.dilate(filtered, dilate_kernel, iterations=1)
-    clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8,8))
-    filtered = clahe.apply(filtered)
-    # Background removal from mamacker's pi_to_potter
-    # fgmask = fgbg.apply(filtered, learningRate=0.001)
-    # filtered = cv2.bitwise_and(
-    #     filtered, filtered, mask=fgmask)
-    # th, filtered = cv2.threshold(filtered, 180, 255, cv2.THRESH_BINARY)
-
-    return filtered
-
-def FindWand(cam):
-    """
-    FindWand is called to find all potential wands in a scene.  These are then 
-    tracked as points for movement.  The scene is reset based on scene_duration.
+    The returned image is reused two calls later; copy it to keep it longer.
     """
 
-    try:
-        rval, old_frame = cam.read()
-        if rotate_camera is not None:
-            old_frame = cv2.rotate(old_frame, rotate_camera)
-        cv2.flip(old_frame,1,old_frame)
-        old_gray = ProcessImage(old_frame)
-        #TODO: trained image recognition
-        p0 = cv2.HoughCircles(old_gray,cv2.HOUGH_GRADIENT,3,50,param1=240,param2=8,minRadius=4,maxRadius=15)
-        if p0 is not None:
-            p0.shape = (p0.shape[1], 1, p0.shape[2])
-            p0 = p0[:,:,0:2]
-        mask = np.zeros_like(old_frame)
-        ig = [[''] for x in range(20)]
-
-        print("finding...")
-        return rval,old_frame,old_gray,p0,mask,ig
-
-    except Exception as e:
-        print(f'Error: {e}')
-        End(cam)
-        exit
+    return image_pipeline.process(frame, roi=roi)
 
+def FindWand(gray, regions=None):
+    """
+    FindWand is called to find potential wands in a scene, across the whole
+    frame or only in `regions` where tracks were lost.  Detections are
+    matched to existing tracks and the rest are tracked as new points; a
+    whole-frame search also confirms the points already tracked.
+    """
+    #TODO: trained image recognition
+    with detect_time:
+        if regions is None:
+            points = wand_detector.detect(gray)
+        else:
+            points = detect_regions(wand_detector, gray, regions)
+    now = time.monotonic()
+    started = tracks.associate(points, now, confirm=regions is None)
+    if recorder is not None:
+        for key in started:
+            track = tracks.tracks[key]
+            recorder.record(now, key, track.x, track.y, NEW)
+    return started
+
+
+def ScanDue(shape, now, last_scan):
+    """
+    Whether to search the whole frame for new wands.
 
-def TrackWand():
+    While no point is followed, or none has moved in the last
+    `scan_interval`, that is every `scan_interval`.  Otherwise it
+    is only when the motion gate sees something move away from the followed
+    points, at most as often, or every `confirm_interval` to drop tracks
+    that optical flow has carried onto the background.
     """
-    Tracks wand points for `scene_duration` seconds.
+    since = now - last_scan
+    if since < scan_interval:
+        return False
+    if since >= confirm_interval or not tracks.live(now - scan_interval):
+        return True
+    return idle_gate is not None and idle_gate.moved_outside(
+        tracks.bounds(shape, optical_flow.margin(shape), parked=False))
+
+def TrackWand(source=None):
+    """
+    Tracks wand points until the lamp is turned off or `wand_timeout`.
     """
     wand_timeout = config["wand_timeout"]
-    cam = StartCamera()
+    cam = StartCamera(source)
     if not cam:
-        print('=== NO CAMERA FOUND ===')
-        WatchSpellsOff()
-        exit
-
-    wand_timer = time.time() + wand_timeout
-    rval,old_frame,old_gray,p0,mask,ig = FindWand(cam)
-    # Loop every `scene_duration` seconds until a wand is found
-    while rval is None and (time.time() < wand_timer or wand_timeout < 0):
-        time.sleep(scene_duration)
-        rval,old_frame,old_gray,p0,mask,ig = FindWand(cam)
-
-    # check if we've started the scene successfully within timeout
-    if rval is None:
-        print('Scene not started.')
+        log.error('No camera found')
         WatchSpellsOff()
-        exit
-
-    try:
-        color = (0,0,255)
-        rval, old_frame = cam.read()
-        if rotate_camera is not None:
-            old_frame = cv2.rotate(old_frame, rotate_camera)
-        cv2.flip(old_frame,1,old_frame)
-        old_gray = ProcessImage(old_frame)
-
-        # Take first frame and find circles in it
-        p0 = cv2.HoughCircles(old_gray,cv2.HOUGH_GRADIENT,3,50,param1=240,param2=8,minRadius=4,maxRadius=10)
-        if p0 is not None:
-            p0.shape = (p0.shape[1], 1, p0.shape[2])
-            p0 = p0[:,:,0:2]
-            mask = np.zeros_like(old_frame)
-    except Exception as e:
-        print("No points found")
-    # Create a mask image for drawing purposes
-    find_wand_timer = time.time() + scene_duration
+        return
+
+    color = (0,0,255)
+    tracks.reset()
+    ig = defaultdict(GestureState)
+    if trajectories is not None:
+        trajectories.reset()
+    # start awake: whoever turned us on is probably about to cast
+    tracking = True
+    if idle_gate is not None:
+        idle_gate.reset(awake=True)
+    mask = None
+    optical_flow.reset()
+    last_scan = -math.inf
     wand_timer = time.time() + wand_timeout
     captures = 0
-    frame_gray = None
-    good_new = None
-    good_old = None
     while LampState() and (time.time() < wand_timer or wand_timeout < 0):
-        captures = captures + 1
         try:
-            rval, frame = cam.read()
+            # latest frame only; the grabber drops frames we were too slow for
+            with capture_time:
+                rval, frame = cam.read()
             if frame is None:
                 continue
-            if rotate_camera is not None:
-                frame = cv2.rotate(frame, rotate_camera)
-            cv2.flip(frame,1,frame)
-            if p0 is not None:
-                frame_gray = ProcessImage(frame)
-
-                # calculate optical flow
-                p1, st, err = cv2.calcOpticalFlowPyrLK(old_gray, frame_gray, p0, None, **lk_params)
-
-                # Select good points
-                good_new = p1[st==1] if p1 is not None else good_new
-                good_old = p0[st==1] if p0 is not None else good_old
-
-                # draw the tracks
-                for i,(new,old) in enumerate(zip(good_new,good_old)):
-                    newX,newY = new.ravel()
-                    oldX,oldY = old.ravel()
-                    # only try to detect gesture on highly-rated points (below 10)
-                    if (i<10):
-                        ig, spell_cast = IsGesture(newX,newY,oldX,oldY,i,ig)
-                        time.sleep(0.1)
-                        # reset timer if spell is cast
-                        if spell_cast:
-                            wand_timer = time.time() + wand_timeout
+            now = time.monotonic()
+            if idle_gate is not None:
+                with gate_time:
+                    awake = idle_gate.update(frame, now)
+                if awake != tracking:
+                    tracking = awake
+                    # frames skipped while idle are not dropped for being slow
+                    cam.set_idle(not awake)
+                    if awake:
+                        log.info('Motion seen, tracking wands')
+                        last_scan = -math.inf
+                    else:
+                        log.info('Nothing moving, idling')
+                        tracks.reset()
+                        ig.clear()
+                        if trajectories is not None:
+                            trajectories.reset()
+                        optical_flow.reset()
+                if not awake:
+                    idle_frames.inc()
+                    time.sleep(max(0, now + idle_period - time.monotonic()))
+                    continue
+            captures = captures + 1
+            tracked_frames.inc()
+            scan = ScanDue(frame.shape, now, last_scan)
+            roi = None
+            if flow_roi and not scan:
+                roi = tracks.bounds(frame.shape, optical_flow.margin(frame.shape))
+            with process_time:
+                frame_gray = ProcessImage(frame, roi)
+            # the debug overlay is drawn in color, and only while someone looks at it
+            debug_frame = None
+            if debug_opencv or (config['debug_test_image'] and debug_stream.subscribers):
+                debug_frame = frame if frame.ndim == 3 else cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+                if mask is None or mask.shape != debug_frame.shape:
+                    mask = np.zeros_like(debug_frame)
+
+            # calculate optical flow for the active tracks
+            moved = []
+            ids, p0 = tracks.points()
+            with flow_time:
+                # start each search where the track's motion says the point went
+                guess = tracks.predictions(ids, now) if p0 is not None else None
+                flow = optical_flow.track(frame_gray, p0, roi, guess)
+            if flow is not None:
+                p1, st, err = flow
+                moved = tracks.advance(ids, p1, st, now, err)
+
+            # draw the tracks
+            for rank, (key, newX, newY, oldX, oldY) in enumerate(moved):
+                # only try to detect gestures on the most confident tracks
+                if rank < max_gesture_tracks and trajectories is None:
+                    with gesture_time:
+                        ig, spell_cast = IsGesture(newX,newY,oldX,oldY,key,ig)
+                    # reset timer if spell is cast
+                    if spell_cast:
+                        wand_timer = time.time() + wand_timeout
+                        if recorder is not None:
+                            recorder.record(now, key, newX, newY, SPELL, spell_index.get(spell_cast, 0))
+                if recorder is not None:
+                    token = motion_token(newX - oldX, newY - oldY, movement_threshold)
+                    recorder.record(now, key, newX, newY, token=token_index[token])
+                if debug_frame is not None:
                     dist = math.hypot(newX - oldX, newY - oldY)
                     if (dist>movement_threshold):
                         cv2.line(mask, (int(newX),int(newY)),(int(oldX),int(oldY)),(0,255,0), 2)
-                    cv2.circle(frame,(int(newX),int(newY)),5,color,-1)
-                    cv2.putText(frame, str(i), (int(newX),int(newY)), cv2.FONT_HERSHEY_SIMPLEX, 1.0, (0,0,255)) 
-                img = cv2.add(frame,mask)
-
-                # save for debug
+                    cv2.circle(debug_frame,(int(newX),int(newY)),5,color,-1)
+                    cv2.putText(debug_frame, str(key), (int(newX),int(newY)), cv2.FONT_HERSHEY_SIMPLEX, 1.0, (0,0,255))
+            # score all trajectories against the spell templates at once
+            if trajectories is not None and moved:
+                with gesture_time:
+                    recognized = trajectories.update(
+                        ((key, x, y) for key, x, y, _, _ in moved[:max_gesture_tracks]), now)
+                for key, spell in recognized:
+                    cast_spell(spell)
+                    log.info('Spell cast', spell=spell, point=key)
+                    wand_timer = time.time() + wand_timeout
+                    if recorder is not None:
+                        track = tracks.tracks[key]
+                        recorder.record(now, key, track.x, track.y, SPELL, spell_index.get(spell, 0))
+
+            # look for new wands across the frame when ScanDue says so,
+            # otherwise only around points optical flow just lost
+            if scan:
+                FindWand(frame_gray)
+                frame_scans.inc()
+                last_scan = now
+                if mask is not None:
+                    mask.fill(0)
+                log.debug('Frames captured', frames=captures, dropped=cam.dropped, points=len(tracks))
+                captures = 0
+            else:
+                regions = tracks.lost_regions(frame_gray.shape)
+                if regions:
+                    FindWand(frame_gray, regions)
+            for key in tracks.retire(now):
+                ig.pop(key, None)
+                if trajectories is not None:
+                    trajectories.reset(key)
+                if recorder is not None:
+                    recorder.record(now, key, 0, 0, RETIRED)
+
+            if debug_frame is not None:
+                img = cv2.add(debug_frame,mask,dst=debug_frame)
+                # share with /wand/stream viewers (encoded only while watched)
                 if config['debug_test_image']:
-                    # save for Flask endpoint
-                    _, img_encoded = cv2.imencode('.jpg', img)
-                    store.set(f'{redis_ns}:image', pickle.dumps(img_encoded))
-
-            if debug_opencv:
-                cv2.imshow("Raspberry Potter", frame)
+                    debug_stream.publish(img)
 
-            # get next frame
-            rval, frame = cam.read()
-            if rotate_camera is not None:
-                frame = cv2.rotate(frame, rotate_camera)
-
-            # Now update the previous frame and previous points
-            old_gray = frame_gray.copy() if frame_gray is not None else None
-            p0 = good_new.reshape(-1,1,2) if good_new is not None else None
-        except IndexError:
-            print("Index error - Tracking")  
+                if debug_opencv:
+                    cv2.imshow("Raspberry Potter", img)
         except Exception as error:
             # e = sys.exc_info()[0]
-            print(f'Tracking Error: {error}')
-            print(traceback.format_exc())
-        
-        # Scene resets every `scene_duration` seconds
-        if time.time() > find_wand_timer:
-            rval,old_frame,old_gray,p0,mask,ig = FindWand(cam)
-            find_wand_timer = time.time() + scene_duration
-            print(f'Images captured this scene: {captures}')
-            print(f'{len(ig)} points found in new scene.')
-            captures = 0
-    
+            log.exception('Tracking error', error=error)
+
     # The End
+    if recorder is not None:
+        recorder.flush()
+    End(cam)
+    WatchSpellsOff()
+
+def PipelineSettings():
+    """Everything the tracking processes of pipeline.py need to know."""
+    return {
+        'rotate': rotate_camera,
+        'camera_format': camera_format,
+        'slots': 3,
+        'stages': config.get('preprocess_stages', default_stages),
+        'dilation': dilation_params,
+        'detector': config.get('wand_detector', 'hough'),
+        'detector_gate': config.get('wand_detector_gate', False),
+        'detector_params': config.get('wand_detector_params', {}),
+        'scan_interval': scan_interval,
+        'confirm_interval': confirm_interval,
+        'tracks': dict(lost_timeout=tracks.lost_timeout, min_confidence=tracks.min_confidence,
+                       static_after=tracks.static_after),
+        'idle': idle_gate is not None,
+        'idle_after': idle_gate.idle_after if idle_gate is not None else 0,
+        'idle_fps': 1 / idle_period,
+        'templates': templates_path if trajectories is not None else None,
+        'flow': dict(max_speed=optical_flow.max_speed, fps=optical_flow.fps,
+                     max_acceleration=optical_flow.max_acceleration),
+        'movement_threshold': movement_threshold,
+        'max_gesture_tracks': max_gesture_tracks,
+    }
+
+
+def TrackWandPipeline(source=None):
+    """
+    Tracks wand points like TrackWand, with capture, detection and optical
+    flow each in a process of their own.
+    """
+    wand_timeout = config["wand_timeout"]
+    if source is None:
+        source = hardware.camera_source()
+    vision = VisionPipeline(source, PipelineSettings()).start()
+    log.info('Vision pipeline started')
+    wand_timer = time.time() + wand_timeout
+    try:
+        while LampState() and (time.time() < wand_timer or wand_timeout < 0):
+            try:
+                message = vision.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if message is None:
+                break
+            if message[0] == 'spell':
+                _, spell, key = message
+                cast_spell(spell)
+                log.info('Spell cast', spell=spell, point=key)
+                wand_timer = time.time() + wand_timeout
+            else:
+                _, captured, done = message
+                tracked_frames.inc()
+                pipeline_latency.observe(done - captured)
+    finally:
+        vision.stop()
+
+    # The End
+    LampState('off')
+    log.info('Tracking stopped')
+    WatchSpellsOff()
+
+def TrackWandOffload(source=None):
+    """
+    Tracks wand points like TrackWand, on the vision worker at
+    config['offload_host'] (see offload.py): frames are sent there and the
+    spells it recognizes come back.
+    """
+    wand_timeout = config["wand_timeout"]
+    wand_timer = time.time() + wand_timeout
+
+    def on_spell(spell, key):
+        nonlocal wand_timer
+        cast_spell(spell)
+        log.info('Spell cast', spell=spell, point=key)
+        wand_timer = time.time() + wand_timeout
+
+    client = OffloadClient(config.get('offload_host', '127.0.0.1'), config.get('offload_port', 9000),
+                           name=config.get('offload_name'), on_spell=on_spell,
+                           max_in_flight=config.get('offload_max_in_flight', 2),
+                           quality=config.get('offload_quality', 80), crop=config.get('offload_crop'))
+    try:
+        client.connect()
+    except OSError as error:
+        log.error('No vision worker', error=error)
+        WatchSpellsOff()
+        return
+    cam = StartCamera(source)
+    if not cam:
+        log.error('No camera found')
+        client.close()
+        WatchSpellsOff()
+        return
+    log.info('Sending frames to the vision worker', host=client.address[0], port=client.address[1])
+
+    tracking = True
+    if idle_gate is not None:
+        idle_gate.reset(awake=True)
+    while LampState() and (time.time() < wand_timer or wand_timeout < 0):
+        with capture_time:
+            rval, frame = cam.read()
+        if frame is None:
+            continue
+        now = time.monotonic()
+        # nothing to send while nothing moves
+        if idle_gate is not None:
+            with gate_time:
+                awake = idle_gate.update(frame, now)
+            if awake != tracking:
+                tracking = awake
+                cam.set_idle(not awake)
+                log.info('Motion seen, tracking wands' if awake else 'Nothing moving, idling')
+            if not awake:
+                idle_frames.inc()
+                time.sleep(max(0, now + idle_period - time.monotonic()))
+                continue
+        if not client.connected:
+            log.error('Lost the vision worker')
+            break
+        try:
+            if client.send(frame, now):
+                tracked_frames.inc()
+        except OSError as error:
+            log.error('Lost the vision worker', error=error)
+            break
+
+    # The End
+    client.close()
+    log.info('Offload finished', sent=client.sent, dropped=client.dropped)
     End(cam)
     WatchSpellsOff()
 
 def End(cam):
     # Stop IR emitter
     LampState('off')
-    print('=== END ===')
+    log.info('Tracking stopped')
     try:
-	    cam.close()
+        # paused and kept open for the next session
+        cameras.release(cam)
     except Exception as e:
-        print('Camera not found.')
-    cv2.destroyAllWindows()
+        log.warning('Camera not found')
+    if debug_opencv:
+        cv2.destroyAllWindows()
 
 def WatchSpellsOn():
     """Start watching for spells."""
     LampState('on')
-    # Light up for 5s to let the Wizard know you're ready
-    lumos(0, (16,16,255), True)
+    # Light up to let the Wizard know you're ready, while the camera starts
+    cast_spell('lumos', 0, (16,16,255))
     # track wand
-    print("Begin Tracking Wand")
-    TrackWand()
+    log.info('Begin tracking wand')
+    vision = config.get('vision_pipeline', 'thread')
+    if vision == 'processes':
+        TrackWandPipeline()
+    elif vision == 'offload':
+        TrackWandOffload()
+    else:
+        TrackWand()
 
 def WatchSpellsOff():
     """Stop watching for spells."""